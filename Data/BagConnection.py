@@ -0,0 +1,211 @@
+"""Read-only, memory-mapped SQLite connections to recorded bags.
+
+ROSDeserializer.connect() opens a bag like any database: read-write, with
+a 2 MB page cache, every page copied from the OS into SQLite's cache and
+file locks taken for every read transaction. Recorded bags never change, so
+open_readonly() opens them through a 'file:...?mode=ro&immutable=1' URI
+(no locks, no change detection, the file cannot be modified or created by
+mistake) and sets:
+
+    mmap_size    pages are read straight from the OS page cache, not copied
+                 (SQLite caps it at its compile-time limit, 2 GB by default)
+    cache_size   a larger page cache for what is not memory-mapped
+
+temp_store is left to SQLite unless given: 'memory' made an unindexed
+GROUP BY over a 6M-row bag three times slower here (its temporary b-tree
+competes with the page cache).
+
+Do not open a bag that is still being recorded with immutable=True: SQLite
+would not see the new rows (and could read a half-written page); pass
+immutable=False for those.
+
+A sqlite3 connection must not be shared between threads that use it at the
+same time. ConnectionPool gives each thread its own read-only connection to
+the same bag:
+
+    pool = ConnectionPool('bag_0.db3')
+    def work(topic):                      # run on any number of threads
+        conn = pool.connection()
+        ...
+    pool.close()
+
+    python BagConnection.py --bag big_0.db3   # cold/warm scans: connect() vs open_readonly()
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+MMAP_SIZE = 1 << 34
+CACHE_SIZE_KB = 64 * 1024
+TEMP_STORE = None
+
+
+def readonly_uri(path, immutable=True):
+    """ Returns the 'file:' URI opening path read-only. """
+    return 'file:{}?mode=ro{}'.format(pathname2url(os.path.abspath(path)), '&immutable=1' if immutable else '')
+
+
+def open_readonly(path, immutable=True, mmap_size=MMAP_SIZE, cache_size_kb=CACHE_SIZE_KB, temp_store=TEMP_STORE,
+                  check_same_thread=True):
+    """ Opens a bag read-only with the pragmas of the module docstring.
+    mmap_size=0 disables memory mapping, temp_store=None keeps SQLite's
+    default ('memory' or 'file'). Raises sqlite3.OperationalError if
+    the file does not exist.
+    """
+    if not os.path.exists(path):
+        # SQLite would only say 'unable to open database file'
+        raise sqlite3.OperationalError('No such bag file: {}'.format(path))
+    conn = sqlite3.connect(readonly_uri(path, immutable), uri=True, check_same_thread=check_same_thread)
+    conn.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+    conn.execute('PRAGMA cache_size = -{:d}'.format(cache_size_kb))
+    if temp_store is not None:
+        conn.execute('PRAGMA temp_store = {}'.format(temp_store))
+    return conn
+
+
+class ConnectionPool:
+    """ One read-only connection per thread to the same bag, created on the
+    thread's first connection() call. close() closes them all.
+    """
+
+    def __init__(self, path, **options):
+        self.path = path
+        self.options = options
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """ Returns the connection of the calling thread. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Created and used by this thread only, but closed by close() from another one
+            conn = open_readonly(self.path, check_same_thread=False, **self.options)
+            with self._lock:
+                if self._connections is None:
+                    conn.close()
+                    raise sqlite3.ProgrammingError('Cannot use a closed ConnectionPool')
+                self._connections.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return len(self._connections or ())
+
+    def close(self):
+        """ Closes every connection. Do not call it while threads are still reading. """
+        import ROSDeserializer
+        with self._lock:
+            connections, self._connections = self._connections or [], None
+        for conn in connections:
+            ROSDeserializer.close(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def drop_from_page_cache(path):
+    """ Asks the OS to evict a file from its page cache, for cold-cache
+    measurements. Returns False when the platform cannot do it.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def _scan(conn, topics=None, sql=False):
+    """ Reads messages in timestamp order through ROSDeserializer.iter_messages,
+    or with sql=True sums their sizes in SQLite, without creating Python rows.
+    """
+    import ROSDeserializer
+    if sql:
+        return conn.execute('SELECT SUM(length(data)) FROM messages').fetchone()[0]
+    size = 0
+    for message in ROSDeserializer.iter_messages(conn, topics=topics, batch_size=10000):
+        size += len(message.data)
+    return size
+
+
+def _smallest_topic(path):
+    import ROSDeserializer
+    conn = open_readonly(path)
+    catalog = ROSDeserializer.get_catalog(conn)
+    topic = min(catalog, key=lambda info: catalog.count(info.name)).name
+    ROSDeserializer.close(conn)
+    return topic
+
+
+def _opener(kind):
+    if kind == 'connect':
+        import ROSDeserializer
+        return lambda path: ROSDeserializer.connect(path)[0]
+    return open_readonly
+
+
+def benchmark(path, scans=('all', 'topic', 'sql'), repeat=3):
+    """ Times each scan with connect() and open_readonly(), cold (bag evicted
+    from the page cache first) and warm. Returns [(scan, opener, cache, seconds)].
+    """
+    import ROSDeserializer
+    # 'all': every message; 'topic': the smallest topic, an index walk skipping most rows;
+    # 'sql': every message read by SQLite alone, where the page reads are not hidden by Python
+    topics = {'all': None, 'sql': None, 'topic': [_smallest_topic(path)] if 'topic' in scans else None}
+    results = []
+    for scan in scans:
+        for kind in ('connect', 'readonly'):
+            for cache in ('cold', 'warm'):
+                best = float('inf')
+                for _ in range(repeat):
+                    if cache == 'cold' and not drop_from_page_cache(path):
+                        break
+                    start = time.perf_counter()
+                    conn = _opener(kind)(path)
+                    _scan(conn, topics[scan], sql=scan == 'sql')
+                    ROSDeserializer.close(conn)
+                    best = min(best, time.perf_counter() - start)
+                results.append((scan, kind, cache, best if best < float('inf') else None))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare scans of a bag through connect() and the read-only, "
+                                                 "memory-mapped connections, with a cold and a warm page cache.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--scans", type=str, default="all,topic,sql",
+                        help="Comma-separated scans: all (every message), topic (the smallest topic), "
+                             "sql (every message, summed in SQLite).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is reported).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    size_mb = os.path.getsize(args.bag) / 1e6
+    print(f"{args.bag}: {size_mb:.0f} MB")
+    results = benchmark(args.bag, [scan.strip() for scan in args.scans.split(',') if scan.strip()], args.repeat)
+    timings = {(scan, kind, cache): seconds for scan, kind, cache, seconds in results}
+    print(f"{'scan':<6} {'cache':<5} {'connect s':>10} {'readonly s':>11} {'speedup':>8} {'readonly MB/s':>14}")
+    for scan, kind, cache, _ in results:
+        if kind != 'connect':
+            continue
+        base, fast = timings[(scan, 'connect', cache)], timings[(scan, 'readonly', cache)]
+        if base is None or fast is None:
+            print(f"{scan:<6} {cache:<5} {'(cannot drop the page cache here)':>35}")
+            continue
+        print(f"{scan:<6} {cache:<5} {base:>10.3f} {fast:>11.3f} {base / fast:>7.2f}x {size_mb / fast:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
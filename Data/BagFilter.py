@@ -0,0 +1,161 @@
+"""Subset bags: keep some topics, trim to a time window, merge splits.
+
+The messages are copied as they are stored (CDR blobs, timestamps, topic
+type, serialization format and QoS), never deserialized, and ROS is not
+needed. Every input split is read through the read-only, memory-mapped
+connections of BagConnection and appended by BagWriter.SqliteBagWriter
+in one INSERT ... SELECT per split: one sequential pass in storage order,
+with the topic and time filters evaluated by SQLite and no row going
+through Python. The new split is written without journaling and its
+timestamp_idx is built once at the end. The output is a bag directory with
+a single .db3 split and its metadata.yaml.
+
+    python BagFilter.py bag_dir --out_dir small_bag --topics /sensing/imu/tamagawa/imu_raw
+    python BagFilter.py bag_dir --out_dir cut --start_s 60 --duration_s 30 --exclude /sensing/camera/image
+    python BagFilter.py run_a run_b/run_b_3.db3 --out_dir merged       # several bags or splits into one
+
+Inputs are bag directories, metadata.yaml files or single .db3 splits.
+Splits are copied in order of their first timestamp, and those entirely
+outside the time window are not read. A topic that appears in several
+inputs must have the same type in all of them.
+"""
+import argparse
+import glob
+import os
+import time
+
+import BagStorage
+import BagWriter
+
+
+def _bag_splits(path):
+    """ Returns the .db3 files of a bag directory, metadata.yaml or split. """
+    if os.path.isdir(path):
+        metadata_path = os.path.join(path, 'metadata.yaml')
+        if not os.path.exists(metadata_path):
+            splits = sorted(glob.glob(os.path.join(path, '*.db3')))
+            if not splits:
+                raise FileNotFoundError('No metadata.yaml or .db3 file in {}'.format(path))
+            return splits
+        path = metadata_path
+    if os.path.basename(path) != 'metadata.yaml':
+        if BagStorage.detect_storage(path) != 'sqlite3':
+            raise ValueError('Only SQLite (.db3) bags can be filtered: {}'.format(path))
+        return [path]
+    import BagReader
+    reader = BagReader.BagReader(path)
+    if reader.storage_identifier != 'sqlite3':
+        raise ValueError('Only SQLite (.db3) bags can be filtered: {} is {}'.format(path, reader.storage_identifier))
+    return [split.path for split in reader.splits]
+
+
+def list_splits(paths):
+    """ Returns (path, start_ns, end_ns) for every split of paths, by start
+    time. The bounds (None for an empty split) are two index lookups each.
+    """
+    splits = []
+    for path in paths:
+        for split_path in _bag_splits(path):
+            with BagStorage.SqliteStorage(split_path) as storage:
+                start_ns, end_ns = storage.time_bounds()
+            splits.append((split_path, start_ns, end_ns))
+    return sorted(splits, key=lambda split: (split[1] is None, split[1] or 0))
+
+
+def copy_split(writer, path, topics=None, exclude=(), start_ns=None, end_ns=None):
+    """ Appends the messages of one .db3 split to writer. topics (None for
+    all) and exclude are topic names; start_ns/end_ns bound the timestamps
+    (inclusive). Returns the number of messages copied.
+    """
+    with BagStorage.SqliteStorage(path) as storage:
+        ids = {}
+        for info in storage.catalog:
+            if (topics is not None and info.name not in topics) or info.name in exclude:
+                continue
+            known = writer.topics.get(info.name)
+            if known is not None and known['type'] != info.type:
+                raise ValueError('Topic {} is {} in {} but {} in an earlier input'.format(
+                    info.name, info.type, path, known['type']))
+            ids[info.id] = writer.add_topic(info.name, info.type, info.serialization_format,
+                                            info.offered_qos_profiles)
+    return writer.copy_from(path, ids, start_ns, end_ns)
+
+
+def filter_bag(inputs, out_dir, topics=None, exclude=(), start_ns=None, end_ns=None, overwrite=False):
+    """ Writes the selected messages of inputs (bag directories, metadata.yaml
+    files or .db3 splits) to a new bag in out_dir, see the module docstring.
+    Unless overwrite is set, out_dir must not hold a bag already nor be the
+    directory of an input. An input split is never overwritten.
+    Returns the closed SqliteBagWriter of the output split.
+    """
+    splits = list_splits(inputs)
+    if not overwrite:
+        # write_metadata() would replace the metadata.yaml of a bag, e.g. of an input bag directory
+        if os.path.exists(os.path.join(out_dir, 'metadata.yaml')):
+            raise FileExistsError('{} already holds a bag (metadata.yaml), pass overwrite=True (--overwrite) '
+                                  'to replace it'.format(out_dir))
+        input_dirs = {os.path.realpath(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)))
+                      for path in inputs}
+        if os.path.realpath(out_dir) in input_dirs:
+            raise ValueError('{} is an input directory, pass overwrite=True (--overwrite) to write '
+                             'there anyway'.format(out_dir))
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, '{}_0.db3'.format(os.path.basename(os.path.abspath(out_dir))))
+    for path, _, _ in splits:
+        if os.path.exists(out_path) and os.path.samefile(path, out_path):
+            raise ValueError('The output split {} is also an input'.format(out_path))
+    topics = set(topics) if topics is not None else None
+    exclude = set(exclude)
+
+    writer = BagWriter.SqliteBagWriter(out_path, overwrite=overwrite)
+    try:
+        for path, split_start_ns, split_end_ns in splits:
+            if split_start_ns is None or (end_ns is not None and split_start_ns > end_ns) \
+                    or (start_ns is not None and split_end_ns < start_ns):
+                continue
+            copy_split(writer, path, topics, exclude, start_ns, end_ns)
+    finally:
+        writer.close()
+    BagWriter.write_metadata(out_dir, [writer])
+    return writer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write a new bag with some topics, a time window or several "
+                                                 "bags merged, copying the messages without decoding them.")
+    parser.add_argument("inputs", nargs="+", help="Bag directories, metadata.yaml files or .db3 splits.")
+    parser.add_argument("--out_dir", type=str, required=True, help="Directory of the new bag.")
+    parser.add_argument("--topics", type=str, default="", help="Comma-separated topics to keep (default: all).")
+    parser.add_argument("--exclude", type=str, default="", help="Comma-separated topics to drop.")
+    parser.add_argument("--start_s", type=float, default=None,
+                        help="Window start, in seconds from the start of the first input.")
+    parser.add_argument("--duration_s", type=float, default=None, help="Window length in seconds.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing output bag, or write into an input directory.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    topics = [t.strip() for t in args.topics.split(",") if t.strip()] or None
+    exclude = [t.strip() for t in args.exclude.split(",") if t.strip()]
+
+    start_ns = end_ns = None
+    if args.start_s is not None or args.duration_s is not None:
+        starts = [start for _, start, _ in list_splits(args.inputs) if start is not None]
+        first_ns = min(starts) if starts else 0
+        start_ns = first_ns + int((args.start_s or 0) * 1e9)
+        if args.duration_s is not None:
+            end_ns = start_ns + int(args.duration_s * 1e9)
+
+    start = time.perf_counter()
+    writer = filter_bag(args.inputs, args.out_dir, topics, exclude, start_ns, end_ns, args.overwrite)
+    elapsed = time.perf_counter() - start
+    size_mb = os.path.getsize(writer.path) / 1e6
+    for name, topic in writer.topics.items():
+        print(f"{name}: {topic['message_count']} messages")
+    print(f"Wrote {writer.message_count} messages ({size_mb:.1f} MB) to {writer.path} in {elapsed:.2f} s "
+          f"({size_mb / max(elapsed, 1e-9):.0f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
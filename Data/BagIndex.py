@@ -0,0 +1,222 @@
+"""Time-range queries across topics, backed by a sparse per-topic time index.
+
+query_time_range(conn, topics, start_ns, end_ns) returns the messages of a
+set of topics inside [start_ns, end_ns], merged across topics in timestamp
+order (heap-based k-way merge). Without an index every topic is read through
+timestamp_idx. With a SparseTimeIndex, which stores a (rowid range, min/max
+timestamp) checkpoint every 'stride' messages of each topic, only the rowid
+ranges of that topic overlapping the window are visited, so busy topics
+in the same window (e.g. lidar packets) are never touched.
+
+The index is built with one pass over the ids and timestamps of the bag and
+saved next to it (<bag>.tindex.json), so later queries start immediately.
+
+    python BagIndex.py --bag sample-rosbag_0.db3 --start_s 10 --duration_s 1
+"""
+import argparse
+import bisect
+import heapq
+import json
+import os
+import time
+
+import ROSDeserializer
+
+
+class SparseTimeIndex:
+    """ Checkpoints of each topic: blocks of 'stride' consecutive messages,
+    stored as (first_id, last_id, min_timestamp, max_timestamp).
+    """
+
+    def __init__(self, blocks, stride, signature=None):
+        self.blocks = blocks  # topic_id -> list of blocks, in rowid order
+        self.stride = stride
+        self.signature = signature
+        # Running maximum of the block end times, to bisect on even when the
+        # timestamps are not perfectly monotonic in rowid
+        self._max_ends = {}
+        # Whether the blocks of a topic are disjoint and ordered in time
+        self._sorted = {}
+        for topic_id, topic_blocks in blocks.items():
+            ends = []
+            latest = None
+            for block in topic_blocks:
+                latest = block[3] if latest is None else max(latest, block[3])
+                ends.append(latest)
+            self._max_ends[topic_id] = ends
+            self._sorted[topic_id] = all(a[3] <= b[2] for a, b in zip(topic_blocks, topic_blocks[1:]))
+
+    @classmethod
+    def build(cls, conn, stride=1000):
+        """ Builds the index with a single scan of (id, topic_id, timestamp). """
+        conn = getattr(conn, 'connection', conn)
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, topic_id, timestamp FROM messages ORDER BY id')
+        blocks = {}
+        open_blocks = {}  # topic_id -> [first_id, last_id, min_ts, max_ts, count]
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row_id, topic_id, timestamp in rows:
+                block = open_blocks.get(topic_id)
+                if block is None:
+                    open_blocks[topic_id] = [row_id, row_id, timestamp, timestamp, 1]
+                    continue
+                block[1] = row_id
+                if timestamp < block[2]:
+                    block[2] = timestamp
+                if timestamp > block[3]:
+                    block[3] = timestamp
+                block[4] += 1
+                if block[4] == stride:
+                    blocks.setdefault(topic_id, []).append(tuple(block[:4]))
+                    del open_blocks[topic_id]
+        for topic_id, block in open_blocks.items():
+            blocks.setdefault(topic_id, []).append(tuple(block[:4]))
+        cursor.close()
+        return cls(blocks, stride, _bag_signature(conn))
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump({'stride': self.stride, 'signature': self.signature,
+                       'blocks': {str(topic_id): blocks for topic_id, blocks in self.blocks.items()}}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as file:
+            data = json.load(file)
+        blocks = {int(topic_id): [tuple(block) for block in topic_blocks]
+                  for topic_id, topic_blocks in data['blocks'].items()}
+        return cls(blocks, data['stride'], data['signature'])
+
+    def id_ranges(self, topic_id, start_ns, end_ns):
+        """ Returns the (first_id, last_id) ranges of a topic whose blocks
+        overlap [start_ns, end_ns]; consecutive blocks are coalesced.
+        """
+        topic_blocks = self.blocks.get(topic_id, [])
+        # All blocks before this position end before start_ns
+        position = bisect.bisect_left(self._max_ends.get(topic_id, []), start_ns)
+        ranges = []
+        previous = None
+        for position in range(position, len(topic_blocks)):
+            first_id, last_id, min_ts, max_ts = topic_blocks[position]
+            if min_ts > end_ns:
+                if self._sorted[topic_id]:
+                    break  # all later blocks start even later
+                continue
+            if max_ts < start_ns:
+                continue
+            if previous == position - 1:
+                ranges[-1] = (ranges[-1][0], last_id)
+            else:
+                ranges.append((first_id, last_id))
+            previous = position
+        return ranges
+
+
+def _bag_signature(conn):
+    """ Identifies the bag's content, to detect a stale index file. """
+    cursor = conn.cursor()
+    # Separate subqueries, so each one is a single b-tree lookup
+    cursor.execute('SELECT (SELECT MAX(id) FROM messages), (SELECT MAX(timestamp) FROM messages)')
+    signature = list(cursor.fetchone())
+    cursor.close()
+    return signature
+
+
+def index_path(bag_path):
+    return bag_path + '.tindex.json'
+
+
+def load_or_build_index(conn, bag_path, stride=1000):
+    """ Returns the index saved next to the bag, (re)building it if it is
+    missing or the bag has changed since.
+    """
+    path = index_path(bag_path)
+    if os.path.isfile(path):
+        index = SparseTimeIndex.load(path)
+        if index.signature == _bag_signature(getattr(conn, 'connection', conn)) and index.stride == stride:
+            return index
+    index = SparseTimeIndex.build(conn, stride)
+    index.save(path)
+    return index
+
+
+def _iter_topic_window(conn, topic_id, topic_name, ranges, start_ns, end_ns):
+    """ Yields the BagMessage of one topic inside the window, reading only the
+    given rowid ranges.
+    """
+    if not ranges:
+        return
+    id_filter = ' OR '.join('id BETWEEN ? AND ?' for _ in ranges)
+    params = [bound for id_range in ranges for bound in id_range] + [topic_id, start_ns, end_ns]
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT id, timestamp, data FROM messages WHERE ({}) AND topic_id = ? '
+                       'AND timestamp BETWEEN ? AND ? ORDER BY timestamp, id'.format(id_filter), params)
+        for row_id, timestamp, data in cursor:
+            yield ROSDeserializer.BagMessage(row_id, topic_name, timestamp, data)
+    finally:
+        cursor.close()
+
+
+def query_time_range(conn, topics, start_ns, end_ns, index=None):
+    """ Yields the BagMessage of the given topics (None for all) with
+    start_ns <= timestamp <= end_ns, merged across topics in timestamp order.
+    """
+    catalog = ROSDeserializer.get_catalog(conn)
+    names = catalog.names() if topics is None else [name for name in topics if name in catalog]
+    if index is None:
+        streams = [ROSDeserializer.iter_messages(conn, topics=[name], start_ns=start_ns, end_ns=end_ns)
+                   for name in names]
+    else:
+        conn = getattr(conn, 'connection', conn)
+        streams = []
+        for name in names:
+            topic_id = catalog.get(name).id
+            ranges = index.id_ranges(topic_id, start_ns, end_ns)
+            streams.append(_iter_topic_window(conn, topic_id, name, ranges, start_ns, end_ns))
+    return heapq.merge(*streams, key=lambda message: message.timestamp)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query a time window of a bag across topics.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--topics", type=str, default="", help="Comma-separated topic names (default: all).")
+    parser.add_argument("--start_s", type=float, default=0.0, help="Window start, in seconds from the start of the bag.")
+    parser.add_argument("--duration_s", type=float, default=1.0, help="Window length in seconds.")
+    parser.add_argument("--stride", type=int, default=1000, help="Messages per index checkpoint.")
+    parser.add_argument("--no_index", action="store_true", help="Query through timestamp_idx only.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    conn, c = ROSDeserializer.connect(args.bag)
+    topics = [t.strip() for t in args.topics.split(",") if t.strip()] or None
+
+    index = None
+    if not args.no_index:
+        start = time.perf_counter()
+        index = load_or_build_index(conn, args.bag, args.stride)
+        print(f"Index ready in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    c.execute('SELECT MIN(timestamp) FROM messages')
+    bag_start = c.fetchone()[0] or 0
+    start_ns = bag_start + int(args.start_s * 1e9)
+    end_ns = start_ns + int(args.duration_s * 1e9)
+
+    start = time.perf_counter()
+    counts = {}
+    for message in query_time_range(conn, topics, start_ns, end_ns, index):
+        counts[message.topic] = counts.get(message.topic, 0) + 1
+    elapsed = (time.perf_counter() - start) * 1000
+    for topic_name, count in counts.items():
+        print(f"{topic_name}: {count} messages")
+    print(f"{sum(counts.values())} messages in [{start_ns}, {end_ns}] in {elapsed:.1f} ms")
+    ROSDeserializer.close(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Fast inventory of bags: topics, types, counts, time bounds and rates.
+
+Nothing is deserialized and ROS is never imported. The answers come from
+metadata.yaml, which ros2 bag writes with the message count of every topic,
+the start time and the duration of the bag (parsed with libyaml when PyYAML
+has it). A split without metadata.yaml falls back to the storage itself:
+for SQLite the topics table, MIN/MAX(timestamp) (two lookups in
+timestamp_idx) and COUNT(*) (a walk of timestamp_idx, which is much smaller
+than the table); for MCAP the summary section. Per-topic counts of a .db3
+without metadata.yaml need a scan of the messages table, done only with
+count_topics=True (--count_topics).
+
+    python BagInspect.py /data/bags/*                  # one summary per bag
+    python BagInspect.py /data/bags/* --json > inventory.jsonl
+
+Rates are averages over the whole bag: message count / duration.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+
+# One topic of a bag; count and rate_hz are None when unknown
+TopicSummary = namedtuple('TopicSummary', ['name', 'type', 'count', 'rate_hz'])
+
+# source is 'metadata' or 'storage'; times are in ns since the epoch
+BagSummary = namedtuple('BagSummary', ['path', 'storage', 'source', 'start_ns', 'end_ns', 'duration_s',
+                                       'message_count', 'files', 'topics'])
+
+BAG_EXTENSIONS = ('.db3', '.mcap')
+
+
+def _load_yaml(path):
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, 'r') as file:
+        return yaml.load(file, Loader=loader)
+
+
+def _rate(count, start_ns, end_ns):
+    if count is None or start_ns is None or end_ns is None or end_ns <= start_ns:
+        return None
+    return count / ((end_ns - start_ns) / 1e9)
+
+
+def _summary(path, storage, source, start_ns, end_ns, message_count, files, topics):
+    """ Builds a BagSummary from (name, type, count) topics. """
+    duration_s = (end_ns - start_ns) / 1e9 if start_ns is not None and end_ns is not None else None
+    return BagSummary(path, storage, source, start_ns, end_ns, duration_s, message_count, files,
+                      [TopicSummary(name, msg_type, count, _rate(count, start_ns, end_ns))
+                       for name, msg_type, count in topics])
+
+
+def from_metadata(metadata_path):
+    """ Summary of a bag from its metadata.yaml alone. """
+    info = _load_yaml(metadata_path)['rosbag2_bagfile_information']
+    start_ns = info['starting_time']['nanoseconds_since_epoch']
+    end_ns = start_ns + info['duration']['nanoseconds']
+    message_count = info.get('message_count')
+    if not message_count:
+        start_ns = end_ns = None
+    topics = [(t['topic_metadata']['name'], t['topic_metadata']['type'], t.get('message_count'))
+              for t in info.get('topics_with_message_count') or []]
+    return _summary(os.path.dirname(os.path.abspath(metadata_path)), info.get('storage_identifier'), 'metadata',
+                    start_ns, end_ns, message_count, list(info.get('relative_file_paths') or []), topics)
+
+
+def from_storage(path, count_topics=False):
+    """ Summary of one split read from the file itself, see the module docstring. """
+    import BagStorage
+    with BagStorage.open_storage(path) as storage:
+        start_ns, end_ns = storage.time_bounds()
+        catalog = storage.catalog
+        if storage.storage_identifier == 'sqlite3':
+            cursor = storage.conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM messages')
+            message_count = cursor.fetchone()[0]
+            cursor.close()
+            counts = {info.name: catalog.count(info.name) if count_topics else info.count for info in catalog}
+        else:
+            counts = {info.name: info.count for info in catalog}
+            message_count = sum(count for count in counts.values() if count is not None)
+        topics = [(info.name, info.type, counts[info.name]) for info in catalog]
+        return _summary(os.path.abspath(path), storage.storage_identifier, 'storage', start_ns, end_ns,
+                        message_count, [os.path.basename(path)], topics)
+
+
+def merge(path, summaries):
+    """ Combines the summaries of the splits of one bag. """
+    starts = [summary.start_ns for summary in summaries if summary.start_ns is not None]
+    ends = [summary.end_ns for summary in summaries if summary.end_ns is not None]
+    topics = {}
+    for summary in summaries:
+        for topic in summary.topics:
+            name, msg_type, count = topics.get(topic.name, (topic.name, topic.type, 0))
+            topics[topic.name] = (name, msg_type, None if count is None or topic.count is None else count + topic.count)
+    counts = [summary.message_count for summary in summaries]
+    return _summary(path, summaries[0].storage if summaries else None, 'storage',
+                    min(starts) if starts else None, max(ends) if ends else None,
+                    None if None in counts else sum(counts),
+                    [name for summary in summaries for name in summary.files], list(topics.values()))
+
+
+def inspect(path, count_topics=False):
+    """ Returns the BagSummary of a bag directory, a metadata.yaml or a
+    single split (.db3 / .mcap). metadata.yaml is used whenever there is one.
+    """
+    if os.path.isdir(path):
+        metadata_path = os.path.join(path, 'metadata.yaml')
+        if os.path.exists(metadata_path):
+            return from_metadata(metadata_path)
+        splits = sorted(name for name in os.listdir(path) if name.lower().endswith(BAG_EXTENSIONS))
+        if not splits:
+            raise FileNotFoundError('No metadata.yaml or bag file in {}'.format(path))
+        return merge(os.path.abspath(path),
+                     [from_storage(os.path.join(path, name), count_topics) for name in splits])
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    if os.path.basename(path) == 'metadata.yaml':
+        return from_metadata(path)
+    return from_storage(path, count_topics)
+
+
+def to_dict(summary):
+    """ JSON-friendly dict of a BagSummary. """
+    result = summary._asdict()
+    result['topics'] = [topic._asdict() for topic in summary.topics]
+    return result
+
+
+def format_summary(summary):
+    lines = ['{} ({}, from {})'.format(summary.path, summary.storage, summary.source)]
+    if summary.start_ns is not None:
+        lines.append('  start {}  end {}  duration {:.3f} s'.format(summary.start_ns, summary.end_ns,
+                                                                    summary.duration_s))
+    lines.append('  messages {}  files {}'.format(summary.message_count, ', '.join(summary.files)))
+    width = max([len(topic.name) for topic in summary.topics] + [5])
+    for topic in summary.topics:
+        count = '?' if topic.count is None else topic.count
+        rate = '?' if topic.rate_hz is None else '{:.2f} Hz'.format(topic.rate_hz)
+        lines.append('  {:<{}} {:>10} {:>12}  {}'.format(topic.name, width, count, rate, topic.type))
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="List topics, types, counts, time bounds and rates of bags "
+                                                 "without decoding them.")
+    parser.add_argument("paths", nargs="+", help="Bag directories, metadata.yaml files or .db3/.mcap splits "
+                                                 "(glob patterns are expanded).")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per bag (JSON Lines).")
+    parser.add_argument("--count_topics", action="store_true",
+                        help="Count messages per topic in .db3 splits without metadata.yaml (scans the table).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    paths = [match for pattern in args.paths for match in (sorted(glob.glob(pattern)) or [pattern])]
+    failed = 0
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            summary = inspect(path, args.count_topics)
+        except Exception as e:
+            failed += 1
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        print(json.dumps(to_dict(summary)) if args.json else format_summary(summary))
+    seconds = time.perf_counter() - start
+    print(f"{len(paths) - failed} bags in {seconds:.3f} s ({seconds / max(len(paths), 1) * 1e3:.2f} ms per bag)",
+          file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Bag-level reader for split recordings.
+
+rosbag2 splits long recordings into several files (<name>_0.db3,
+<name>_1.db3, ...) listed under relative_file_paths in metadata.yaml.
+BagReader opens a bag through its metadata, reads the splits concurrently on
+a bounded thread pool and yields one stream of BagMessage in timestamp order,
+with the same iter_messages / catalog / time_bounds API as a single storage
+(see BagStorage.py).
+
+Every split is read by one worker into a bounded queue of batches, so memory
+stays bounded by workers * prefetch batches. Splits whose time range (from
+the 'files' section of metadata.yaml, or from the split itself for older
+metadata) lies outside the requested window are never opened.
+
+    python BagReader.py --bag path/to/bag_dir --start_s 10 --duration_s 5
+"""
+import argparse
+import heapq
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+
+import yaml
+
+import BagStorage
+import ROSDeserializer
+
+# One file of a bag; start_ns/end_ns are None for an empty split
+SplitInfo = namedtuple('SplitInfo', ['path', 'start_ns', 'end_ns', 'message_count'])
+
+
+class BagReader(BagStorage.Storage):
+    """ Reads all the splits of a bag as one time-ordered stream.
+    path is the bag directory or its metadata.yaml.
+    """
+
+    def __init__(self, path, workers=4, prefetch=4, storage_identifier=None):
+        self.metadata_path = os.path.join(path, 'metadata.yaml') if os.path.isdir(path) else path
+        self.directory = os.path.dirname(os.path.abspath(self.metadata_path))
+        self.workers = workers
+        self.prefetch = prefetch
+
+        with open(self.metadata_path, 'r') as file:
+            info = yaml.safe_load(file)['rosbag2_bagfile_information']
+        if info.get('compression_format'):
+            raise ValueError('Compressed bags ({}) are not supported, decompress them first '
+                             '(ros2 bag decompress)'.format(info['compression_format']))
+        self.storage_identifier = storage_identifier or info.get('storage_identifier')
+        self.catalog = ROSDeserializer.TopicCatalog(
+            ROSDeserializer.TopicInfo(topic_id, t['topic_metadata']['name'], t['topic_metadata']['type'],
+                                      t['topic_metadata'].get('serialization_format', 'cdr'),
+                                      t['topic_metadata'].get('offered_qos_profiles', ''), t.get('message_count'))
+            for topic_id, t in enumerate(info.get('topics_with_message_count') or [], 1))
+        self.splits = self._load_splits(info)
+
+    def _load_splits(self, info):
+        files = {entry['path']: entry for entry in info.get('files') or []}
+        splits = []
+        for relative_path in info.get('relative_file_paths') or []:
+            path = os.path.join(self.directory, relative_path)
+            entry = files.get(relative_path)
+            if entry is not None:
+                start_ns = entry['starting_time']['nanoseconds_since_epoch']
+                end_ns = start_ns + entry['duration']['nanoseconds']
+                count = entry.get('message_count')
+                if count == 0:
+                    start_ns = end_ns = None
+            else:
+                # Older metadata: ask the split itself (an index lookup or the MCAP summary)
+                with BagStorage.open_storage(path, self.storage_identifier) as storage:
+                    start_ns, end_ns = storage.time_bounds()
+                count = None
+            splits.append(SplitInfo(path, start_ns, end_ns, count))
+        return splits
+
+    def select_splits(self, start_ns=None, end_ns=None):
+        """ Returns the non-empty splits overlapping [start_ns, end_ns], by start time. """
+        selected = [split for split in self.splits
+                    if split.start_ns is not None
+                    and (end_ns is None or split.start_ns <= end_ns)
+                    and (start_ns is None or split.end_ns >= start_ns)]
+        return sorted(selected, key=attrgetter('start_ns'))
+
+    def time_bounds(self):
+        splits = self.select_splits()
+        if not splits:
+            return None, None
+        return splits[0].start_ns, max(split.end_ns for split in splits)
+
+    def close(self):
+        pass  # splits are opened and closed by iter_messages
+
+    def _read_split(self, split, output, stop, topics, start_ns, end_ns, batch_size):
+        """ Worker: reads one split into 'output' as lists of BagMessage,
+        then None (or the exception raised). Gives up when 'stop' is set.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            storage = BagStorage.open_storage(split.path, self.storage_identifier)
+            try:
+                batch = []
+                for message in storage.iter_messages(topics, start_ns, end_ns, batch_size):
+                    batch.append(message)
+                    if len(batch) >= batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch and not put(batch):
+                    return
+            finally:
+                storage.close()
+            put(None)
+        except Exception as e:
+            put(e)
+
+    @staticmethod
+    def _drain(output):
+        while True:
+            batch = output.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+
+    def iter_messages(self, topics=None, start_ns=None, end_ns=None, batch_size=1000):
+        """ Yields BagMessage of all splits in timestamp order. Splits with
+        overlapping time ranges are merged through a heap; consecutive
+        splits are simply chained.
+        """
+        splits = self.select_splits(start_ns, end_ns)
+        if len(splits) == 1:
+            with BagStorage.open_storage(splits[0].path, self.storage_identifier) as storage:
+                yield from storage.iter_messages(topics, start_ns, end_ns, batch_size)
+            return
+        if not splits:
+            return
+
+        groups = []  # runs of splits whose time ranges overlap
+        group_end = None
+        for split in splits:
+            if groups and split.start_ns <= group_end:
+                groups[-1].append(split)
+                group_end = max(group_end, split.end_ns)
+            else:
+                groups.append([split])
+                group_end = split.end_ns
+
+        stop = threading.Event()
+        # A whole group must be read at once, or the merge would wait forever
+        executor = ThreadPoolExecutor(max_workers=max(self.workers, max(len(group) for group in groups)))
+        try:
+            # Submitted in time order: the pool reads ahead of the consumer
+            outputs = []
+            for split in splits:
+                output = queue.Queue(self.prefetch)
+                executor.submit(self._read_split, split, output, stop, topics, start_ns, end_ns, batch_size)
+                outputs.append(output)
+            position = 0
+            for group in groups:
+                streams = [self._drain(output) for output in outputs[position:position + len(group)]]
+                position += len(group)
+                if len(streams) == 1:
+                    yield from streams[0]
+                else:
+                    yield from heapq.merge(*streams, key=attrgetter('timestamp'))
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Read all the splits of a bag as one time-ordered stream.")
+    parser.add_argument("--bag", type=str, default="metadata.yaml", help="Bag directory or its metadata.yaml.")
+    parser.add_argument("--topics", type=str, default="", help="Comma-separated topic names (default: all).")
+    parser.add_argument("--start_s", type=float, default=None, help="Window start, in seconds from the start of the bag.")
+    parser.add_argument("--duration_s", type=float, default=None, help="Window length in seconds.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of splits read concurrently.")
+    parser.add_argument("--prefetch", type=int, default=4, help="Batches buffered per split.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    topics = [t.strip() for t in args.topics.split(",") if t.strip()] or None
+    with BagReader(args.bag, args.workers, args.prefetch) as bag:
+        first_ns, _ = bag.time_bounds()
+        start_ns = end_ns = None
+        if args.start_s is not None and first_ns is not None:
+            start_ns = first_ns + int(args.start_s * 1e9)
+        if args.duration_s is not None and first_ns is not None:
+            end_ns = (start_ns if start_ns is not None else first_ns) + int(args.duration_s * 1e9)
+        print(f"{len(bag.splits)} splits, {len(bag.select_splits(start_ns, end_ns))} in the requested window")
+
+        start = time.perf_counter()
+        counts = {}
+        for message in bag.iter_messages(topics, start_ns, end_ns):
+            counts[message.topic] = counts.get(message.topic, 0) + 1
+        elapsed = time.perf_counter() - start
+        for topic_name, count in counts.items():
+            print(f"{topic_name}: {count} messages")
+        print(f"{sum(counts.values())} messages in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+"""Storage backends for rosbag2 recordings: SQLite (.db3) and MCAP (.mcap).
+
+open_storage(path) returns a reader with the same API for both formats:
+
+    storage.catalog                                  TopicCatalog of the bag
+    storage.iter_messages(topics, start_ns, end_ns)  BagMessage in timestamp order
+    storage.time_bounds()                            (first, last) timestamp in ns
+    storage.close()
+
+The MCAP reader is native (the mcap package is not needed). It reads the
+summary section at the end of the file (schemas, channels, chunk indexes and
+statistics) and, for a query, only seeks to the chunks whose time range
+overlaps the window and which hold one of the requested channels. Inside a
+chunk, the message indexes give the offsets of the requested messages, so
+nothing else is parsed, and chunks without a matching message are not even
+decompressed. Files without a summary are read with a sequential scan.
+zstd and lz4 chunks need the zstandard / lz4 packages.
+
+    python BagStorage.py --bag recording_0.mcap --topics /sensing/imu/imu_data
+"""
+import abc
+import argparse
+import heapq
+import os
+import struct
+import time
+from collections import namedtuple
+
+import yaml
+
+import CDRDecoder
+import ROSDeserializer
+
+MCAP_MAGIC = b'\x89MCAP0\r\n'
+
+# MCAP record opcodes
+OP_HEADER = 0x01
+OP_FOOTER = 0x02
+OP_SCHEMA = 0x03
+OP_CHANNEL = 0x04
+OP_MESSAGE = 0x05
+OP_CHUNK = 0x06
+OP_MESSAGE_INDEX = 0x07
+OP_CHUNK_INDEX = 0x08
+OP_STATISTICS = 0x0B
+OP_DATA_END = 0x0F
+
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_RECORD_HEADER = struct.Struct('<BQ')  # opcode, content length
+_FOOTER = struct.Struct('<QQI')  # summary_start, summary_offset_start, summary_crc
+_MESSAGE = struct.Struct('<HIQQ')  # channel_id, sequence, log_time, publish_time
+_CHUNK = struct.Struct('<QQQI')  # start_time, end_time, uncompressed_size, uncompressed_crc
+_CHUNK_INDEX = struct.Struct('<QQQQ')  # start_time, end_time, chunk_start_offset, chunk_length
+_STATISTICS = struct.Struct('<QHIIIIQQ')  # message/schema/channel/attachment/metadata/chunk counts, start, end
+_INDEX_ENTRY = struct.Struct('<QQ')  # log_time, offset in the uncompressed chunk
+_FOOTER_SIZE = _RECORD_HEADER.size + _FOOTER.size + len(MCAP_MAGIC)
+
+McapSchema = namedtuple('McapSchema', ['id', 'name', 'encoding', 'data'])
+McapChannel = namedtuple('McapChannel', ['id', 'schema_id', 'topic', 'message_encoding', 'metadata'])
+McapChunkIndex = namedtuple('McapChunkIndex', ['start_time', 'end_time', 'offset', 'length',
+                                               'message_index_offsets', 'message_index_length', 'compression'])
+McapStatistics = namedtuple('McapStatistics', ['message_count', 'start_time', 'end_time', 'channel_message_counts'])
+
+
+def _read_string(buf, pos):
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    return bytes(buf[pos:pos + size]).decode('utf-8'), pos + size
+
+
+def _read_bytes(buf, pos):
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    return bytes(buf[pos:pos + size]), pos + size
+
+
+def _read_string_map(buf, pos):
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    end = pos + size
+    result = {}
+    while pos < end:
+        key, pos = _read_string(buf, pos)
+        result[key], pos = _read_string(buf, pos)
+    return result, end
+
+
+def _read_id_map(buf, pos):
+    """ Reads a Map<uint16, uint64>. """
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    return {key: value for key, value in struct.iter_unpack('<HQ', buf[pos:pos + size])}, pos + size
+
+
+def _iter_records(buf, pos=0, end=None):
+    """ Yields (opcode, content start, content end) of the records in buf. """
+    end = len(buf) if end is None else end
+    while pos + _RECORD_HEADER.size <= end:
+        opcode, length = _RECORD_HEADER.unpack_from(buf, pos)
+        pos += _RECORD_HEADER.size
+        yield opcode, pos, pos + length
+        pos += length
+
+
+def _parse_schema(buf, pos):
+    schema_id = _U16.unpack_from(buf, pos)[0]
+    name, pos = _read_string(buf, pos + 2)
+    encoding, pos = _read_string(buf, pos)
+    data, _ = _read_bytes(buf, pos)
+    return McapSchema(schema_id, name, encoding, data)
+
+
+def _parse_channel(buf, pos):
+    channel_id, schema_id = struct.unpack_from('<HH', buf, pos)
+    topic, pos = _read_string(buf, pos + 4)
+    message_encoding, pos = _read_string(buf, pos)
+    metadata, _ = _read_string_map(buf, pos)
+    return McapChannel(channel_id, schema_id, topic, message_encoding, metadata)
+
+
+def _parse_chunk_index(buf, pos):
+    start_time, end_time, offset, length = _CHUNK_INDEX.unpack_from(buf, pos)
+    message_index_offsets, pos = _read_id_map(buf, pos + _CHUNK_INDEX.size)
+    message_index_length = _U64.unpack_from(buf, pos)[0]
+    compression, _ = _read_string(buf, pos + 8)
+    return McapChunkIndex(start_time, end_time, offset, length, message_index_offsets, message_index_length,
+                          compression)
+
+
+def _parse_statistics(buf, pos):
+    message_count, _, _, _, _, _, start_time, end_time = _STATISTICS.unpack_from(buf, pos)
+    channel_message_counts, _ = _read_id_map(buf, pos + _STATISTICS.size)
+    return McapStatistics(message_count, start_time, end_time, channel_message_counts)
+
+
+def _decompress(data, compression, size):
+    if compression == '':
+        return data
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is required to read zstd-compressed MCAP chunks (pip install zstandard)')
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('lz4 is required to read lz4-compressed MCAP chunks (pip install lz4)')
+        return lz4.frame.decompress(data)
+    raise ValueError('Unsupported MCAP chunk compression: {!r}'.format(compression))
+
+
+def _parse_chunk(buf, pos):
+    """ Returns the uncompressed records of the Chunk record whose content starts at pos. """
+    uncompressed_size = _CHUNK.unpack_from(buf, pos)[2]
+    compression, pos = _read_string(buf, pos + _CHUNK.size)
+    size = _U64.unpack_from(buf, pos)[0]
+    pos += 8
+    return _decompress(bytes(buf[pos:pos + size]), compression, uncompressed_size)
+
+
+class Storage(abc.ABC):
+    """ Common part of the storage readers. """
+
+    @abc.abstractmethod
+    def iter_messages(self, topics=None, start_ns=None, end_ns=None, batch_size=1000):
+        """ Yields BagMessage in timestamp order. """
+
+    @abc.abstractmethod
+    def time_bounds(self):
+        """ Returns the (first, last) timestamp in ns, or (None, None) for an empty bag. """
+
+    @abc.abstractmethod
+    def close(self):
+        """ Releases the file or connection. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SqliteStorage(Storage):
+    """ Reader of a rosbag2 SQLite (.db3) file, on top of ROSDeserializer. """
+
+    storage_identifier = 'sqlite3'
+
+    def __init__(self, path, metadata_path=None):
+        self.path = path
+        # Recorded bags do not change: read-only, memory-mapped, no locking
+        self.conn, _ = ROSDeserializer.connect(path, read_only=True)
+        self.catalog = ROSDeserializer.get_catalog(self.conn, metadata_path)
+
+    def iter_messages(self, topics=None, start_ns=None, end_ns=None, batch_size=1000):
+        """ Yields BagMessage in timestamp order, see ROSDeserializer.iter_messages. """
+        return ROSDeserializer.iter_messages(self.conn, topics, start_ns, end_ns, batch_size)
+
+    def time_bounds(self):
+        cursor = self.conn.cursor()
+        # Two subqueries: each is a single lookup in timestamp_idx
+        cursor.execute('SELECT (SELECT MIN(timestamp) FROM messages), (SELECT MAX(timestamp) FROM messages)')
+        bounds = cursor.fetchone()
+        cursor.close()
+        return bounds
+
+    def close(self):
+        ROSDeserializer.close(self.conn)
+
+
+class McapStorage(Storage):
+    """ Native reader of a rosbag2 MCAP file.
+    MCAP messages have no SQLite rowid: BagMessage.id is None and the
+    timestamp is the message's log_time.
+    """
+
+    storage_identifier = 'mcap'
+
+    def __init__(self, path, metadata_path=None):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.schemas = {}  # schema id -> McapSchema
+        self.channels = {}  # channel id -> McapChannel
+        self.chunk_indexes = []
+        self.statistics = None
+        if self._file.read(len(MCAP_MAGIC)) != MCAP_MAGIC:
+            self._file.close()
+            raise ValueError('{} is not an MCAP file'.format(path))
+        if not self._read_summary() or self.statistics is None:
+            self._scan_summary()
+
+        topics = []
+        for channel in self.channels.values():
+            schema = self.schemas.get(channel.schema_id)
+            topics.append(ROSDeserializer.TopicInfo(
+                channel.id, channel.topic, schema.name if schema else '', channel.message_encoding,
+                channel.metadata.get('offered_qos_profiles', ''),
+                self.statistics.channel_message_counts.get(channel.id, 0)))
+        self.catalog = ROSDeserializer.TopicCatalog(topics)
+        if metadata_path is not None:
+            self.catalog.merge_metadata(metadata_path)
+
+        # Definitions embedded in the file let CDRDecoder decode types it has no built-in for
+        for schema in self.schemas.values():
+            if schema.encoding == 'ros2msg' and schema.data:
+                CDRDecoder.default_registry.add_concatenated_definitions(
+                    schema.name, schema.data.decode('utf-8'), replace=False)
+
+    def _read_summary(self):
+        """ Loads schemas, channels, chunk indexes and statistics from the
+        summary section. Returns False when the file has no summary.
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MCAP_MAGIC) + _FOOTER_SIZE:
+            return False
+        self._file.seek(size - _FOOTER_SIZE)
+        tail = self._file.read(_FOOTER_SIZE)
+        opcode, _ = _RECORD_HEADER.unpack_from(tail)
+        if opcode != OP_FOOTER or tail[-len(MCAP_MAGIC):] != MCAP_MAGIC:
+            return False  # truncated recording
+        summary_start = _FOOTER.unpack_from(tail, _RECORD_HEADER.size)[0]
+        if summary_start == 0:
+            return False
+        self._file.seek(summary_start)
+        summary = self._file.read(size - _FOOTER_SIZE - summary_start)
+        for opcode, start, _ in _iter_records(summary):
+            if opcode == OP_SCHEMA:
+                schema = _parse_schema(summary, start)
+                self.schemas[schema.id] = schema
+            elif opcode == OP_CHANNEL:
+                channel = _parse_channel(summary, start)
+                self.channels[channel.id] = channel
+            elif opcode == OP_CHUNK_INDEX:
+                self.chunk_indexes.append(_parse_chunk_index(summary, start))
+            elif opcode == OP_STATISTICS:
+                self.statistics = _parse_statistics(summary, start)
+        self.chunk_indexes.sort(key=lambda chunk: chunk.start_time)
+        return True
+
+    def _iter_data_records(self):
+        """ Yields (opcode, buffer, content start, content end) of every record
+        of the data section in file order, descending into chunks.
+        """
+        self._file.seek(len(MCAP_MAGIC))
+        while True:
+            header = self._file.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            opcode, length = _RECORD_HEADER.unpack(header)
+            if opcode in (OP_DATA_END, OP_FOOTER):
+                return
+            content = self._file.read(length)
+            if len(content) < length:
+                return  # truncated recording
+            if opcode == OP_CHUNK:
+                records = _parse_chunk(content, 0)
+                for record in _iter_records(records):
+                    yield (record[0], records) + record[1:]
+            else:
+                yield opcode, content, 0, length
+
+    def _scan_summary(self):
+        """ Rebuilds schemas, channels and statistics with a sequential scan. """
+        counts = {}
+        start_time = end_time = None
+        for opcode, buf, start, end in self._iter_data_records():
+            if opcode == OP_MESSAGE:
+                channel_id, _, log_time, _ = _MESSAGE.unpack_from(buf, start)
+                counts[channel_id] = counts.get(channel_id, 0) + 1
+                start_time = log_time if start_time is None else min(start_time, log_time)
+                end_time = log_time if end_time is None else max(end_time, log_time)
+            elif opcode == OP_SCHEMA:
+                schema = _parse_schema(buf, start)
+                self.schemas[schema.id] = schema
+            elif opcode == OP_CHANNEL:
+                channel = _parse_channel(buf, start)
+                self.channels[channel.id] = channel
+        self.statistics = McapStatistics(sum(counts.values()), start_time or 0, end_time or 0, counts)
+
+    def _channel_ids(self, topics):
+        if topics is None:
+            return None
+        topics = set(topics)
+        return {channel.id for channel in self.channels.values() if channel.topic in topics}
+
+    def _read_chunk(self, chunk, channel_ids, start_ns, end_ns):
+        """ Returns the BagMessage of one chunk matching the filters, in
+        (timestamp, position) order.
+        """
+        topics = {channel.id: channel.topic for channel in self.channels.values()}
+        wanted = chunk.message_index_offsets.keys() if channel_ids is None \
+            else channel_ids & chunk.message_index_offsets.keys()
+        entries = []  # (log_time, offset, channel id)
+        if chunk.message_index_offsets:
+            index_start = chunk.offset + chunk.length
+            self._file.seek(index_start)
+            indexes = self._file.read(chunk.message_index_length)
+            for channel_id in wanted:
+                pos = chunk.message_index_offsets[channel_id] - index_start + _RECORD_HEADER.size + 2
+                size = _U32.unpack_from(indexes, pos)[0]
+                for log_time, offset in _INDEX_ENTRY.iter_unpack(indexes[pos + 4:pos + 4 + size]):
+                    if (start_ns is None or log_time >= start_ns) and (end_ns is None or log_time <= end_ns):
+                        entries.append((log_time, offset, channel_id))
+            if not entries:
+                return []  # nothing to decompress
+        self._file.seek(chunk.offset)
+        records = _parse_chunk(self._file.read(chunk.length), _RECORD_HEADER.size)
+
+        messages = []
+        if chunk.message_index_offsets:
+            entries.sort()
+            for log_time, offset, channel_id in entries:
+                length = _RECORD_HEADER.unpack_from(records, offset)[1]
+                start = offset + _RECORD_HEADER.size
+                messages.append(ROSDeserializer.BagMessage(
+                    None, topics[channel_id], log_time, records[start + _MESSAGE.size:start + length]))
+            return messages
+        # Chunk written without message indexes: parse all of its records
+        for opcode, start, end in _iter_records(records):
+            if opcode != OP_MESSAGE:
+                continue
+            channel_id, _, log_time, _ = _MESSAGE.unpack_from(records, start)
+            if (channel_ids is None or channel_id in channel_ids) and \
+                    (start_ns is None or log_time >= start_ns) and (end_ns is None or log_time <= end_ns):
+                messages.append(ROSDeserializer.BagMessage(None, topics[channel_id], log_time,
+                                                           records[start + _MESSAGE.size:end]))
+        messages.sort(key=lambda message: message.timestamp)
+        return messages
+
+    def iter_messages(self, topics=None, start_ns=None, end_ns=None, batch_size=None):
+        """ Yields BagMessage(None, topic, timestamp, data) in timestamp order.
+        Only the chunks overlapping [start_ns, end_ns] that contain one of the
+        topics are read; chunks with overlapping time ranges are merged
+        through a heap. batch_size is accepted for API compatibility.
+        """
+        channel_ids = self._channel_ids(topics)
+        if channel_ids is not None and not channel_ids:
+            return
+        if not self.chunk_indexes:
+            yield from self._scan_messages(channel_ids, start_ns, end_ns)
+            return
+
+        chunks = [chunk for chunk in self.chunk_indexes
+                  if (start_ns is None or chunk.end_time >= start_ns)
+                  and (end_ns is None or chunk.start_time <= end_ns)
+                  and (channel_ids is None or not chunk.message_index_offsets
+                       or not channel_ids.isdisjoint(chunk.message_index_offsets))]
+        pending = []  # heap of (timestamp, sequence, message)
+        sequence = 0
+        for chunk in chunks:
+            # Later chunks start at or after chunk.start_time, so anything earlier is final
+            while pending and pending[0][0] < chunk.start_time:
+                yield heapq.heappop(pending)[2]
+            for message in self._read_chunk(chunk, channel_ids, start_ns, end_ns):
+                heapq.heappush(pending, (message.timestamp, sequence, message))
+                sequence += 1
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+    def _scan_messages(self, channel_ids, start_ns, end_ns):
+        """ Fallback for files without chunk indexes. Messages may be recorded
+        out of log_time order and nothing bounds the times of what is left to
+        read, so the matching messages are gathered and sorted (file order for
+        equal times) before the first one is yielded.
+        """
+        topics = {channel.id: channel.topic for channel in self.channels.values()}
+        messages = []
+        for opcode, buf, start, end in self._iter_data_records():
+            if opcode != OP_MESSAGE:
+                continue
+            channel_id, _, log_time, _ = _MESSAGE.unpack_from(buf, start)
+            if (channel_ids is None or channel_id in channel_ids) and \
+                    (start_ns is None or log_time >= start_ns) and (end_ns is None or log_time <= end_ns):
+                messages.append(ROSDeserializer.BagMessage(None, topics[channel_id], log_time,
+                                                           bytes(buf[start + _MESSAGE.size:end])))
+        messages.sort(key=lambda message: message.timestamp)
+        yield from messages
+
+    def time_bounds(self):
+        if not self.statistics.message_count:
+            return None, None
+        return self.statistics.start_time, self.statistics.end_time
+
+    def close(self):
+        self._file.close()
+
+
+STORAGES = {SqliteStorage.storage_identifier: SqliteStorage, McapStorage.storage_identifier: McapStorage}
+
+
+def read_storage_identifier(metadata_path):
+    """ Returns the storage_identifier of metadata.yaml ('sqlite3', 'mcap'), or None. """
+    with open(metadata_path, 'r') as file:
+        metadata = yaml.safe_load(file)
+    return metadata['rosbag2_bagfile_information'].get('storage_identifier')
+
+
+def detect_storage(path):
+    """ Guesses the storage of a bag file from its extension, then its first bytes. """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.mcap':
+        return 'mcap'
+    if extension == '.db3':
+        return 'sqlite3'
+    with open(path, 'rb') as file:
+        head = file.read(16)
+    if head.startswith(MCAP_MAGIC):
+        return 'mcap'
+    if head.startswith(b'SQLite format 3'):
+        return 'sqlite3'
+    raise ValueError('Unknown bag storage format: {}'.format(path))
+
+
+def open_storage(path, storage_identifier=None, metadata_path=None):
+    """ Opens a bag file with the matching reader. The storage is taken from
+    storage_identifier, else from metadata.yaml when given, else guessed
+    from the file itself.
+    """
+    if storage_identifier is None and metadata_path is not None:
+        storage_identifier = read_storage_identifier(metadata_path)
+    if storage_identifier is None:
+        storage_identifier = detect_storage(path)
+    if storage_identifier not in STORAGES:
+        raise ValueError('Unsupported storage_identifier: {}'.format(storage_identifier))
+    return STORAGES[storage_identifier](path, metadata_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Read a .db3 or .mcap bag through the common storage API.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 or .mcap bag file.")
+    parser.add_argument("--storage", type=str, default=None, choices=sorted(STORAGES),
+                        help="Storage format (default: guessed from the file).")
+    parser.add_argument("--topics", type=str, default="", help="Comma-separated topic names (default: all).")
+    parser.add_argument("--start_s", type=float, default=None, help="Window start, in seconds from the start of the bag.")
+    parser.add_argument("--duration_s", type=float, default=None, help="Window length in seconds.")
+    parser.add_argument("--decode", action="store_true", help="Also deserialize the messages read.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    topics = [t.strip() for t in args.topics.split(",") if t.strip()] or None
+    with open_storage(args.bag, args.storage) as storage:
+        print(f"{args.bag}: {storage.storage_identifier}, {len(storage.catalog)} topics")
+        for info in storage.catalog:
+            print(f"  {info.name} ({info.type}): {storage.catalog.count(info.name)} messages")
+
+        first_ns, _ = storage.time_bounds()
+        start_ns = end_ns = None
+        if args.start_s is not None and first_ns is not None:
+            start_ns = first_ns + int(args.start_s * 1e9)
+        if args.duration_s is not None and first_ns is not None:
+            end_ns = (start_ns if start_ns is not None else first_ns) + int(args.duration_s * 1e9)
+
+        start = time.perf_counter()
+        count = 0
+        for message in storage.iter_messages(topics, start_ns, end_ns):
+            if args.decode:
+                storage.catalog.topic_deserializer(message.topic)(message.data)
+            count += 1
+        elapsed = time.perf_counter() - start
+        print(f"Read {count} messages in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Writes rosbag2 SQLite bags: .db3 splits and their metadata.yaml.
+
+SqliteBagWriter creates a split with the same schema as ros2 bag record
+(topics, messages, timestamp_idx) and loads it the fast way: rows are
+inserted with executemany in large transactions, with journaling off (a
+half-written split is useless anyway), and the timestamp index is built
+once at the end instead of being updated for every row. copy_from()
+appends the messages of another .db3 in a single INSERT ... SELECT run by
+SQLite, so copied blobs never pass through Python.
+
+    writer = SqliteBagWriter('bag/bag_0.db3')
+    topic_id = writer.add_topic('/sensing/imu/tamagawa/imu_raw', 'sensor_msgs/msg/Imu')
+    writer.write((topic_id, timestamp, blob) for timestamp, blob in messages)
+    writer.close()
+    write_metadata('bag', [writer])
+
+The result is readable by BagReader, BagStorage and ros2 bag.
+"""
+import os
+from itertools import islice
+
+import yaml
+
+import BagConnection
+
+SCHEMA = """
+CREATE TABLE topics(id INTEGER PRIMARY KEY,name TEXT NOT NULL,type TEXT NOT NULL,serialization_format TEXT NOT NULL,offered_qos_profiles TEXT NOT NULL);
+CREATE TABLE messages(id INTEGER PRIMARY KEY,topic_id INTEGER NOT NULL,timestamp INTEGER NOT NULL, data BLOB NOT NULL);
+"""
+INDEX = "CREATE INDEX timestamp_idx ON messages (timestamp ASC);"
+
+METADATA_VERSION = 5
+
+
+class SqliteBagWriter:
+    """ Writes one .db3 split. Topics keep the order in which they are added. """
+
+    def __init__(self, path, transaction_rows=100000, overwrite=False):
+        import sqlite3
+        if os.path.exists(path):
+            if not overwrite:
+                raise FileExistsError(path)
+            os.remove(path)
+        self.path = path
+        self.transaction_rows = transaction_rows
+        self.topics = {}  # name -> {'id', 'type', 'serialization_format', 'offered_qos_profiles', 'message_count'}
+        self._names = {}  # topic id -> name
+        self.message_count = 0
+        self.start_ns = None
+        self.end_ns = None
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.executescript(SCHEMA)
+
+    def add_topic(self, name, msg_type, serialization_format='cdr', offered_qos_profiles=''):
+        """ Registers a topic and returns its id. """
+        if name in self.topics:
+            return self.topics[name]['id']
+        topic_id = len(self.topics) + 1
+        self.conn.execute('INSERT INTO topics (id, name, type, serialization_format, offered_qos_profiles) '
+                          'VALUES (?, ?, ?, ?, ?)', (topic_id, name, msg_type, serialization_format,
+                                                      offered_qos_profiles or ''))
+        self.topics[name] = {'id': topic_id, 'type': msg_type, 'serialization_format': serialization_format,
+                             'offered_qos_profiles': offered_qos_profiles or '', 'message_count': 0}
+        self._names[topic_id] = name
+        return topic_id
+
+    def write(self, rows):
+        """ Appends (topic_id, timestamp, data) rows, committing every transaction_rows rows. """
+        rows = iter(rows)
+        counts = {}
+        while True:
+            chunk = list(islice(rows, self.transaction_rows))
+            if not chunk:
+                break
+            with self.conn:
+                self.conn.executemany('INSERT INTO messages (topic_id, timestamp, data) VALUES (?, ?, ?)', chunk)
+            for topic_id, _, _ in chunk:
+                counts[topic_id] = counts.get(topic_id, 0) + 1
+            first = min(row[1] for row in chunk)
+            last = max(row[1] for row in chunk)
+            self.start_ns = first if self.start_ns is None else min(self.start_ns, first)
+            self.end_ns = last if self.end_ns is None else max(self.end_ns, last)
+            self.message_count += len(chunk)
+        for topic_id, count in counts.items():
+            self.topics[self._names[topic_id]]['message_count'] += count
+
+    def copy_from(self, path, topic_ids, start_ns=None, end_ns=None):
+        """ Appends the messages of another .db3 split, attached read-only.
+        topic_ids maps the topic ids of path to ids returned by add_topic;
+        other topics are skipped. start_ns/end_ns bound the timestamps
+        (inclusive). Returns the number of messages copied.
+        """
+        if not topic_ids:
+            return 0
+        if all(source == target for source, target in topic_ids.items()):
+            topic_column = 'topic_id'
+        else:
+            topic_column = 'CASE topic_id {} END'.format(
+                ' '.join('WHEN {:d} THEN {:d}'.format(source, target) for source, target in topic_ids.items()))
+        conditions = ['topic_id IN ({})'.format(', '.join('{:d}'.format(source) for source in topic_ids))]
+        params = []
+        if start_ns is not None:
+            conditions.append('timestamp >= ?')
+            params.append(start_ns)
+        if end_ns is not None:
+            conditions.append('timestamp <= ?')
+            params.append(end_ns)
+        last_id = self.conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+
+        self.conn.commit()  # ATTACH is not allowed inside the transaction left open by add_topic
+        self.conn.execute('ATTACH DATABASE ? AS source', (BagConnection.readonly_uri(path),))
+        try:
+            self.conn.execute('PRAGMA source.mmap_size = {:d}'.format(BagConnection.MMAP_SIZE))
+            with self.conn:
+                # No ORDER BY: one sequential pass over the source (readers sort through timestamp_idx)
+                self.conn.execute('INSERT INTO main.messages (topic_id, timestamp, data) SELECT {}, timestamp, data '
+                                  'FROM source.messages WHERE {}'.format(topic_column, ' AND '.join(conditions)),
+                                  params)
+        finally:
+            self.conn.execute('DETACH DATABASE source')
+
+        copied = 0
+        for topic_id, count, first, last in self.conn.execute(
+                'SELECT topic_id, COUNT(*), MIN(timestamp), MAX(timestamp) FROM messages WHERE id > ? '
+                'GROUP BY topic_id', (last_id,)):
+            self.topics[self._names[topic_id]]['message_count'] += count
+            self.start_ns = first if self.start_ns is None else min(self.start_ns, first)
+            self.end_ns = last if self.end_ns is None else max(self.end_ns, last)
+            copied += count
+        self.message_count += copied
+        return copied
+
+    def close(self):
+        """ Builds the timestamp index and closes the split. """
+        if self.conn is None:
+            return
+        self.conn.execute(INDEX)
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+    def file_info(self):
+        """ Returns the 'files' entry of this split for metadata.yaml. """
+        start_ns = self.start_ns or 0
+        return {
+            'path': os.path.basename(self.path),
+            'starting_time': {'nanoseconds_since_epoch': start_ns},
+            'duration': {'nanoseconds': (self.end_ns or start_ns) - start_ns},
+            'message_count': self.message_count,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_metadata(directory, writers, storage_identifier='sqlite3'):
+    """ Writes directory/metadata.yaml describing the closed splits of writers.
+    Returns its path.
+    """
+    topics = {}
+    for writer in writers:
+        for name, topic in writer.topics.items():
+            entry = topics.setdefault(name, dict(topic, message_count=0))
+            entry['message_count'] += topic['message_count']
+    files = [writer.file_info() for writer in writers]
+    starts = [writer.start_ns for writer in writers if writer.start_ns is not None]
+    ends = [writer.end_ns for writer in writers if writer.end_ns is not None]
+    start_ns = min(starts) if starts else 0
+    info = {
+        'version': METADATA_VERSION,
+        'storage_identifier': storage_identifier,
+        'duration': {'nanoseconds': (max(ends) - start_ns) if ends else 0},
+        'starting_time': {'nanoseconds_since_epoch': start_ns},
+        'message_count': sum(writer.message_count for writer in writers),
+        'topics_with_message_count': [
+            {'topic_metadata': {'name': name, 'type': topic['type'],
+                                'serialization_format': topic['serialization_format'],
+                                'offered_qos_profiles': topic['offered_qos_profiles']},
+             'message_count': topic['message_count']}
+            for name, topic in topics.items()],
+        'compression_format': '',
+        'compression_mode': '',
+        'relative_file_paths': [entry['path'] for entry in files],
+        'files': files,
+    }
+    path = os.path.join(directory, 'metadata.yaml')
+    with open(path, 'w') as file:
+        yaml.safe_dump({'rosbag2_bagfile_information': info}, file, sort_keys=False)
+    return path
@@ -0,0 +1,352 @@
+"""End-to-end benchmarks of the bag and Excel pipelines.
+
+Runs timed scenarios against a bag and a sensor workbook, each in a fresh
+process so that its peak memory is its own, and reports rows/s, MB/s and
+peak RSS per scenario as a table and as JSON:
+
+    catalog          open every split and build its topic catalog
+    scan             read every message of the bag in timestamp order (BagReader)
+    decode_<backend> decode every message (cdr, and rclpy when installed); reads are not timed
+    export_csv       CSV export of all topics (IncrementalExport)
+    export_columnar  one .npz file per topic and split (ColumnarExport)
+    excel_cold       parse the workbook without its sidecar cache (ExcelToMQTT)
+    excel_warm       load the workbook from its sidecar cache
+    publish          publish every blob of the bag to an MQTT broker (skipped if unreachable)
+
+Without --bag / --excel, a synthetic bag and workbook are generated first
+(see SyntheticData.py). Compare a run with an earlier one with --baseline:
+
+    python BenchmarkSuite.py --size_gb 0.5 --splits 4 --output bench.json
+    python BenchmarkSuite.py --bag /tmp/synthetic_bag --excel ../Data/sensor_data_buildings.xlsx \\
+        --broker localhost:1883 --baseline bench.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts')
+
+SCENARIOS = ('catalog', 'scan', 'decode_cdr', 'decode_rclpy', 'export_csv', 'export_columnar',
+             'excel_cold', 'excel_warm', 'publish')
+
+
+class Skipped(Exception):
+    """ A scenario that cannot run here (missing backend, no broker). """
+
+
+def bag_files(bag):
+    """ Returns the .db3 splits of a bag directory, metadata.yaml or single file. """
+    if bag.endswith('.db3'):
+        return [bag]
+    import BagReader
+    return [split.path for split in BagReader.BagReader(bag).splits]
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(name) for name in glob.glob(os.path.join(path, '**'), recursive=True)
+               if os.path.isfile(name))
+
+
+# Every scenario returns (rows, bytes, seconds); seconds is None when the
+# whole call is timed by run_scenario
+
+def scenario_catalog(options):
+    import ROSDeserializer
+    rows = 0
+    for path in bag_files(options['bag']):
+        conn, _ = ROSDeserializer.connect(path)
+        catalog = ROSDeserializer.get_catalog(conn)
+        rows += sum(catalog.count(name) for name in catalog.names())
+        ROSDeserializer.close(conn)
+    return rows, 0, None
+
+
+def scenario_scan(options):
+    import BagReader
+    import BagStorage
+    bag = options['bag']
+    storage = BagStorage.open_storage(bag) if bag.endswith('.db3') else BagReader.BagReader(bag)
+    rows = size = 0
+    with storage:
+        for message in storage.iter_messages():
+            rows += 1
+            size += len(message.data)
+    return rows, size, None
+
+
+def _scenario_decode(options, backend):
+    import ROSDeserializer
+    if backend == 'rclpy' and not ROSDeserializer.ros_available():
+        raise Skipped('rclpy is not installed')
+    rows = size = 0
+    seconds = 0.0
+    for path in bag_files(options['bag']):
+        conn, _ = ROSDeserializer.connect(path)
+        catalog = ROSDeserializer.get_catalog(conn)
+        for topic_name in catalog.names():
+            deserialize = catalog.topic_deserializer(topic_name, backend)
+            cursor = conn.execute('SELECT data FROM messages WHERE topic_id = ?', (catalog.get(topic_name).id,))
+            while True:
+                blobs = [row[0] for row in cursor.fetchmany(10000)]
+                if not blobs:
+                    break
+                start = time.perf_counter()
+                for blob in blobs:
+                    deserialize(blob)
+                seconds += time.perf_counter() - start
+                rows += len(blobs)
+                size += sum(map(len, blobs))
+        ROSDeserializer.close(conn)
+    return rows, size, seconds
+
+
+def scenario_decode_cdr(options):
+    return _scenario_decode(options, 'cdr')
+
+
+def scenario_decode_rclpy(options):
+    return _scenario_decode(options, 'rclpy')
+
+
+def scenario_export_csv(options):
+    import IncrementalExport
+    with tempfile.TemporaryDirectory() as out_dir:
+        csv_path = os.path.join(out_dir, 'details.csv')
+        rows = IncrementalExport.export_incremental(bag_files(options['bag']), csv_path, backend='cdr',
+                                                    checkpoint_every=10 ** 9)
+        return rows, os.path.getsize(csv_path), None
+
+
+def scenario_export_columnar(options):
+    import ColumnarExport
+    import ROSDeserializer
+    rows = 0
+    with tempfile.TemporaryDirectory() as out_dir:
+        for index, path in enumerate(bag_files(options['bag'])):
+            conn, _ = ROSDeserializer.connect(path)
+            written = ColumnarExport.export_columnar(conn, os.path.join(out_dir, str(index)), fmt='npz',
+                                                     backend='cdr')
+            ROSDeserializer.close(conn)
+            rows += sum(count for _, count in written.values())
+        return rows, _directory_size(out_dir), None
+
+
+def _scenario_excel(options, warm):
+    sys.path.insert(0, SCRIPTS_DIR)
+    import ExcelToMQTT
+    excel = options['excel_copy']
+    if not warm and os.path.exists(ExcelToMQTT.sidecar_path(excel)):
+        os.remove(ExcelToMQTT.sidecar_path(excel))
+    start = time.perf_counter()
+    sensor_data = ExcelToMQTT.read_sensor_data(excel, ExcelToMQTT.get_excel_sheets(excel))
+    seconds = time.perf_counter() - start
+    return sum(len(series.timestamps) for series in sensor_data.values()), os.path.getsize(excel), seconds
+
+
+def scenario_excel_cold(options):
+    return _scenario_excel(options, warm=False)
+
+
+def scenario_excel_warm(options):
+    return _scenario_excel(options, warm=True)
+
+
+def scenario_publish(options):
+    sys.path.insert(0, SCRIPTS_DIR)
+    import paho.mqtt.client as mqtt
+    from MQTTPublisher import MQTTPublisher, wait_for_connection
+    import BagReader
+    import BagStorage
+    host, _, port = options['broker'].partition(':')
+    client = mqtt.Client(protocol=mqtt.MQTTv311)
+    try:
+        client.connect(host, int(port or 1883))
+    except OSError as e:
+        raise Skipped(f"broker {options['broker']} unreachable ({e})")
+    client.loop_start()
+    try:
+        if not wait_for_connection(client):
+            raise Skipped(f"could not connect to {options['broker']}")
+        publisher = MQTTPublisher(client, qos=options['qos'], max_inflight=options['max_inflight'], log_interval=0)
+        bag = options['bag']
+        storage = BagStorage.open_storage(bag) if bag.endswith('.db3') else BagReader.BagReader(bag)
+        start = time.perf_counter()
+        with storage:
+            for message in storage.iter_messages():
+                publisher.publish('benchmark' + message.topic, message.data)
+        publisher.flush(timeout=60)
+        seconds = time.perf_counter() - start
+        return publisher.acknowledged, publisher.bytes, seconds
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+def _peak_rss_mb():
+    # VmHWM starts over in a new process; ru_maxrss is kept across exec on
+    # Linux and would include the parent's peak
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KiB elsewhere
+
+
+def _run_in_child(name, options):
+    """ Child process: runs one scenario, silenced. Returns its measurements. """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        try:
+            rows, size, seconds = globals()['scenario_' + name](options)
+        except Skipped as e:
+            return {'skipped': str(e)}
+        elapsed = time.perf_counter() - start
+    return {'rows': rows, 'bytes': size, 'seconds': seconds if seconds is not None else elapsed,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def run_scenario(name, options, repeat=1):
+    """ Runs a scenario 'repeat' times, each in a new process, and returns
+    the result of the fastest run with its rates.
+    """
+    best = None
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(_run_in_child, name, options).result()
+        if 'skipped' in result:
+            return dict(scenario=name, **result)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    seconds = best['seconds']
+    best['rows_per_s'] = best['rows'] / seconds if seconds > 0 else None
+    best['mb_per_s'] = best['bytes'] / 1e6 / seconds if seconds > 0 else None
+    return dict(scenario=name, **best)
+
+
+def broker_reachable(broker, timeout=1.0):
+    host, _, port = broker.partition(':')
+    try:
+        socket.create_connection((host, int(port or 1883)), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def format_table(results, baseline=None):
+    previous = {result['scenario']: result for result in (baseline or {}).get('results', [])}
+    lines = [f"{'scenario':<16} {'rows':>10} {'seconds':>8} {'rows/s':>11} {'MB/s':>8} {'peak MB':>8}"
+             + (f" {'vs base':>8}" if previous else '')]
+    for result in results:
+        if 'skipped' in result:
+            lines.append(f"{result['scenario']:<16} skipped: {result['skipped']}")
+            continue
+        line = (f"{result['scenario']:<16} {result['rows']:>10} {result['seconds']:>8.3f} "
+                f"{result['rows_per_s'] or 0:>11.0f} {result['mb_per_s'] or 0:>8.1f} {result['peak_rss_mb']:>8.1f}")
+        old = previous.get(result['scenario'])
+        if old and old.get('seconds') and result['seconds'] > 0:
+            line += f" {old['seconds'] / result['seconds']:>7.2f}x"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run end-to-end benchmarks on a bag and a sensor workbook.")
+    parser.add_argument("--bag", type=str, default="",
+                        help="Bag directory, metadata.yaml or .db3 file. Default: generate a synthetic bag.")
+    parser.add_argument("--excel", type=str, default="",
+                        help="Sensor workbook. Default: generate a synthetic workbook.")
+    parser.add_argument("--size_gb", type=float, default=0.1, help="Payload size of the synthetic bag.")
+    parser.add_argument("--splits", type=int, default=2, help="Number of splits of the synthetic bag.")
+    parser.add_argument("--rows", type=int, default=5000, help="Rows per sheet of the synthetic workbook.")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS),
+                        help="Comma-separated scenarios to run: " + ", ".join(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario (the fastest is reported).")
+    parser.add_argument("--broker", type=str, default="localhost:1883", help="MQTT broker host:port for 'publish'.")
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1, 2], help="QoS of the 'publish' scenario.")
+    parser.add_argument("--max_inflight", type=int, default=1000, help="In-flight window of the 'publish' scenario.")
+    parser.add_argument("--output", type=str, default="", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, default="", help="Earlier JSON results to compare with.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated bag and workbook.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}")
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='rosbag-bench-')
+    try:
+        bag, excel = args.bag, args.excel
+        if not bag or not excel:
+            import SyntheticData
+            if not bag:
+                bag = os.path.join(work_dir, 'synthetic_bag')
+                SyntheticData.generate_bag(bag, size_gb=args.size_gb, splits=args.splits)
+            if not excel:
+                excel = os.path.join(work_dir, 'synthetic_sensors.xlsx')
+                SyntheticData.generate_workbook(excel, rows=args.rows)
+        # The Excel scenarios write a sidecar cache: work on a copy
+        excel_copy = os.path.join(work_dir, 'bench_' + os.path.basename(excel))
+        shutil.copyfile(excel, excel_copy)
+        options = {'bag': bag, 'excel_copy': excel_copy, 'broker': args.broker, 'qos': args.qos,
+                   'max_inflight': args.max_inflight}
+        if 'publish' in scenarios and not broker_reachable(args.broker):
+            print(f"No broker at {args.broker}, skipping 'publish'")
+            scenarios.remove('publish')
+
+        results = []
+        print(format_table([]))
+        for name in scenarios:
+            result = run_scenario(name, options, args.repeat)
+            results.append(result)
+            print(format_table([result]).splitlines()[1])
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'bag': args.bag or 'synthetic:{}GB/{} splits'.format(args.size_gb, args.splits),
+            'bag_bytes': sum(os.path.getsize(path) for path in bag_files(bag)),
+            'excel': args.excel or 'synthetic:{} rows/sheet'.format(args.rows),
+            'results': results,
+        }
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        if baseline is not None:
+            print()
+            print(format_table(results, baseline))
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+            print(f"Results written to {args.output}")
+    finally:
+        if args.keep:
+            print(f"Generated files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
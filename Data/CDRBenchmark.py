@@ -0,0 +1,68 @@
+"""Throughput comparison between the pure-Python CDR decoder and rclpy.
+
+Decodes every message of every topic listed in metadata.yaml with each
+available backend and prints messages/sec per topic. The rclpy column is
+only filled in when ROS is installed (e.g. inside the Docker image).
+
+    python CDRBenchmark.py --bag sample-rosbag_0.db3 --metadata metadata.yaml
+"""
+import argparse
+import time
+
+import ROSDeserializer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare CDR decoding throughput of the available backends.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--metadata", type=str, default="metadata.yaml", help="Path to metadata.yaml.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of passes over each topic (best pass is reported).")
+    return parser.parse_args()
+
+
+def time_backend(deserialize, blobs, repeat):
+    """ Returns the best messages/sec over 'repeat' passes. """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for blob in blobs:
+            deserialize(blob)
+        best = min(best, time.perf_counter() - start)
+    return len(blobs) / best if best > 0 else float('inf')
+
+
+def main():
+    args = parse_args()
+    backends = ['cdr']
+    if ROSDeserializer.ros_available():
+        backends.append('rclpy')
+
+    type_map = ROSDeserializer.parse_metadata_topics(args.metadata)
+    conn, c = ROSDeserializer.connect(args.bag)
+
+    print(f"{'topic':45} {'msgs':>6} " + ' '.join(f"{b + ' msg/s':>12}" for b in backends) + f" {'speedup':>8}")
+    totals = {backend: 0.0 for backend in backends}
+    total_count = 0
+    for topic_name, msg_type in type_map.items():
+        c.execute("SELECT data FROM messages WHERE topic_id = (SELECT id FROM topics WHERE name = ?)", (topic_name,))
+        blobs = [row[0] for row in c.fetchall()]
+        if not blobs:
+            continue
+        rates = {}
+        for backend in backends:
+            rates[backend] = time_backend(ROSDeserializer.get_deserializer(msg_type, backend), blobs, args.repeat)
+            totals[backend] += len(blobs) / rates[backend]
+        total_count += len(blobs)
+        speedup = f"{rates['cdr'] / rates['rclpy']:8.1f}x" if 'rclpy' in rates else f"{'-':>8}"
+        print(f"{topic_name:45} {len(blobs):6d} " + ' '.join(f"{rates[b]:12.0f}" for b in backends) + f" {speedup}")
+
+    if total_count:
+        overall = {backend: total_count / seconds for backend, seconds in totals.items()}
+        speedup = f"{overall['cdr'] / overall['rclpy']:8.1f}x" if 'rclpy' in overall else f"{'-':>8}"
+        print(f"{'all topics':45} {total_count:6d} " + ' '.join(f"{overall[b]:12.0f}" for b in backends) + f" {speedup}")
+
+    ROSDeserializer.close(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+"""Pure-Python CDR decoder for ROS 2 messages.
+
+Parses ``.msg`` definitions and compiles a specialised, ``struct``-based
+decode function for every message type, so bag files can be deserialized
+on machines without a ROS installation (no rclpy / rosidl_runtime_py).
+
+Typical use::
+
+    from CDRDecoder import get_decoder
+
+    decode = get_decoder('geometry_msgs/msg/TwistWithCovarianceStamped')
+    msg = decode(blob)
+    print(msg.twist.twist.linear.x)
+
+Definitions are looked up in this order: types registered explicitly with
+``TypeRegistry.add_definition`` / ``add_concatenated_definitions`` (e.g. the
+definitions embedded in a bag), ``.msg`` files found in the registry's schema
+directories, and finally the built-in definitions below, which cover every
+type listed in ``metadata.yaml``.
+"""
+import os
+import re
+import struct
+from collections import namedtuple
+
+
+# ROS primitive type -> (struct format code, size in bytes). CDR aligns every
+# primitive to its own size.
+PRIMITIVES = {
+    'bool': ('?', 1),
+    'byte': ('B', 1),
+    'char': ('B', 1),
+    'int8': ('b', 1),
+    'uint8': ('B', 1),
+    'int16': ('h', 2),
+    'uint16': ('H', 2),
+    'int32': ('i', 4),
+    'uint32': ('I', 4),
+    'int64': ('q', 8),
+    'uint64': ('Q', 8),
+    'float32': ('f', 4),
+    'float64': ('d', 8),
+}
+
+# Definitions of the message types recorded in our bags (see metadata.yaml)
+# and everything they depend on.
+BUILTIN_DEFINITIONS = {
+    'builtin_interfaces/msg/Time': """
+int32 sec
+uint32 nanosec
+""",
+    'std_msgs/msg/Header': """
+builtin_interfaces/Time stamp
+string frame_id
+""",
+    'rosgraph_msgs/msg/Clock': """
+builtin_interfaces/Time clock
+""",
+    'geometry_msgs/msg/Vector3': """
+float64 x
+float64 y
+float64 z
+""",
+    'geometry_msgs/msg/Quaternion': """
+float64 x 0
+float64 y 0
+float64 z 0
+float64 w 1
+""",
+    'geometry_msgs/msg/Twist': """
+Vector3 linear
+Vector3 angular
+""",
+    'geometry_msgs/msg/TwistWithCovariance': """
+Twist twist
+float64[36] covariance
+""",
+    'geometry_msgs/msg/TwistWithCovarianceStamped': """
+std_msgs/Header header
+TwistWithCovariance twist
+""",
+    'sensor_msgs/msg/NavSatStatus': """
+int8 STATUS_NO_FIX = -1
+int8 STATUS_FIX = 0
+int8 STATUS_SBAS_FIX = 1
+int8 STATUS_GBAS_FIX = 2
+int8 status
+uint16 SERVICE_GPS = 1
+uint16 SERVICE_GLONASS = 2
+uint16 SERVICE_COMPASS = 4
+uint16 SERVICE_GALILEO = 8
+uint16 service
+""",
+    'sensor_msgs/msg/NavSatFix': """
+std_msgs/Header header
+NavSatStatus status
+float64 latitude
+float64 longitude
+float64 altitude
+float64[9] position_covariance
+uint8 COVARIANCE_TYPE_UNKNOWN = 0
+uint8 COVARIANCE_TYPE_APPROXIMATED = 1
+uint8 COVARIANCE_TYPE_DIAGONAL_KNOWN = 2
+uint8 COVARIANCE_TYPE_KNOWN = 3
+uint8 position_covariance_type
+""",
+    'sensor_msgs/msg/Imu': """
+std_msgs/Header header
+geometry_msgs/Quaternion orientation
+float64[9] orientation_covariance
+geometry_msgs/Vector3 angular_velocity
+float64[9] angular_velocity_covariance
+geometry_msgs/Vector3 linear_acceleration
+float64[9] linear_acceleration_covariance
+""",
+    'autoware_vehicle_msgs/msg/ControlModeReport': """
+uint8 NO_COMMAND = 0
+uint8 AUTONOMOUS = 1
+uint8 AUTONOMOUS_STEER_ONLY = 2
+uint8 AUTONOMOUS_VELOCITY_ONLY = 3
+uint8 MANUAL = 4
+uint8 DISENGAGED = 5
+uint8 NOT_READY = 6
+builtin_interfaces/Time stamp
+uint8 mode
+""",
+    'autoware_vehicle_msgs/msg/GearReport': """
+uint8 NONE = 0
+uint8 NEUTRAL = 1
+uint8 DRIVE = 2
+uint8 REVERSE = 20
+uint8 PARK = 22
+uint8 LOW = 23
+builtin_interfaces/Time stamp
+uint8 report
+""",
+    'autoware_vehicle_msgs/msg/SteeringReport': """
+builtin_interfaces/Time stamp
+float32 steering_tire_angle
+""",
+    'autoware_vehicle_msgs/msg/VelocityReport': """
+std_msgs/Header header
+float32 longitudinal_velocity
+float32 lateral_velocity
+float32 heading_rate
+""",
+}
+
+# One field of a message definition. ``kind`` is 'primitive', 'string' or
+# 'message'; ``array`` is None for scalars, -1 for (bounded or unbounded)
+# sequences and N for fixed-size arrays.
+Field = namedtuple('Field', ['name', 'type', 'kind', 'array'])
+
+_FIELD_RE = re.compile(r'^(?P<type>[\w/]+(?:<=\d+)?)(?P<array>\[(?:<=)?\d*\])?\s+(?P<name>\w+)(?P<rest>.*)$')
+_SEPARATOR_RE = re.compile(r'^={10,}\s*$', re.MULTILINE)
+
+
+def normalize_type_name(msg_type):
+    """ Returns the canonical 'pkg/msg/Name' form of a message type name.
+    Accepts 'pkg/msg/Name', 'pkg/Name' and 'pkg.msg.Name'.
+    """
+    parts = msg_type.replace('.', '/').strip().split('/')
+    if len(parts) == 2:
+        return '{}/msg/{}'.format(parts[0], parts[1])
+    if len(parts) == 3:
+        return '/'.join(parts)
+    raise ValueError('Invalid message type name: {}'.format(msg_type))
+
+
+def _resolve_field_type(base, package):
+    """ Resolves a field's base type to a primitive name or a full message type. """
+    if '<=' in base:
+        base = base.split('<=', 1)[0]  # bounded string, e.g. string<=10
+    if base in PRIMITIVES or base in ('string', 'wstring'):
+        return base
+    if base == 'Header':
+        return 'std_msgs/msg/Header'
+    if '/' in base:
+        return normalize_type_name(base)
+    return '{}/msg/{}'.format(package, base)
+
+
+def parse_message_definition(msg_type, text):
+    """ Parses the text of a .msg file.
+    Returns (fields, constants): a list of Field and a dict name -> value.
+    """
+    package = normalize_type_name(msg_type).split('/')[0]
+    fields = []
+    constants = {}
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = _FIELD_RE.match(line)
+        if match is None:
+            raise ValueError('Cannot parse line in {}: {!r}'.format(msg_type, raw_line))
+        field_type = _resolve_field_type(match.group('type'), package)
+        rest = match.group('rest').strip()
+        if rest.startswith('='):
+            value = rest[1:].strip()
+            if field_type not in ('string', 'wstring'):
+                value = value.split('#', 1)[0].strip()
+            constants[match.group('name')] = _parse_constant(field_type, value)
+            continue
+        if field_type == 'wstring':
+            raise ValueError('wstring fields are not supported ({}.{})'.format(msg_type, match.group('name')))
+        array = match.group('array')
+        if array is None:
+            size = None
+        elif array == '[]' or array.startswith('[<='):
+            size = -1
+        else:
+            size = int(array[1:-1])
+        if field_type in PRIMITIVES:
+            kind = 'primitive'
+        elif field_type == 'string':
+            kind = 'string'
+        else:
+            kind = 'message'
+        fields.append(Field(match.group('name'), field_type, kind, size))
+    return fields, constants
+
+
+def _parse_constant(field_type, value):
+    if field_type in ('string', 'wstring'):
+        return value.strip('"\'')
+    if field_type == 'bool':
+        return value.lower() in ('true', '1')
+    if field_type in ('float32', 'float64'):
+        return float(value)
+    return int(value)
+
+
+def split_concatenated_definitions(msg_type, text):
+    """ Splits a concatenated definition (the format stored in rosbag2's
+    message_definitions table and in MCAP schemas) into {type: text}.
+    """
+    definitions = {}
+    chunks = _SEPARATOR_RE.split(text)
+    definitions[normalize_type_name(msg_type)] = chunks[0]
+    for chunk in chunks[1:]:
+        chunk = chunk.lstrip('\n')
+        header, _, body = chunk.partition('\n')
+        if not header.startswith('MSG:'):
+            raise ValueError('Expected "MSG: <type>" after separator, got {!r}'.format(header))
+        definitions[normalize_type_name(header[4:].strip())] = body
+    return definitions
+
+
+class CDRMessage:
+    """ Base class of the message classes generated by TypeRegistry.
+    Mirrors the parts of the rclpy message API we rely on: attribute access,
+    a repr in the same format, equality and get_fields_and_field_types().
+    """
+    __slots__ = ()
+    _type = ''
+    _field_types = {}
+
+    @classmethod
+    def get_fields_and_field_types(cls):
+        return dict(cls._field_types)
+
+    def __repr__(self):
+        args = ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__)
+        return '{}({})'.format(self._type.replace('/', '.'), args)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __reduce__(self):
+        return _restore, (self._type, tuple(getattr(self, name) for name in self.__slots__))
+
+
+def _restore(msg_type, values):
+    """ Unpickles a CDRMessage (used by CDRMessage.__reduce__). """
+    cls = default_registry._classes.get(msg_type) or default_registry.get_class(msg_type)
+    return cls(*values)
+
+
+class _FunctionBuilder:
+    """ Generates the source of one decode function.
+
+    Consecutive fixed-size fields are merged into a single precompiled Struct
+    as long as their alignment can be worked out statically; strings and
+    sequences fall back to run-time alignment.
+    """
+
+    def __init__(self, registry, endian, namespace, root):
+        self.registry = registry
+        self.endian = endian
+        self.namespace = namespace
+        self.lines = []
+        self.counter = 0
+        # Statically known state: at the start of the current run the offset
+        # (pos - 4) is congruent to 'phase' modulo 'base'. A root message
+        # starts right after the encapsulation header, i.e. fully aligned.
+        self.base = 8 if root else 1
+        self.phase = 0
+        self.run_fmt = ''
+        self.run_size = 0
+        self.run_targets = []  # (var, count)
+        self.pending = []  # statements to emit after the run's unpack
+
+    def var(self, hint):
+        self.counter += 1
+        return '_{}{}'.format(hint, self.counter)
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def align(self, alignment):
+        """ Makes sure the next field starts at a multiple of 'alignment'. """
+        if alignment <= self.base:
+            return
+        self.flush()
+        self.emit('pos += (4 - pos) % {}'.format(alignment))
+        self.base = alignment
+        self.phase = 0
+
+    def primitive(self, ros_type, count=1):
+        code, size = PRIMITIVES[ros_type]
+        self.align(size)
+        padding = -(self.phase + self.run_size) % size
+        if padding:
+            self.run_fmt += '{}x'.format(padding)
+        self.run_fmt += code if count == 1 else '{}{}'.format(count, code)
+        self.run_size += padding + size * count
+        target = self.var('v')
+        self.run_targets.append((target, count))
+        return target
+
+    def flush(self):
+        if self.run_targets:
+            name = self.var('S')
+            self.namespace[name] = struct.Struct(self.endian + self.run_fmt)
+            if all(count == 1 for _, count in self.run_targets):
+                targets = ''.join(var + ', ' for var, _ in self.run_targets)
+                self.emit('{}= {}.unpack_from(buf, pos)'.format(targets, name))
+            else:
+                self.emit('_t = {}.unpack_from(buf, pos)'.format(name))
+                index = 0
+                for var, count in self.run_targets:
+                    if count == 1:
+                        self.emit('{} = _t[{}]'.format(var, index))
+                    else:
+                        self.emit('{} = list(_t[{}:{}])'.format(var, index, index + count))
+                    index += count
+            self.emit('pos += {}'.format(self.run_size))
+            self.phase = (self.phase + self.run_size) % self.base
+        self.run_fmt = ''
+        self.run_size = 0
+        self.run_targets = []
+        for line in self.pending:
+            self.emit(line)
+        self.pending = []
+
+    def forget_alignment(self):
+        """ Called after variable-length data: pos is no longer known statically. """
+        self.flush()
+        self.base = 1
+        self.phase = 0
+
+    def string(self):
+        length = self.primitive('uint32')
+        self.forget_alignment()
+        target = self.var('s')
+        self.emit("{} = buf[pos:pos + {} - 1].decode()".format(target, length))
+        self.emit('pos += {}'.format(length))
+        return target
+
+    def message(self, msg_type):
+        """ Decodes a nested message inline; returns the variable holding it. """
+        fields = self.registry.get_fields(msg_type)
+        values = [self.field(field) for field in fields]
+        cls_name = self.registry.class_name(msg_type)
+        self.namespace[cls_name] = self.registry.get_class(msg_type)
+        target = self.var('m')
+        self.pending.append('{} = {}({})'.format(target, cls_name, ', '.join(values)))
+        return target
+
+    def call_nested(self, msg_type):
+        """ Decodes a nested message through its own function (used in loops). """
+        fn_name = self.registry.function_name(msg_type, self.endian)
+        self.namespace[fn_name] = self.registry.get_function(msg_type, self.endian)
+        return fn_name
+
+    def field(self, field):
+        if field.array is None:
+            if field.kind == 'primitive':
+                return self.primitive(field.type)
+            if field.kind == 'string':
+                return self.string()
+            return self.message(field.type)
+
+        if field.array == -1:
+            count = self.primitive('uint32')
+            self.forget_alignment()
+        else:
+            count = str(field.array)
+            if field.kind == 'primitive' and field.type not in ('byte', 'uint8', 'char'):
+                return self.primitive(field.type, field.array)
+            self.flush()
+
+        target = self.var('a')
+        if field.kind == 'primitive':
+            code, size = PRIMITIVES[field.type]
+            if size > 1:
+                # Fast-CDR only aligns non-empty arrays
+                self.emit('if {}:'.format(count))
+                self.emit('    pos += (4 - pos) % {}'.format(size))
+            if field.type in ('byte', 'uint8', 'char'):
+                self.emit('{} = buf[pos:pos + {}]'.format(target, count))
+            else:
+                self.emit("{} = list(_unpack_from('{}%d{}' % {}, buf, pos))".format(
+                    target, self.endian, code, count))
+            self.emit('pos += {} * {}'.format(count, size))
+        elif field.kind == 'string':
+            self.emit('{} = []'.format(target))
+            self.emit('for _ in range({}):'.format(count))
+            self.emit('    pos += (4 - pos) % 4')
+            self.emit('    _n, = _U32.unpack_from(buf, pos)')
+            self.emit('    {}.append(buf[pos + 4:pos + 3 + _n].decode())'.format(target))
+            self.emit('    pos += 4 + _n')
+        else:
+            fn_name = self.call_nested(field.type)
+            self.emit('{} = []'.format(target))
+            self.emit('for _ in range({}):'.format(count))
+            self.emit('    _o, pos = {}(buf, pos)'.format(fn_name))
+            self.emit('    {}.append(_o)'.format(target))
+        self.forget_alignment()
+        return target
+
+
+class TypeRegistry:
+    """ Holds message definitions and the classes/decoders compiled from them. """
+
+    def __init__(self, schema_dirs=(), include_builtin=True):
+        self.schema_dirs = list(schema_dirs)
+        self.include_builtin = include_builtin
+        self._definitions = {}
+        self._parsed = {}
+        self._classes = {}
+        self._functions = {}
+        self._decoders = {}
+
+    def add_definition(self, msg_type, text, replace=True):
+        """ Registers the .msg definition of a single type. Must be called
+        before the type (or a type containing it) is first decoded.
+        With replace=False, types that already have an explicit definition or
+        were already parsed are left untouched.
+        """
+        msg_type = normalize_type_name(msg_type)
+        if not replace and (msg_type in self._definitions or msg_type in self._parsed):
+            return
+        self._definitions[msg_type] = text
+        self._parsed.pop(msg_type, None)
+
+    def add_concatenated_definitions(self, msg_type, text, replace=True):
+        """ Registers a definition in rosbag2/MCAP concatenated form. """
+        for name, body in split_concatenated_definitions(msg_type, text).items():
+            self.add_definition(name, body, replace)
+
+    def add_schema_dir(self, path):
+        """ Adds a directory with .msg files, laid out as <pkg>/msg/<Name>.msg
+        (a source tree) or share/<pkg>/msg/<Name>.msg (an install prefix).
+        """
+        self.schema_dirs.append(path)
+
+    def _find_msg_file(self, msg_type):
+        package, _, name = msg_type.split('/')
+        for schema_dir in self.schema_dirs:
+            for candidate in (os.path.join(schema_dir, package, 'msg', name + '.msg'),
+                              os.path.join(schema_dir, 'share', package, 'msg', name + '.msg')):
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def get_fields(self, msg_type):
+        """ Returns the list of Field of a message type. """
+        msg_type = normalize_type_name(msg_type)
+        if msg_type not in self._parsed:
+            text = self._definitions.get(msg_type)
+            if text is None:
+                path = self._find_msg_file(msg_type)
+                if path is not None:
+                    with open(path, 'r') as file:
+                        text = file.read()
+                elif self.include_builtin and msg_type in BUILTIN_DEFINITIONS:
+                    text = BUILTIN_DEFINITIONS[msg_type]
+                else:
+                    raise KeyError('No definition found for message type {}'.format(msg_type))
+            self._parsed[msg_type] = parse_message_definition(msg_type, text)
+        return self._parsed[msg_type][0]
+
+    def get_constants(self, msg_type):
+        self.get_fields(msg_type)
+        return self._parsed[normalize_type_name(msg_type)][1]
+
+    @staticmethod
+    def class_name(msg_type):
+        return '_C_' + msg_type.replace('/', '_')
+
+    @staticmethod
+    def function_name(msg_type, endian, root=False):
+        return '_decode_{}_{}{}'.format(msg_type.replace('/', '_'), 'le' if endian == '<' else 'be',
+                                        '_root' if root else '')
+
+    def get_class(self, msg_type):
+        """ Returns the generated message class of a type. """
+        msg_type = normalize_type_name(msg_type)
+        if msg_type not in self._classes:
+            fields = self.get_fields(msg_type)
+            names = [field.name for field in fields]
+            source = 'def __init__(self{}):\n'.format(''.join(', ' + name for name in names))
+            source += ''.join('    self.{0} = {0}\n'.format(name) for name in names) or '    pass\n'
+            namespace = {}
+            exec(source, namespace)
+            attributes = dict(self.get_constants(msg_type))
+            attributes.update({
+                '__slots__': tuple(names),
+                '__init__': namespace['__init__'],
+                '__module__': __name__,
+                '_type': msg_type,
+                '_field_types': {field.name: _field_type_string(field) for field in fields},
+            })
+            self._classes[msg_type] = type(msg_type.split('/')[-1], (CDRMessage,), attributes)
+        return self._classes[msg_type]
+
+    def get_function(self, msg_type, endian='<', root=False):
+        """ Returns the compiled function decode(buf, pos) -> (msg, new_pos).
+        Root functions assume pos is the start of the payload (offset 4) and can
+        therefore resolve more alignment statically.
+        """
+        msg_type = normalize_type_name(msg_type)
+        key = (msg_type, endian, root)
+        if key not in self._functions:
+            namespace = {'_unpack_from': struct.unpack_from, '_U32': struct.Struct(endian + 'I')}
+            builder = _FunctionBuilder(self, endian, namespace, root)
+            result = builder.message(msg_type)
+            builder.flush()
+            fn_name = self.function_name(msg_type, endian, root)
+            source = 'def {}(buf, pos):\n{}\n    return {}, pos\n'.format(
+                fn_name, '\n'.join(builder.lines), result)
+            exec(compile(source, '<cdr {}>'.format(msg_type), 'exec'), namespace)
+            self._functions[key] = namespace[fn_name]
+            self._functions[key].source = source
+        return self._functions[key]
+
+    def get_decoder(self, msg_type):
+        """ Returns a function that turns one serialized CDR message (as stored
+        in the bag's 'data' column) into a message object.
+        """
+        msg_type = normalize_type_name(msg_type)
+        if msg_type not in self._decoders:
+            little = self.get_function(msg_type, '<', root=True)
+            registry = self
+
+            def decode(data):
+                if data[1] & 1:  # encapsulation kind: CDR_LE / PL_CDR_LE
+                    return little(data, 4)[0]
+                return registry.get_function(msg_type, '>', root=True)(data, 4)[0]
+
+            self._decoders[msg_type] = decode
+        return self._decoders[msg_type]
+
+
+def _field_type_string(field):
+    """ Field type as reported by rclpy's get_fields_and_field_types(). """
+    if field.array is None:
+        return field.type
+    if field.array == -1:
+        return 'sequence<{}>'.format(field.type)
+    return '{}[{}]'.format(field.type, field.array)
+
+
+default_registry = TypeRegistry()
+
+
+def get_decoder(msg_type):
+    """ Returns the decoder of msg_type from the default registry. """
+    return default_registry.get_decoder(msg_type)
+
+
+def deserialize_cdr(data, msg_type):
+    """ Drop-in for rclpy's deserialize_message taking a type name. """
+    return default_registry.get_decoder(msg_type)(data)
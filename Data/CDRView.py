@@ -0,0 +1,605 @@
+"""Lazy, zero-copy views over serialized CDR messages.
+
+Decoding a message builds its whole object tree (an Imu has three 9-element
+covariance lists) even when only two fields are read. A MessageView wraps
+the blob in a memoryview and decodes a field only when it is accessed:
+
+    view = MessageView(data, 'sensor_msgs/msg/Imu')
+    view.angular_velocity.z          # one struct.unpack_from at a known offset
+    view.orientation_covariance      # read-only NumPy array over the blob, no copy
+    view.header.frame_id
+
+The layout of every type is worked out once. Field offsets are constants up
+to the first string or sequence. After that they are a short program ("read
+the string length at 12, skip it, align to 8, add 16") evaluated on access.
+Views have the message API the scripts rely on (attribute access,
+get_fields_and_field_types(), a repr equal to the decoded message's), so
+they can stand in for decoded messages: ROSDeserializer.get_deserializer(...,
+backend='view').
+
+column() and columns() run the same offset programs over many blobs at once
+with NumPy and return one array per field:
+
+    columns(blobs, ['twist.twist.linear.x', 'twist.twist.angular.z'],
+            'geometry_msgs/msg/TwistWithCovarianceStamped')
+
+    python CDRView.py --bag sample-rosbag_0.db3   # full decode vs views vs columns
+"""
+import argparse
+import struct
+import time
+import tracemalloc
+from collections import namedtuple
+from operator import attrgetter
+
+import numpy as np
+
+import CDRDecoder
+
+# Offset program steps (see _LayoutBuilder)
+_SKIP, _ALIGN, _STRING, _SEQUENCE, _CALL = range(5)
+
+# Where a field starts: evaluate 'ops' from the start of the payload, then add
+# 'offset'. kind is 'primitive', 'string', 'message', 'array' (fixed
+# primitive array), 'sequence' (primitive sequence) or 'list' (array or
+# sequence of strings or messages); count is the fixed array size.
+FieldLocation = namedtuple('FieldLocation', ['kind', 'type', 'count', 'ops', 'offset', 'field'])
+
+_STRUCTS = {}
+
+
+def _struct(endian, code):
+    key = endian + code
+    if key not in _STRUCTS:
+        _STRUCTS[key] = struct.Struct(key)
+    return _STRUCTS[key]
+
+
+def _dtype(endian, ros_type):
+    code, _ = CDRDecoder.PRIMITIVES[ros_type]
+    return np.dtype(endian + code)
+
+
+class _LayoutBuilder:
+    """ Walks a message definition and records the offset program of every
+    field path. Like CDRDecoder's _FunctionBuilder, it tracks what is known
+    about the alignment of the current position so that padding is resolved
+    statically whenever possible.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.locations = {}
+        self.ops = []
+        self.skip = 0
+        self.base = 8  # the payload starts fully aligned
+        self.phase = 0
+
+    def align(self, size):
+        if size <= self.base:
+            padding = -self.phase % size
+            self.advance(padding)
+            return
+        self.dynamic((_ALIGN, size))
+        self.base = size
+
+    def advance(self, size):
+        self.skip += size
+        self.phase = (self.phase + size) % self.base
+
+    def dynamic(self, op):
+        if self.skip:
+            self.ops.append((_SKIP, self.skip))
+            self.skip = 0
+        self.ops.append(op)
+        self.base = 1
+        self.phase = 0
+
+    def record(self, path, kind, field, count=None):
+        self.locations[path] = FieldLocation(kind, field.type, count, tuple(self.ops), self.skip, field)
+
+    def message(self, msg_type, prefix):
+        for field in self.registry.get_fields(msg_type):
+            path = prefix + field.name
+            if field.array is None:
+                if field.kind == 'primitive':
+                    size = CDRDecoder.PRIMITIVES[field.type][1]
+                    self.align(size)
+                    self.record(path, 'primitive', field)
+                    self.advance(size)
+                elif field.kind == 'string':
+                    self.align(4)
+                    self.record(path, 'string', field)
+                    self.dynamic((_STRING, None))
+                else:
+                    self.record(path, 'message', field)
+                    self.message(field.type, path + '.')
+            elif field.array >= 0 and field.kind == 'primitive':
+                size = CDRDecoder.PRIMITIVES[field.type][1]
+                self.align(size)
+                self.record(path, 'array', field, field.array)
+                self.advance(size * field.array)
+            elif field.array >= 0:
+                # Fixed arrays of strings or messages are unrolled: path[i] is a field of its own
+                self.record(path, 'list', field, field.array)
+                for index in range(field.array):
+                    element = field._replace(name='{}[{}]'.format(field.name, index), array=None)
+                    if field.kind == 'string':
+                        self.align(4)
+                        self.record(prefix + element.name, 'string', element)
+                        self.dynamic((_STRING, None))
+                    else:
+                        self.record(prefix + element.name, 'message', element)
+                        self.message(field.type, prefix + element.name + '.')
+            elif field.kind == 'primitive':
+                self.align(4)
+                self.record(path, 'sequence', field)
+                self.dynamic((_SEQUENCE, CDRDecoder.PRIMITIVES[field.type][1]))
+            else:
+                # Sequences of strings or messages have no fixed element size: skipped by decoding them
+                self.align(4)
+                self.record(path, 'list', field)
+                self.dynamic((_CALL, field))
+
+
+class Layout:
+    """ Field locations of one message type, see FieldLocation. """
+
+    def __init__(self, msg_type, registry=None):
+        self.registry = registry or CDRDecoder.default_registry
+        self.msg_type = CDRDecoder.normalize_type_name(msg_type)
+        builder = _LayoutBuilder(self.registry)
+        builder.message(self.msg_type, '')
+        self.locations = builder.locations
+        self.fixed = not any(location.ops for location in self.locations.values())
+        self._children = {}  # message path -> [Field]
+        self._readers = {}  # endian -> {path: reader(buf)}
+        self._classes = {}  # (endian, message path) -> MessageView subclass
+
+    def children(self, prefix):
+        """ Returns the fields of the message at 'prefix' ('' for the root). """
+        if prefix not in self._children:
+            msg_type = self.msg_type if not prefix else self.locations[prefix[:-1]].type
+            self._children[prefix] = self.registry.get_fields(msg_type)
+        return self._children[prefix]
+
+    def readers(self, endian):
+        """ Returns {path: reader(buf) -> value}, compiled for one byte order. """
+        if endian not in self._readers:
+            readers = {}
+            getters = {}  # path -> property getter(view), the reader inlined
+            messages = []
+            for path, location in self.locations.items():
+                if location.kind == 'message':
+                    messages.append(path)
+                else:
+                    readers[path], getters[path] = self._compile(path, location, endian)
+            # Nested messages come after their parent: build the innermost view classes first
+            for path in reversed(messages):
+                cls = self._view_class(endian, path + '.', readers, getters)
+                readers[path] = lambda buf, cls=cls: _child(cls, buf)
+                getters[path] = _message_getter(cls)
+            self._view_class(endian, '', readers, getters)
+            self._readers[endian] = readers
+        return self._readers[endian]
+
+    def view_class(self, endian, prefix=''):
+        """ Returns the MessageView subclass of the message at 'prefix'. """
+        self.readers(endian)
+        return self._classes[(endian, prefix)]
+
+    def _view_class(self, endian, prefix, readers, getters):
+        # One property per field, like the classes CDRDecoder generates
+        msg_type = self.msg_type if not prefix else self.locations[prefix[:-1]].type
+        attributes = {'__slots__': (), '_layout': self, '_readers': readers, '_prefix': prefix, '_type': msg_type}
+        for field in self.children(prefix):
+            attributes[field.name] = property(getters[prefix + field.name])
+        cls = type(msg_type.rsplit('/', 1)[-1] + 'View', (MessageView,), attributes)
+        self._classes[(endian, prefix)] = cls
+        return cls
+
+    def _compile(self, path, location, endian):
+        """ Generates the reader of one field: the offset program unrolled
+        into straight-line code, then a single unpack for primitives.
+        Returns (reader(buf), getter(view)).
+        """
+        namespace = {'_U32': _struct(endian, 'I').unpack_from}
+        lines = []
+        pos = 4  # constant part of the offset, not yet added to the variable pos
+        dynamic = False
+        for op, argument in location.ops:
+            if op == _SKIP:
+                pos += argument
+                continue
+            lines.append('    pos {} {}'.format('+=' if dynamic else '=', pos))
+            dynamic = True
+            pos = 0
+            if op == _ALIGN:
+                lines.append('    pos += (4 - pos) % {}'.format(argument))
+            elif op == _STRING:
+                lines.append('    pos += 4 + _U32(buf, pos)[0]')
+            elif op == _SEQUENCE:
+                lines.append('    n = _U32(buf, pos)[0]')
+                lines.append('    pos += 4')
+                if argument > 1:
+                    lines.append('    if n:')
+                    lines.append('        pos += (4 - pos) % {}'.format(argument))
+                lines.append('    pos += n * {}'.format(argument))
+            else:
+                skip = '_skip{}'.format(len(namespace))
+                namespace[skip] = lambda buf, pos, field=argument: self._skip_list(buf, pos, field, endian)[1]
+                lines.append('    pos = {}(buf, pos)'.format(skip))
+        pos += location.offset
+        where = 'pos + {}'.format(pos) if dynamic else str(pos)
+        if location.kind == 'primitive':
+            namespace['_unpack'] = _struct(endian, CDRDecoder.PRIMITIVES[location.type][0]).unpack_from
+            lines.append('    return _unpack(buf, {})[0]'.format(where))
+        elif location.kind == 'string':
+            lines.append('    pos = {}'.format(where))
+            lines.append("    return str(buf[pos + 4:pos + 3 + _U32(buf, pos)[0]], 'utf-8')")
+        else:
+            namespace['_value'] = lambda buf, pos: self.value(buf, location, pos, endian, path)
+            lines.append('    return _value(buf, {})'.format(where))
+        body = '\n'.join(lines)
+        exec('def _reader(buf):\n' + body, namespace)
+        exec('def _getter(view):\n    buf = view._buf\n' + body, namespace)
+        return namespace['_reader'], namespace['_getter']
+
+    def offset(self, buf, location, endian):
+        """ Absolute offset of a field in one blob. """
+        pos = 4
+        for op, argument in location.ops:
+            if op == _SKIP:
+                pos += argument
+            elif op == _ALIGN:
+                pos += (4 - pos) % argument
+            elif op == _STRING:
+                pos += 4 + _struct(endian, 'I').unpack_from(buf, pos)[0]
+            elif op == _SEQUENCE:
+                count = _struct(endian, 'I').unpack_from(buf, pos)[0]
+                pos += 4
+                if count and argument > 1:
+                    pos += (4 - pos) % argument
+                pos += count * argument
+            else:
+                pos = self._skip_list(buf, pos, argument, endian)[1]
+        return pos + location.offset
+
+    def _skip_list(self, buf, pos, field, endian):
+        # A sequence of strings or messages is decoded, there is no shortcut over it
+        count = _struct(endian, 'I').unpack_from(buf, pos)[0]
+        pos += 4
+        return self._read_list(buf, pos, field, count, endian)
+
+    def _read_list(self, buf, pos, field, count, endian):
+        data = buf.obj if isinstance(buf, memoryview) and isinstance(buf.obj, bytes) else bytes(buf)
+        items = []
+        if field.kind == 'string':
+            for _ in range(count):
+                pos += (4 - pos) % 4
+                length = _struct(endian, 'I').unpack_from(data, pos)[0]
+                items.append(data[pos + 4:pos + 3 + length].decode())
+                pos += 4 + length
+        else:
+            decode = self.registry.get_function(field.type, endian)
+            for _ in range(count):
+                item, pos = decode(data, pos)
+                items.append(item)
+        return items, pos
+
+    def value(self, buf, location, pos, endian, path=None):
+        """ Decodes the field at 'location', which starts at offset pos of buf.
+        Nested messages are returned as views.
+        """
+        kind = location.kind
+        if kind == 'primitive':
+            code = CDRDecoder.PRIMITIVES[location.type][0]
+            return _struct(endian, code).unpack_from(buf, pos)[0]
+        if kind == 'string':
+            length = _struct(endian, 'I').unpack_from(buf, pos)[0]
+            return str(buf[pos + 4:pos + 3 + length], 'utf-8')
+        if kind == 'message':
+            return _child(self.view_class(endian, path + '.'), buf)
+        if kind == 'array':
+            return _array(buf, location.type, location.count, pos, endian)
+        if kind == 'sequence':
+            count = _struct(endian, 'I').unpack_from(buf, pos)[0]
+            pos += 4
+            size = CDRDecoder.PRIMITIVES[location.type][1]
+            if count and size > 1:
+                pos += (4 - pos) % size
+            return _array(buf, location.type, count, pos, endian)
+        # list
+        if location.count is not None:
+            readers = self.readers(endian)
+            name = location.field.name
+            prefix = path[:len(path) - len(name)]
+            return [readers['{}{}[{}]'.format(prefix, name, index)](buf) for index in range(location.count)]
+        return self._skip_list(buf, pos, location.field, endian)[0]
+
+
+def _array(buf, ros_type, count, pos, endian):
+    if ros_type in ('byte', 'uint8', 'char'):
+        return buf[pos:pos + count]
+    return np.frombuffer(buf, dtype=_dtype(endian, ros_type), count=count, offset=pos)
+
+
+_layouts = {}
+
+
+def get_layout(msg_type, registry=None):
+    """ Returns the (shared) Layout of a message type. """
+    registry = registry or CDRDecoder.default_registry
+    key = (id(registry), CDRDecoder.normalize_type_name(msg_type))
+    if key not in _layouts:
+        _layouts[key] = Layout(msg_type, registry)
+    return _layouts[key]
+
+
+class MessageView:
+    """ Read-only view of a serialized message (or of a message nested in
+    it). Fields are decoded on every access: keep a value in a local
+    variable rather than reading it twice.
+
+    MessageView(data, msg_type) returns an instance of the view class that
+    Layout generates for the type, with one property per field.
+    """
+
+    __slots__ = ('_buf',)
+    _layout = None
+    _readers = None
+    _prefix = ''
+    _type = None
+
+    def __new__(cls, data, msg_type=None, registry=None):
+        buf = data if isinstance(data, memoryview) else memoryview(data)
+        # Encapsulation kind: CDR_LE / PL_CDR_LE have the low bit set
+        return _child(get_layout(msg_type, registry).view_class('<' if buf[1] & 1 else '>'), buf)
+
+    def __init__(self, data, msg_type=None, registry=None):
+        pass
+
+    def get(self, path):
+        """ Value of a dotted field path, e.g. view.get('twist.twist.linear.x'). """
+        return self._readers[self._prefix + path](self._buf)
+
+    @property
+    def _endian(self):
+        return '<' if self._buf[1] & 1 else '>'
+
+    @classmethod
+    def get_fields_and_field_types(cls):
+        return {field.name: CDRDecoder._field_type_string(field) for field in cls._layout.children(cls._prefix)}
+
+    def decode(self):
+        """ Decodes the whole (sub)message with CDRDecoder. """
+        data = self._buf.obj if isinstance(self._buf.obj, bytes) else bytes(self._buf)
+        if not self._prefix:
+            return self._layout.registry.get_decoder(self._layout.msg_type)(data)
+        location = self._layout.locations[self._prefix[:-1]]
+        pos = self._layout.offset(self._buf, location, self._endian)
+        return self._layout.registry.get_function(self._type, self._endian)(data, pos)[0]
+
+    def __repr__(self):
+        return repr(self.decode())
+
+    def __eq__(self, other):
+        if isinstance(other, MessageView):
+            other = other.decode()
+        return self.decode() == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return _restore_view, (bytes(self._buf), self._layout.msg_type, self._prefix)
+
+
+def _restore_view(data, msg_type, prefix):
+    view = MessageView(data, msg_type)
+    return view.get(prefix[:-1]) if prefix else view
+
+
+def _child(cls, buf):
+    # Views of nested messages share the buffer of the root view
+    view = object.__new__(cls)
+    view._buf = buf
+    return view
+
+
+def _message_getter(cls):
+    new = object.__new__
+
+    def getter(view):
+        child = new(cls)
+        child._buf = view._buf
+        return child
+    return getter
+
+
+def get_view_factory(msg_type, registry=None):
+    """ Returns a deserializer-like function: blob -> MessageView. """
+    layout = get_layout(msg_type, registry)
+    little, big = layout.view_class('<'), layout.view_class('>')
+
+    def view(data):
+        buf = memoryview(data)
+        return _child(little if buf[1] & 1 else big, buf)
+    return view
+
+
+def _gather(data, positions, dtype, count=1):
+    """ Reads 'count' values of dtype at each of 'positions' of the uint8
+    array 'data'. Returns an (n,) array, or (n, count) if count > 1.
+    """
+    size = dtype.itemsize * count
+    out = np.empty((len(positions), size), dtype=np.uint8)
+    index = np.empty_like(positions)
+    # One byte column at a time keeps the temporaries at one index per message
+    for byte in range(size):
+        np.add(positions, byte, out=index)
+        np.take(data, index, out=out[:, byte])
+    values = out.view(dtype)
+    return values.ravel() if count == 1 else values
+
+
+def _pack(messages):
+    """ Joins blobs (or root views) into one uint8 array.
+    Returns (data, starts, endian).
+    """
+    blobs = []
+    for message in messages:
+        if isinstance(message, MessageView):
+            if message._prefix:
+                raise ValueError('Bulk reads need root message views, not {}'.format(message._type))
+            message = message._buf
+        blobs.append(message)
+    lengths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+    starts = np.zeros(len(blobs), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    kinds = data[starts + 1] & 1
+    if kinds.min() != kinds.max():
+        raise ValueError('Blobs of mixed endianness')
+    return data, starts, '<' if kinds[0] else '>'
+
+
+def _positions(layout, data, starts, location, endian):
+    """ Absolute offsets of a field in every blob, evaluated for all blobs at once. """
+    pos = np.full(len(starts), 4, dtype=np.int64)
+    u32 = np.dtype(endian + 'u4')
+    for op, argument in location.ops:
+        if op == _SKIP:
+            pos += argument
+        elif op == _ALIGN:
+            pos += (4 - pos) % argument
+        elif op == _STRING:
+            pos += 4 + _gather(data, starts + pos, u32)
+        elif op == _SEQUENCE:
+            count = _gather(data, starts + pos, u32).astype(np.int64)
+            pos += 4
+            if argument > 1:
+                pos += np.where(count > 0, (4 - pos) % argument, 0)
+            pos += count * argument
+        else:
+            buffer = data.data
+            for i, start in enumerate(starts.tolist()):
+                end = int(starts[i + 1]) if i + 1 < len(starts) else len(data)
+                blob = bytes(buffer[start:end])
+                pos[i] = layout._skip_list(blob, int(pos[i]), argument, endian)[1]
+    return starts + pos + location.offset
+
+
+def columns(messages, paths, msg_type, registry=None):
+    """ Reads fields from many blobs (or root views) of one type at once.
+    Returns {path: NumPy array}: one value per message for scalar fields, an
+    (n, count) array for fixed primitive arrays, an object array for strings
+    and sequences.
+    """
+    layout = get_layout(msg_type, registry)
+    result = {}
+    if not len(messages):
+        for path in paths:
+            location = layout.locations[path]
+            dtype = _dtype('<', location.type) if location.kind in ('primitive', 'array') else object
+            result[path] = np.empty((0, location.count) if location.kind == 'array' else 0, dtype=dtype)
+        return result
+    data, starts, endian = _pack(messages)
+    for path in paths:
+        location = layout.locations[path]
+        positions = _positions(layout, data, starts, location, endian)
+        if location.kind == 'primitive':
+            result[path] = _gather(data, positions, _dtype(endian, location.type)).astype(
+                _dtype('=', location.type), copy=False)
+        elif location.kind == 'array':
+            result[path] = _gather(data, positions, _dtype(endian, location.type), location.count).astype(
+                _dtype('=', location.type), copy=False)
+        elif location.kind == 'message':
+            raise ValueError('{} is a message, select one of its fields'.format(path))
+        else:
+            # Variable-length values: one Python object per message
+            buffer = data.data
+            values = np.empty(len(starts), dtype=object)
+            for i, (start, position) in enumerate(zip(starts.tolist(), positions.tolist())):
+                end = int(starts[i + 1]) if i + 1 < len(starts) else len(data)
+                blob = buffer[start:end]
+                values[i] = layout.value(blob, location, position - start, endian, path)
+            result[path] = values
+    return result
+
+
+def column(messages, path, msg_type, registry=None):
+    """ Reads one field from many blobs of one type, see columns(). """
+    return columns(messages, [path], msg_type, registry)[path]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare full decoding with lazy views for field-selective scans.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per method (best pass is reported).")
+    return parser.parse_args()
+
+
+# Fields read by the benchmark: the ones ROSMessageParser extracts
+BENCHMARK_FIELDS = {
+    'geometry_msgs/msg/TwistWithCovarianceStamped': ['twist.twist.linear.x', 'twist.twist.angular.z'],
+    'sensor_msgs/msg/NavSatFix': ['latitude', 'longitude'],
+    'sensor_msgs/msg/Imu': ['angular_velocity.z', 'linear_acceleration.x'],
+    'autoware_vehicle_msgs/msg/VelocityReport': ['longitudinal_velocity', 'heading_rate'],
+}
+
+
+def _best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _traced_peak(function):
+    """ Peak memory allocated while function() runs, kept result included. """
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main():
+    import ROSDeserializer
+    args = parse_args()
+    conn, _ = ROSDeserializer.connect(args.bag)
+    catalog = ROSDeserializer.get_catalog(conn)
+    # Scan: read the BENCHMARK_FIELDS of every message. Held: memory of all
+    # messages kept decoded vs kept as views; columns: peak of columns().
+    print(f"{'topic':<40} {'msgs':>6} {'decode ms':>10} {'view ms':>8} {'columns ms':>10} "
+          f"{'decoded KB':>11} {'views KB':>9} {'columns KB':>10}")
+    for topic_name in catalog.names():
+        msg_type = CDRDecoder.normalize_type_name(catalog.get(topic_name).type)
+        fields = BENCHMARK_FIELDS.get(msg_type)
+        if fields is None:
+            continue
+        blobs = [row[0] for row in conn.execute('SELECT data FROM messages WHERE topic_id = ?',
+                                                (catalog.get(topic_name).id,))]
+        decode = CDRDecoder.get_decoder(msg_type)
+        view = get_view_factory(msg_type)
+        getter = attrgetter(*fields)
+        seconds = [
+            _best_time(lambda: [getter(decode(blob)) for blob in blobs], args.repeat),
+            _best_time(lambda: [getter(view(blob)) for blob in blobs], args.repeat),
+            _best_time(lambda: columns(blobs, fields, msg_type), args.repeat),
+        ]
+        peaks = [
+            _traced_peak(lambda: [decode(blob) for blob in blobs]),
+            _traced_peak(lambda: [view(blob) for blob in blobs]),
+            _traced_peak(lambda: columns(blobs, fields, msg_type)),
+        ]
+        print(f"{topic_name:<40} {len(blobs):>6} {seconds[0] * 1e3:>10.1f} {seconds[1] * 1e3:>8.1f} "
+              f"{seconds[2] * 1e3:>10.1f} {peaks[0] / 1024:>11.0f} {peaks[1] / 1024:>9.0f} {peaks[2] / 1024:>10.0f}")
+    ROSDeserializer.close(conn)
+
+
+if __name__ == "__main__":
+    main()
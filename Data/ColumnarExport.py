@@ -0,0 +1,313 @@
+"""Columnar export of bag topics (Parquet, Arrow IPC or NumPy .npz).
+
+Instead of writing the repr of every message into details.csv, each message
+type is flattened into typed columns (e.g. 'twist.twist.linear.x',
+'twist.covariance[0]' ... 'twist.covariance[35]') and every topic is written
+to its own file, with the bag timestamp in nanoseconds as the 'timestamp'
+column. Reading the data back is a vectorized load (load_topic) instead of
+string parsing.
+
+    python ColumnarExport.py --bag sample-rosbag_0.db3 --out_dir ../Scripts/columnar --format parquet
+
+Parquet and Arrow output need pyarrow; .npz output only needs NumPy.
+High-rate topics can be downsampled or aggregated on the way with --reduce
+(see Downsampling.py), e.g. --reduce "imu_raw=every:10,/vehicle/status/*=mean:100ms".
+"""
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+
+import Downsampling
+import PipelineMetrics
+import ROSDeserializer
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+
+# Element type names used by CDRDecoder (.msg names) and by rclpy (IDL names)
+# -> NumPy dtype
+DTYPES = {
+    'bool': np.bool_, 'boolean': np.bool_,
+    'byte': np.uint8, 'octet': np.uint8, 'char': np.uint8, 'uint8': np.uint8,
+    'int8': np.int8, 'int16': np.int16, 'uint16': np.uint16,
+    'int32': np.int32, 'uint32': np.uint32, 'int64': np.int64, 'uint64': np.uint64,
+    'float32': np.float32, 'float': np.float32, 'float64': np.float64, 'double': np.float64,
+}
+
+_SEQUENCE_RE = re.compile(r'^sequence<([^,>]+)(?:,\s*\d+)?>$')
+_ARRAY_RE = re.compile(r'^(.+)\[(\d+)\]$')
+
+
+def _split_field_type(field_type):
+    """ Returns (element type, array size) from a field type string;
+    array size is None for scalars and -1 for sequences.
+    """
+    match = _SEQUENCE_RE.match(field_type)
+    if match:
+        return match.group(1).strip(), -1
+    match = _ARRAY_RE.match(field_type)
+    if match:
+        return match.group(1), int(match.group(2))
+    if field_type.endswith('[]'):
+        return field_type[:-2], -1
+    return field_type, None
+
+
+def _element_kind(element_type):
+    element_type = element_type.split('<=', 1)[0]  # bounded strings
+    if element_type in DTYPES:
+        return 'primitive'
+    if element_type in ('string', 'wstring'):
+        return 'string'
+    return 'message'
+
+
+class Flattener:
+    """ Turns messages of one type into rows of scalar values.
+    The column layout is discovered from a sample message, through the
+    get_fields_and_field_types() API shared by rclpy and CDRDecoder messages.
+    Variable-length fields become one column holding a list per row, except
+    sequences of messages, which are skipped.
+    """
+
+    def __init__(self, sample):
+        self.columns = []  # column names
+        self.dtypes = []  # NumPy dtype, str for strings, list for variable-length
+        self.skipped = []
+        expressions = []
+        self._walk(sample, 'm', '', expressions)
+        source = 'def flatten(m):\n    return ({},)\n'.format(', '.join(expressions))
+        namespace = {}
+        exec(source, namespace)
+        self.flatten = namespace['flatten']
+
+    def _walk(self, message, expression, prefix, expressions):
+        for name, field_type in type(message).get_fields_and_field_types().items():
+            element_type, size = _split_field_type(field_type)
+            kind = _element_kind(element_type)
+            value = getattr(message, name)
+            field_expr = '{}.{}'.format(expression, name)
+            column = prefix + name
+            if kind == 'message':
+                if size is None:
+                    self._walk(value, field_expr, column + '.', expressions)
+                elif size >= 0:
+                    for i in range(size):
+                        self._walk(value[i], '{}[{}]'.format(field_expr, i), '{}[{}].'.format(column, i), expressions)
+                else:
+                    self.skipped.append(column)
+            elif size is None:
+                expressions.append(field_expr)
+                self.columns.append(column)
+                self.dtypes.append(DTYPES[element_type] if kind == 'primitive' else str)
+            elif size >= 0:
+                expressions.append('*' + field_expr)
+                self.columns.extend('{}[{}]'.format(column, i) for i in range(size))
+                self.dtypes.extend([DTYPES[element_type] if kind == 'primitive' else str] * size)
+            else:
+                expressions.append('list({})'.format(field_expr))
+                self.columns.append(column)
+                self.dtypes.append(list)
+
+    def to_columns(self, timestamps, rows):
+        """ Transposes rows into {column: array}, 'timestamp' first.
+        Variable-length columns are returned as lists of lists.
+        """
+        columns = {'timestamp': np.asarray(timestamps, dtype=np.int64)}
+        values = list(zip(*rows)) if rows else [()] * len(self.columns)
+        for name, dtype, column in zip(self.columns, self.dtypes, values):
+            if dtype is list:
+                columns[name] = list(column)
+            elif dtype is str:
+                columns[name] = np.asarray(column, dtype=object)
+            else:
+                columns[name] = np.asarray(column, dtype=dtype)
+        return columns
+
+
+def topic_file_name(topic_name, fmt):
+    """ '/sensing/gnss/ublox/fix_velocity' -> 'sensing.gnss.ublox.fix_velocity.parquet' """
+    return topic_name.strip('/').replace('/', '.') + FORMATS[fmt]
+
+
+class _ArrowWriter:
+    """ Writes batches of columns to a Parquet or Arrow IPC file. """
+
+    def __init__(self, path, fmt):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is required for the {} format (pip install pyarrow), '
+                              'or use --format npz'.format(fmt))
+        self.pa = pyarrow
+        self.path = path
+        self.fmt = fmt
+        self.writer = None
+
+    def write(self, columns):
+        table = self.pa.table({name: self.pa.array(values) for name, values in columns.items()})
+        if self.writer is None:
+            if self.fmt == 'parquet':
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                import pyarrow.ipc
+                self.writer = pyarrow.ipc.new_file(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _NpzWriter:
+    """ Collects batches and writes one compressed .npz file. Variable-length
+    columns cannot be stored without pickling and are left out.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.batches = []
+
+    def write(self, columns):
+        # Strings are stored as fixed-width unicode, which np.load reads without pickle
+        self.batches.append({name: values.astype(str) if values.dtype == object else values
+                             for name, values in columns.items() if isinstance(values, np.ndarray)})
+
+    def close(self):
+        if self.batches:
+            names = self.batches[0].keys()
+            np.savez_compressed(self.path, **{name: np.concatenate([batch[name] for batch in self.batches])
+                                              for name in names})
+
+
+def _open_writer(path, fmt):
+    if fmt == 'npz':
+        return _NpzWriter(path)
+    return _ArrowWriter(path, fmt)
+
+
+def export_topic(conn, topic_name, path, fmt='parquet', batch_size=10000, backend='auto', reducer=None):
+    """ Writes one topic to a columnar file, through a Downsampling.Reducer
+    if given. Returns the number of rows written.
+    """
+    deserialize = ROSDeserializer.get_catalog(conn).topic_deserializer(topic_name, backend)
+    flattener = None
+    writer = _open_writer(path, fmt)
+    timestamps = []
+    rows = []
+    count = 0
+    try:
+        for _, _, timestamp, data in ROSDeserializer.iter_messages(conn, topics=[topic_name], batch_size=batch_size):
+            try:
+                message = deserialize(data)
+            except Exception as e:
+                print(f"Failed to deserialize message on topic {topic_name}: {e}")
+                continue
+            if flattener is None:
+                flattener = Flattener(message)
+                if flattener.skipped:
+                    print(f"Skipping variable-length message fields of {topic_name}: {flattener.skipped}")
+            timestamps.append(timestamp)
+            rows.append(flattener.flatten(message))
+            if len(rows) >= batch_size:
+                count += _write(writer, flattener.to_columns(timestamps, rows), reducer, topic_name)
+                timestamps, rows = [], []
+        if rows:
+            count += _write(writer, flattener.to_columns(timestamps, rows), reducer, topic_name)
+        if reducer is not None:
+            rest = reducer.flush()
+            if rest is not None:
+                count += _write(writer, rest, topic_name=topic_name)
+    finally:
+        writer.close()
+    return count
+
+
+def _write(writer, columns, reducer=None, topic_name=None):
+    if reducer is not None:
+        columns = reducer.process(columns)
+    count = len(columns['timestamp'])
+    if not count:
+        return 0
+    metrics = PipelineMetrics.get_metrics()
+    if metrics is None:
+        writer.write(columns)
+    else:
+        start = time.perf_counter()
+        writer.write(columns)
+        metrics.record('export', topic_name, time.perf_counter() - start,
+                       sum(getattr(values, 'nbytes', 0) for values in columns.values()), count)
+    return count
+
+
+def export_columnar(conn, out_dir, topics=None, fmt='parquet', batch_size=10000, backend='auto', reduce_rules=None):
+    """ Writes one columnar file per topic into out_dir, reduced according
+    to the Downsampling rules that match the topic.
+    Returns {topic: (path, rows)}.
+    """
+    catalog = ROSDeserializer.get_catalog(conn)
+    os.makedirs(out_dir, exist_ok=True)
+    written = {}
+    for topic_name in (catalog.names() if topics is None else topics):
+        if topic_name not in catalog:
+            print(f"Topic {topic_name} could not be found.")
+            continue
+        path = os.path.join(out_dir, topic_file_name(topic_name, fmt))
+        reducer = Downsampling.make_reducer(reduce_rules, topic_name)
+        written[topic_name] = (path, export_topic(conn, topic_name, path, fmt, batch_size, backend, reducer))
+    return written
+
+
+def load_topic(path, columns=None):
+    """ Loads a file written by export_columnar as {column: NumPy array}. """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return {name: data[name] for name in (columns or data.files)}
+    import pyarrow
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path, columns=columns)
+    else:
+        import pyarrow.ipc
+        with pyarrow.memory_map(path) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export bag topics to one columnar file per topic.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--metadata", type=str, default="metadata.yaml",
+                        help="Path to metadata.yaml; its topics are exported. Use '' for all topics in the bag.")
+    parser.add_argument("--out_dir", type=str, default="../Scripts/columnar", help="Output directory.")
+    parser.add_argument("--format", type=str, default="parquet", choices=sorted(FORMATS), help="Output format.")
+    parser.add_argument("--batch_size", type=int, default=10000, help="Rows per written batch (row group).")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "cdr", "rclpy"],
+                        help="Deserializer backend.")
+    parser.add_argument("--reduce", type=str, default="",
+                        help="Per-topic reduction rules PATTERN=MODE:PARAM, comma-separated "
+                             "(e.g. 'imu_raw=every:10,/vehicle/status/*=mean:100ms'); see Downsampling.py.")
+    PipelineMetrics.add_metrics_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    PipelineMetrics.metrics_from_args(args)
+    topics = list(ROSDeserializer.parse_metadata_topics(args.metadata)) if args.metadata else None
+    conn, _ = ROSDeserializer.connect(args.bag)
+    written = export_columnar(conn, args.out_dir, topics, args.format, args.batch_size, args.backend,
+                              Downsampling.parse_rules(args.reduce))
+    ROSDeserializer.close(conn)
+    for topic_name, (path, count) in written.items():
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        print(f"{topic_name}: {count} rows -> {path} ({size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Persistent, content-addressed cache of decoded messages.
+
+Entries are keyed by a hash of (backend, message type, serialized blob), so
+the same message found in several bags, splits or storage formats is decoded
+once, and a rewritten bag can never return stale results. Values are the
+pickled decoded messages, stored in a single SQLite file with a size cap and
+least-recently-used eviction.
+
+ROSDeserializer.get_deserializer() (and the TopicCatalog deserializers used by
+the exporters) consult the cache transparently once it is enabled, either
+for every script through environment variables:
+
+    ROSBAG_DECODE_CACHE=/data/decode_cache.db ROSBAG_DECODE_CACHE_MB=2048 python ColumnarExport.py
+
+or in code with ROSDeserializer.set_decode_cache(DecodeCache(path)).
+The cache pays off for the rclpy backend, whose deserialize_message is much
+slower than a lookup; CDRDecoder is usually as fast as reading the cache.
+
+    python DecodeCache.py --cache decode_cache.db --bag sample-rosbag_0.db3  # cold vs warm pass
+    python DecodeCache.py --cache decode_cache.db --stats
+"""
+import argparse
+import atexit
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+# Access times are only rewritten when older than this: LRU order at a one
+# minute resolution, without a write for every hit
+TOUCH_INTERVAL_NS = 60 * 10 ** 9
+
+# The cache created from the environment, see from_environment()
+_environment_cache = None
+
+
+class DecodeCache:
+    """ On-disk map of message hash -> pickled decoded message.
+    New entries and access times are buffered and written every
+    'flush_every' operations; eviction brings the cache back under 90% of
+    max_bytes, least recently used entries first.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, flush_every=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = {}  # key -> value not written yet
+        self._touched = {}  # key -> last use of entries already on disk
+        self._conn = None
+        self._pid = None
+        self._size = 0  # estimate of the total value size, made exact before evicting
+
+    def _connection(self):
+        # A connection must not be shared with forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB NOT NULL, '
+                               'size INTEGER NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS used_idx ON entries (used)')
+            self._conn.commit()
+            self._size = self._total_size()
+        return self._conn
+
+    @staticmethod
+    def key(backend, msg_type, data):
+        return hashlib.blake2b(b'%s\0%s\0%s' % (backend.encode(), msg_type.encode(), data), digest_size=16).digest()
+
+    def get(self, key):
+        """ Returns the pickled value of key, or None. """
+        value = self._pending.get(key)
+        if value is None:
+            row = self._connection().execute('SELECT value, used FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, used = row
+            now = time.time_ns()
+            if now - used > TOUCH_INTERVAL_NS:
+                self._touch(key, now)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._pending[key] = value
+        if len(self._pending) + len(self._touched) >= self.flush_every:
+            self.flush()
+
+    def _touch(self, key, now):
+        self._touched[key] = now
+        if len(self._pending) + len(self._touched) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """ Writes buffered entries and access times, then evicts if needed. """
+        if not self._pending and not self._touched:
+            return
+        conn = self._connection()
+        now = time.time_ns()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)',
+                             ((key, value, len(value), now) for key, value in self._pending.items()))
+            conn.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                             ((used, key) for key, used in self._touched.items()))
+        self._size += sum(len(value) for value in self._pending.values())
+        self._pending.clear()
+        self._touched.clear()
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _total_size(self):
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        conn = self._connection()
+        # Other processes may have added or evicted entries too
+        total = self._size = self._total_size()
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        with conn:
+            while total > target:
+                rows = conn.execute('SELECT key, size FROM entries ORDER BY used LIMIT 1000').fetchall()
+                if not rows:
+                    break
+                removed = []
+                for key, size in rows:
+                    removed.append((key,))
+                    total -= size
+                    if total <= target:
+                        break
+                conn.executemany('DELETE FROM entries WHERE key = ?', removed)
+                self.evictions += len(removed)
+        self._size = total
+
+    def wrap(self, deserialize, msg_type, backend):
+        """ Returns deserialize, answered from the cache when possible. """
+        prefix = b'%s\0%s\0' % (backend.encode(), msg_type.encode())
+        blake2b = hashlib.blake2b
+        loads = pickle.loads
+        dumps = pickle.dumps
+        protocol = pickle.HIGHEST_PROTOCOL
+
+        def cached_deserialize(data):
+            key = blake2b(prefix + data, digest_size=16).digest()
+            value = self.get(key)
+            if value is not None:
+                return loads(value)
+            message = deserialize(data)
+            try:
+                self.put(key, dumps(message, protocol))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                pass  # not picklable: never cached
+            return message
+        return cached_deserialize
+
+    def stats(self):
+        """ Returns the hit/miss counters of this process and the cache size. """
+        self.flush()
+        entries, size = self._connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        self._pending.clear()
+        self._touched.clear()
+        with self._connection() as conn:
+            conn.execute('DELETE FROM entries')
+        self._size = 0
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self.flush()
+            self._conn.close()
+        self._conn = None
+
+
+def from_environment():
+    """ Returns the cache configured by ROSBAG_DECODE_CACHE (path) and
+    ROSBAG_DECODE_CACHE_MB (size cap), or None when it is not set.
+    """
+    global _environment_cache
+    path = os.environ.get('ROSBAG_DECODE_CACHE')
+    if not path:
+        return None
+    if _environment_cache is None or _environment_cache.path != path:
+        max_mb = os.environ.get('ROSBAG_DECODE_CACHE_MB')
+        _environment_cache = DecodeCache(path, int(max_mb) << 20 if max_mb else DEFAULT_MAX_BYTES)
+        atexit.register(_environment_cache.close)
+    return _environment_cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect the decode cache, or time a cold and a warm pass over a bag.")
+    parser.add_argument("--cache", type=str, default="decode_cache.db", help="Path of the cache file.")
+    parser.add_argument("--max_mb", type=int, default=DEFAULT_MAX_BYTES >> 20, help="Size cap of the cache in MB.")
+    parser.add_argument("--bag", type=str, default="", help="Bag (.db3 or .mcap) to decode twice through the cache.")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "cdr", "rclpy"],
+                        help="Deserializer backend.")
+    parser.add_argument("--stats", action="store_true", help="Print the cache statistics.")
+    parser.add_argument("--clear", action="store_true", help="Remove every entry.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache = DecodeCache(args.cache, args.max_mb << 20)
+    if args.clear:
+        cache.clear()
+    if args.bag:
+        import BagStorage
+        import ROSDeserializer
+        with BagStorage.open_storage(args.bag) as storage:
+            for label, enabled in (('uncached', False), ('cold cache', True), ('warm cache', True)):
+                ROSDeserializer.set_decode_cache(cache if enabled else None)
+                deserializers = {}
+                start = time.perf_counter()
+                count = 0
+                for message in storage.iter_messages():
+                    deserialize = deserializers.get(message.topic)
+                    if deserialize is None:
+                        deserialize = deserializers[message.topic] = storage.catalog.topic_deserializer(
+                            message.topic, args.backend)
+                    deserialize(message.data)
+                    count += 1
+                cache.flush()
+                elapsed = time.perf_counter() - start
+                print(f"{label:>10}: {count} messages in {elapsed:.3f} s ({count / elapsed:.0f} msgs/s)")
+            ROSDeserializer.set_decode_cache(None)
+    if args.stats or args.bag:
+        for name, value in cache.stats().items():
+            print(f"{name}: {value}")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Per-topic downsampling and windowed aggregation of columnar batches.
+
+A Reducer cuts the rate of one topic before export or playback. It works on
+batches of columns, {'timestamp': int64 ns array, name: array or list}, as
+produced by ColumnarExport.Flattener.to_columns(), with NumPy operations
+over whole batches instead of a Python filter per message:
+
+    every:N     keep every N-th sample
+    rate:HZ     keep at most HZ samples per second (a kept sample is at least
+                1/HZ s after the previous one)
+    mean:T      one row per time bucket of length T with the mean of every
+    min:T       numeric column (min, max), the last value of other columns,
+    max:T       and the start of the bucket as timestamp
+    last:T      the last sample of every time bucket
+
+Bucket modes hold back the last, possibly incomplete bucket of a batch until
+a later batch (or flush()) completes it. Timestamps must be sorted within a
+topic, which they are in a bag and in ExcelToMQTT's sensor series.
+
+Rules are given per topic as PATTERN=MODE:PARAM, matched (fnmatch) against
+the full topic name or its last component; the first matching rule wins:
+
+    python ColumnarExport.py --bag sample-rosbag_0.db3 --format npz \\
+        --reduce "imu_raw=every:10,/vehicle/status/*=mean:100ms"
+"""
+import fnmatch
+import re
+from collections import namedtuple
+
+import numpy as np
+
+MODES = ('every', 'rate', 'mean', 'min', 'max', 'last')
+BUCKET_MODES = ('mean', 'min', 'max', 'last')
+
+ReduceRule = namedtuple('ReduceRule', ['pattern', 'mode', 'param'])
+
+_DURATION_RE = re.compile(r'^([\d.]+(?:e[-+]?\d+)?)\s*(ns|us|ms|s|min|h)?$')
+_DURATION_UNITS = {'ns': 1, 'us': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'min': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+
+
+def parse_duration(text):
+    """ '100ms', '1.5s', '15min' -> nanoseconds; a bare number is in ms. """
+    match = _DURATION_RE.match(text.strip().lower())
+    if not match:
+        raise ValueError('Invalid duration {!r}'.format(text))
+    return int(round(float(match.group(1)) * _DURATION_UNITS[match.group(2) or 'ms']))
+
+
+def parse_rules(text):
+    """ 'imu_raw=every:10,/vehicle/status/*=mean:100ms' -> [ReduceRule]. """
+    rules = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        pattern, separator, spec = item.rpartition('=')
+        mode, _, param = spec.partition(':')
+        mode = mode.strip()
+        if not separator or mode not in MODES or not param:
+            raise ValueError('Invalid reduce rule {!r}, expected PATTERN=MODE:PARAM with MODE one of {}'.format(
+                item, ', '.join(MODES)))
+        if mode == 'every':
+            param = int(param)
+        elif mode == 'rate':
+            param = float(param)
+        else:
+            param = parse_duration(param)
+        rules.append(ReduceRule(pattern.strip(), mode, param))
+    return rules
+
+
+def make_reducer(rules, topic_name):
+    """ Returns a new Reducer for the first rule matching topic_name, or None. """
+    suffix = topic_name.rstrip('/').split('/')[-1]
+    for rule in rules or ():
+        if fnmatch.fnmatchcase(topic_name, rule.pattern) or fnmatch.fnmatchcase(suffix, rule.pattern):
+            return Reducer(rule.mode, rule.param)
+    return None
+
+
+def _length(columns):
+    return len(columns['timestamp'])
+
+
+def _slice(columns, start, stop):
+    return {name: values[start:stop] for name, values in columns.items()}
+
+
+def _take(columns, index):
+    return {name: values[index] if isinstance(values, np.ndarray) else [values[i] for i in index]
+            for name, values in columns.items()}
+
+
+def _concat(first, second):
+    return {name: np.concatenate([values, second[name]]) if isinstance(values, np.ndarray)
+            else list(values) + list(second[name])
+            for name, values in first.items()}
+
+
+class Reducer:
+    """ Stateful reduction of one topic, fed with consecutive column batches.
+    param is N for 'every', samples per second for 'rate' and the bucket
+    length in nanoseconds for the bucket modes.
+    """
+
+    def __init__(self, mode, param):
+        if mode not in MODES:
+            raise ValueError('Unknown reduce mode {!r}'.format(mode))
+        if param <= 0:
+            raise ValueError('The parameter of {} must be positive'.format(mode))
+        self.mode = mode
+        self.param = param
+        self.rows_in = 0
+        self.rows_out = 0
+        self._count = 0  # every: rows seen
+        self._next_ns = None  # rate: earliest timestamp of the next kept row
+        self._pending = None  # bucket modes: rows of the last bucket seen
+
+    def process(self, columns):
+        """ Returns the reduced columns of the next batch (possibly empty). """
+        timestamps = np.asarray(columns['timestamp'], dtype=np.int64)
+        self.rows_in += len(timestamps)
+        if self.mode == 'every':
+            index = np.flatnonzero(np.arange(self._count, self._count + len(timestamps)) % self.param == 0)
+            self._count += len(timestamps)
+            return self._output(_take(columns, index))
+        if self.mode == 'rate':
+            return self._output(_take(columns, self._rate_index(timestamps)))
+
+        if self._pending is not None:
+            columns = _concat(self._pending, columns)
+            timestamps = np.asarray(columns['timestamp'], dtype=np.int64)
+        if not len(timestamps):
+            return columns
+        # Hold back the last bucket: later rows may still fall into it
+        buckets = timestamps // self.param
+        split = int(np.searchsorted(buckets, buckets[-1]))
+        self._pending = _slice(columns, split, len(timestamps))
+        return self._output(self._aggregate(_slice(columns, 0, split)))
+
+    def pending_start(self):
+        """ Returns the start (ns) of the bucket held back, or None. Rows
+        returned later by process() or flush() are stamped at or after it.
+        """
+        if self._pending is None or not _length(self._pending):
+            return None
+        return int(self._pending['timestamp'][0]) // self.param * self.param
+
+    def advance(self, now_ns):
+        """ Returns the reduced columns of the bucket held back once now_ns,
+        the latest timestamp of the stream the topic is part of, has reached
+        its end (later rows fall into later buckets), else None. A topic that
+        goes quiet thus does not keep its last bucket open.
+        """
+        start = self.pending_start()
+        if start is None or now_ns < start + self.param:
+            return None
+        return self.flush()
+
+    def reduce(self, columns):
+        """ Reduces a complete set of columns (process() and flush()). """
+        reduced = self.process(columns)
+        rest = self.flush()
+        return _concat(reduced, rest) if rest is not None else reduced
+
+    def flush(self):
+        """ Returns the reduced columns of the held back rows, or None. """
+        pending, self._pending = self._pending, None
+        if pending is None or not _length(pending):
+            return None
+        return self._output(self._aggregate(pending))
+
+    def _output(self, columns):
+        self.rows_out += _length(columns)
+        return columns
+
+    def _rate_index(self, timestamps):
+        # Jumps from kept row to kept row: one searchsorted per kept row
+        period = int(round(1e9 / self.param))
+        kept = []
+        i = 0 if self._next_ns is None else int(np.searchsorted(timestamps, self._next_ns))
+        while i < len(timestamps):
+            kept.append(i)
+            self._next_ns = int(timestamps[i]) + period
+            i = int(np.searchsorted(timestamps, self._next_ns))
+        return np.asarray(kept, dtype=np.intp)
+
+    def _aggregate(self, columns):
+        timestamps = np.asarray(columns['timestamp'], dtype=np.int64)
+        if not len(timestamps):
+            return columns
+        buckets = timestamps // self.param
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        lasts = np.concatenate((starts[1:], [len(timestamps)])) - 1
+        if self.mode == 'last':
+            return _take(columns, lasts)
+        result = {}
+        counts = np.diff(np.concatenate((starts, [len(timestamps)])))
+        for name, values in columns.items():
+            if name == 'timestamp':
+                result[name] = buckets[starts] * self.param
+            elif isinstance(values, np.ndarray) and values.dtype.kind in 'iuf':
+                if self.mode == 'mean':
+                    result[name] = np.add.reduceat(values.astype(np.float64), starts) / counts
+                elif self.mode == 'min':
+                    result[name] = np.minimum.reduceat(values, starts)
+                else:
+                    result[name] = np.maximum.reduceat(values, starts)
+            else:
+                # Strings, flags, variable-length fields: last value of the bucket
+                result[name] = values[lasts] if isinstance(values, np.ndarray) else [values[i] for i in lasts]
+        return result
@@ -0,0 +1,197 @@
+"""Incremental, resumable CSV export.
+
+Writes the same (topic, timestamp, message) details.csv as the
+ROSDeserializer.py exporter, but keeps a checkpoint file next to it with the
+last exported rowid and timestamp of every topic of every split. A run only
+decodes the rows past the checkpoint and appends them to the CSV, so
+re-exporting a bag that is still being recorded costs time proportional to
+the new data only.
+
+The CSV is flushed to disk before the checkpoint is atomically replaced, and
+the checkpoint records the CSV size at that point: after an interruption,
+whatever was written past the last checkpoint is truncated away and exported
+again, so the output holds no duplicates and no gaps.
+
+    python IncrementalExport.py --metadata metadata.yaml --csv ../Scripts/details.csv
+    python IncrementalExport.py --bag rosbag2_0.db3 --csv ../Scripts/details.csv  # bag still recording
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import BagReader
+import PipelineMetrics
+import ROSDeserializer
+
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_path(csv_path):
+    return csv_path + '.checkpoint.json'
+
+
+def _new_checkpoint():
+    # splits: split file name -> topic -> {'rowid', 'timestamp', 'rows'}
+    return {'version': CHECKPOINT_VERSION, 'csv_size': 0, 'splits': {}}
+
+
+def load_checkpoint(path):
+    """ Returns the checkpoint saved at path, or an empty one. """
+    if not os.path.isfile(path):
+        return _new_checkpoint()
+    with open(path, 'r') as file:
+        checkpoint = json.load(file)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        print(f"Ignoring checkpoint {path} written by another version")
+        return _new_checkpoint()
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """ Replaces the checkpoint file atomically. """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _iter_new_rows(conn, topic_id, after_id, batch_size=1000, topic_name=None):
+    """ Yields (id, timestamp, data) of a topic with id > after_id, in rowid
+    order: rows are appended in that order, so the last exported rowid is an
+    exact frontier.
+    """
+    metrics = PipelineMetrics.get_metrics()
+    cursor = conn.cursor()
+    try:
+        start = time.perf_counter()
+        cursor.execute('SELECT id, timestamp, data FROM messages WHERE topic_id = ? AND id > ? ORDER BY id',
+                       (topic_id, after_id))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if metrics is not None:
+                metrics.record('read', topic_name or topic_id, time.perf_counter() - start,
+                               sum(len(row[2]) for row in rows), len(rows))
+            yield from rows
+            start = time.perf_counter()
+    finally:
+        cursor.close()
+
+
+def export_incremental(bag_files, csv_path, topics=None, checkpoint_file=None, backend='auto',
+                       checkpoint_every=10000):
+    """ Appends the rows of the given .db3 splits that are past the
+    checkpoint to csv_path. topics is a list of topic names (None for all).
+    Returns the number of rows written by this run.
+    """
+    checkpoint_file = checkpoint_file or checkpoint_path(csv_path)
+    checkpoint = load_checkpoint(checkpoint_file)
+    csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+    if csv_size < checkpoint['csv_size']:
+        print(f"{csv_path} is shorter than its checkpoint, exporting from scratch")
+        checkpoint = _new_checkpoint()
+
+    count = 0
+    metrics = PipelineMetrics.get_metrics()
+    with open(csv_path, 'a+', newline='') as csvfile:
+        # Drop rows written after the last checkpoint (interrupted run)
+        csvfile.truncate(checkpoint['csv_size'])
+        csv_writer = csv.writer(csvfile)
+        if checkpoint['csv_size'] == 0:
+            csv_writer.writerow(["topic", "timestamp", "message"])
+
+        def commit():
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+            checkpoint['csv_size'] = os.fstat(csvfile.fileno()).st_size
+            save_checkpoint(checkpoint_file, checkpoint)
+
+        for bag_file in bag_files:
+            conn, _ = ROSDeserializer.connect(bag_file)
+            catalog = ROSDeserializer.get_catalog(conn)
+            split_state = checkpoint['splits'].setdefault(os.path.basename(bag_file), {})
+            for topic_name in (catalog.names() if topics is None else topics):
+                if topic_name not in catalog:
+                    continue
+                state = split_state.setdefault(topic_name, {'rowid': 0, 'timestamp': None, 'rows': 0})
+                deserialize = catalog.topic_deserializer(topic_name, backend)
+                pending = 0
+                for row_id, timestamp, data in _iter_new_rows(conn, catalog.get(topic_name).id, state['rowid'],
+                                                              topic_name=topic_name):
+                    try:
+                        message = deserialize(data)
+                        if metrics is None:
+                            csv_writer.writerow([topic_name, timestamp, message])
+                        else:
+                            start = time.perf_counter()
+                            text = str(message)
+                            csv_writer.writerow([topic_name, timestamp, text])
+                            metrics.record('export', topic_name, time.perf_counter() - start, len(text))
+                        state['rows'] += 1
+                        count += 1
+                    except Exception as e:
+                        print(f"Failed to deserialize message on topic {topic_name}: {e}")
+                    state['rowid'] = row_id
+                    state['timestamp'] = timestamp
+                    pending += 1
+                    if pending >= checkpoint_every:
+                        commit()
+                        pending = 0
+                if pending:
+                    commit()
+            ROSDeserializer.close(conn)
+        commit()
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Append the new messages of a bag to details.csv, "
+                                                 "resuming from the last checkpoint.")
+    parser.add_argument("--metadata", type=str, default="metadata.yaml",
+                        help="Path to metadata.yaml; its splits and topics are exported.")
+    parser.add_argument("--bag", type=str, default="",
+                        help="Comma-separated .db3 files to export instead of the splits of --metadata "
+                             "(e.g. a bag still being recorded, which has no metadata.yaml yet).")
+    parser.add_argument("--csv", type=str, default="../Scripts/details.csv", help="Path of the CSV file to append to.")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Path of the checkpoint file (default: <csv>.checkpoint.json).")
+    parser.add_argument("--checkpoint_every", type=int, default=10000, help="Rows between two checkpoints.")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "cdr", "rclpy"],
+                        help="Deserializer backend.")
+    parser.add_argument("--reset", action="store_true", help="Discard the checkpoint and export everything again.")
+    PipelineMetrics.add_metrics_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    PipelineMetrics.metrics_from_args(args)
+    checkpoint_file = args.checkpoint or checkpoint_path(args.csv)
+    if args.reset and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    topics = None
+    if args.bag:
+        bag_files = [path.strip() for path in args.bag.split(",") if path.strip()]
+        if os.path.isfile(args.metadata):
+            topics = list(ROSDeserializer.parse_metadata_topics(args.metadata))
+    else:
+        bag = BagReader.BagReader(args.metadata)
+        if bag.storage_identifier not in (None, 'sqlite3'):
+            raise ValueError('Incremental export needs SQLite splits (rowids), not {}'.format(bag.storage_identifier))
+        bag_files = [split.path for split in bag.splits]
+        topics = bag.catalog.names()
+
+    start = time.perf_counter()
+    count = export_incremental(bag_files, args.csv, topics, checkpoint_file, args.backend, args.checkpoint_every)
+    print(f"Appended {count} messages to {args.csv} in {time.perf_counter() - start:.2f} s "
+          f"(checkpoint: {checkpoint_file})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Multi-process decoding of a bag file.
+
+The work is split by topic and, within a topic, into timestamp windows of
+roughly chunk_size messages. Every worker process opens its own read-only
+SQLite connection, decodes its windows and sends the results back, either
+grouped per topic (decode_by_topic) or merged into one stream in global
+timestamp order (decode_merged). export_csv runs the CSV exporter of
+ROSDeserializer.py on the pool.
+
+Returning full message objects to the parent costs about as much as
+decoding them (pickling), so the pool pays off when the workers also do the
+downstream work: formatting (as export_csv does) or reducing messages to the
+fields needed, through the transform argument.
+
+    python ParallelDeserializer.py --bag sample-rosbag_0.db3 --workers 8
+    python ParallelDeserializer.py --bag sample-rosbag_0.db3 --benchmark
+"""
+import argparse
+import csv
+import heapq
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import BagConnection
+import ROSDeserializer
+
+# Read-only connection of the current worker process, see _init_worker()
+_worker_conn = None
+
+
+def open_readonly(bag_path):
+    """ Opens a bag for reading only, so many processes can share it safely. """
+    return BagConnection.open_readonly(bag_path)
+
+
+def _init_worker(bag_path):
+    global _worker_conn
+    _worker_conn = open_readonly(bag_path)
+
+
+def _decode_chunk(task):
+    """ Decodes the messages of one (topic, timestamp window) work unit.
+    Returns a list of (timestamp, topic, message) in timestamp order.
+    """
+    topic_name, msg_type, start_ns, end_ns, backend, transform = task
+    catalog = ROSDeserializer.get_catalog(_worker_conn)
+    deserialize = catalog.get_deserializer(msg_type, backend)
+    results = []
+    for _, _, timestamp, data in ROSDeserializer.iter_messages(_worker_conn, topics=[topic_name],
+                                                              start_ns=start_ns, end_ns=end_ns):
+        try:
+            message = deserialize(data)
+        except Exception as e:
+            print(f"Failed to deserialize message on topic {topic_name}: {e}")
+            continue
+        results.append((timestamp, topic_name, transform(message) if transform else message))
+    return results
+
+
+def plan_chunks(conn, topics=None, chunk_size=2000, start_ns=None, end_ns=None, backend='auto', transform=None):
+    """ Splits the bag into work units. Returns {topic: [task, ...]} where the
+    tasks of a topic cover consecutive timestamp windows, in order.
+    """
+    conn = getattr(conn, 'connection', conn)
+    catalog = ROSDeserializer.get_catalog(conn)
+    cursor = conn.cursor()
+    # Two subqueries: each is a single lookup in timestamp_idx
+    cursor.execute('SELECT (SELECT MIN(timestamp) FROM messages), (SELECT MAX(timestamp) FROM messages)')
+    first_ns, last_ns = cursor.fetchone()
+    cursor.close()
+    if first_ns is None:
+        return {}
+    start_ns = first_ns if start_ns is None else max(start_ns, first_ns)
+    end_ns = last_ns if end_ns is None else min(end_ns, last_ns)
+
+    plan = {}
+    names = catalog.names() if topics is None else [name for name in topics if name in catalog]
+    for topic_name in names:
+        info = catalog.get(topic_name)
+        windows = max(1, -(-catalog.count(topic_name) // chunk_size))
+        step = max(1, (end_ns - start_ns + 1) // windows)
+        tasks = []
+        window_start = start_ns
+        while window_start <= end_ns:
+            window_end = min(window_start + step - 1, end_ns)
+            if end_ns - window_end < step // 2:
+                window_end = end_ns  # fold a small remainder into the last window
+            tasks.append((topic_name, info.type, window_start, window_end, backend, transform))
+            window_start = window_end + 1
+        plan[topic_name] = tasks
+    return plan
+
+
+def _stream_tasks(executor, tasks, prefetch):
+    """ Yields the results of tasks in order, keeping at most 'prefetch'
+    tasks submitted ahead of the consumer.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(_decode_chunk, task))
+        if len(pending) >= prefetch:
+            break
+    while pending:
+        results = pending.popleft().result()
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(executor.submit(_decode_chunk, task))
+        yield from results
+
+
+def decode_by_topic(bag_path, topics=None, workers=None, chunk_size=2000, start_ns=None, end_ns=None,
+                    backend='auto', transform=None):
+    """ Decodes the bag with a pool of 'workers' processes.
+    Returns {topic: [(timestamp, message), ...]}. transform, if given, must be a
+    picklable function applied to each message inside the workers (e.g. to
+    keep only a few fields and make the results cheaper to send back).
+    """
+    conn, _ = ROSDeserializer.connect(bag_path, read_only=True)
+    plan = plan_chunks(conn, topics, chunk_size, start_ns, end_ns, backend, transform)
+    ROSDeserializer.close(conn)
+
+    decoded = {topic_name: [] for topic_name in plan}
+    tasks = [task for topic_tasks in plan.values() for task in topic_tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(bag_path,)) as executor:
+        for results in executor.map(_decode_chunk, tasks):
+            for timestamp, topic_name, message in results:
+                decoded[topic_name].append((timestamp, message))
+    return decoded
+
+
+def decode_merged(bag_path, topics=None, workers=None, chunk_size=2000, start_ns=None, end_ns=None,
+                  backend='auto', transform=None, prefetch=2):
+    """ Decodes the bag with a pool of 'workers' processes and yields
+    (timestamp, topic, message) merged across topics in timestamp order.
+    At most 'prefetch' chunks per topic are decoded ahead of the consumer.
+    """
+    conn, _ = ROSDeserializer.connect(bag_path, read_only=True)
+    plan = plan_chunks(conn, topics, chunk_size, start_ns, end_ns, backend, transform)
+    ROSDeserializer.close(conn)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(bag_path,)) as executor:
+        streams = [_stream_tasks(executor, tasks, prefetch) for tasks in plan.values()]
+        yield from heapq.merge(*streams, key=lambda item: item[0])
+
+
+def export_csv(bag_path, csv_path, topics=None, workers=None, chunk_size=2000, backend='auto'):
+    """ Parallel version of the ROSDeserializer exporter: writes the same
+    (topic, timestamp, message) CSV, topic by topic. The workers also produce
+    the message text, which is the expensive part of the export.
+    Returns the number of rows written.
+    """
+    conn, _ = ROSDeserializer.connect(bag_path, read_only=True)
+    plan = plan_chunks(conn, topics, chunk_size, backend=backend, transform=str)
+    ROSDeserializer.close(conn)
+
+    count = 0
+    tasks = [task for topic_tasks in plan.values() for task in topic_tasks]
+    with open(csv_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["topic", "timestamp", "message"])
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(bag_path,)) as executor:
+            for results in executor.map(_decode_chunk, tasks):
+                csv_writer.writerows((topic_name, timestamp, text) for timestamp, topic_name, text in results)
+                count += len(results)
+    return count
+
+
+def export_csv_serial(bag_path, csv_path, topics=None, backend='auto'):
+    """ Single-process reference for the benchmark (same work as the exporter). """
+    conn, _ = ROSDeserializer.connect(bag_path, read_only=True)
+    catalog = ROSDeserializer.get_catalog(conn)
+    count = 0
+    with open(csv_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["topic", "timestamp", "message"])
+        for topic_name in (catalog.names() if topics is None else topics):
+            if topic_name not in catalog:
+                continue
+            deserialize = catalog.topic_deserializer(topic_name, backend)
+            for _, _, timestamp, data in ROSDeserializer.iter_messages(conn, topics=[topic_name]):
+                csv_writer.writerow([topic_name, timestamp, deserialize(data)])
+                count += 1
+    ROSDeserializer.close(conn)
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Decode a bag file with a pool of worker processes and export it to CSV.")
+    parser.add_argument("--bag", type=str, default="sample-rosbag_0.db3", help="Path to the .db3 bag file.")
+    parser.add_argument("--metadata", type=str, default="metadata.yaml",
+                        help="Path to metadata.yaml; its topics are exported. Use '' for all topics in the bag.")
+    parser.add_argument("--csv", type=str, default="../Scripts/details.csv", help="Path of the CSV file to write.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--chunk_size", type=int, default=2000, help="Approximate number of messages per work unit.")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "cdr", "rclpy"],
+                        help="Deserializer backend.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Report the export speedup curve for 1, 2, 4, ... up to --workers processes "
+                             "(output goes to a temporary file).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    topics = list(ROSDeserializer.parse_metadata_topics(args.metadata)) if args.metadata else None
+
+    if not args.benchmark:
+        start = time.perf_counter()
+        count = export_csv(args.bag, args.csv, topics, args.workers, args.chunk_size, args.backend)
+        print(f"Exported {count} messages to {args.csv} in {time.perf_counter() - start:.2f} s "
+              f"with {args.workers} workers")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'details.csv')
+        start = time.perf_counter()
+        total = export_csv_serial(args.bag, csv_path, topics, args.backend)
+        serial = time.perf_counter() - start
+        print(f"{'workers':>8} {'seconds':>9} {'msgs/s':>10} {'speedup':>8}")
+        print(f"{'serial':>8} {serial:9.3f} {total / serial:10.0f} {1.0:7.2f}x")
+        counts = []
+        workers = 1
+        while workers < args.workers:
+            counts.append(workers)
+            workers *= 2
+        counts.append(args.workers)
+        for workers in counts:
+            start = time.perf_counter()
+            export_csv(args.bag, csv_path, topics, workers, args.chunk_size, args.backend)
+            elapsed = time.perf_counter() - start
+            print(f"{workers:8d} {elapsed:9.3f} {total / elapsed:10.0f} {serial / elapsed:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""Per-stage, per-topic counters and latency histograms of the pipelines.
+
+The readers, exporters and MQTT scripts record what they do in the active
+Metrics object, under one of STAGES and a topic (a sensor name for the
+Excel stage):
+
+    read         rows fetched from SQLite (ROSDeserializer.iter_messages)
+    deserialize  messages decoded by a TopicCatalog deserializer; a decode
+                 that raises is counted as an error
+    export       rows written to CSV (IncrementalExport) or columnar files
+    excel        sensor sheets parsed (ExcelToMQTT)
+    publish      messages handed to paho (MQTTPublisher); failures are errors
+
+Every (stage, topic) keeps message, byte and error counts and a histogram of
+the per-message latency. Metrics are off unless enabled; when off, each
+instrumented loop only tests a local variable against None. Enable them for
+any script through the environment:
+
+    ROSBAG_METRICS_PORT=9464 python IncrementalExport.py        # Prometheus on http://127.0.0.1:9464/metrics
+    ROSBAG_METRICS_JSON=metrics.json ROSBAG_METRICS_INTERVAL=5 python ColumnarExport.py
+
+with the --metrics_port / --metrics_json / --metrics_interval options of the
+scripts, or in code with set_metrics(Metrics()). The HTTP server also serves
+the JSON summary at /metrics.json. A deserializer picks up the metrics that
+are active when it is created, so enable them before opening a bag.
+"""
+import atexit
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+STAGES = ('read', 'deserialize', 'export', 'excel', 'publish')
+
+# Upper bounds (seconds) of the latency histogram buckets, plus +Inf
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The metrics set with set_metrics() or created from the environment
+_metrics = None
+_environment_checked = False
+
+
+class _TopicStats:
+    """ Counters and latency histogram of one (stage, topic). """
+
+    __slots__ = ('count', 'bytes', 'errors', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile of the latency. """
+        observed = sum(self.buckets)
+        if not observed:
+            return None
+        rank = q * observed
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'mean_latency_s': self.seconds / self.count if self.count else None,
+            'p50_latency_s': self.quantile(0.5),
+            'p90_latency_s': self.quantile(0.9),
+            'p99_latency_s': self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """ Thread-safe registry of _TopicStats per (stage, topic). """
+
+    def __init__(self):
+        self.started = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def _get(self, stage, topic):
+        stats = self._stats.get((stage, topic))
+        if stats is None:
+            stats = self._stats[(stage, topic)] = _TopicStats()
+        return stats
+
+    def record(self, stage, topic, seconds, nbytes=0, count=1):
+        """ Records 'count' messages of a topic processed in 'seconds' in total. """
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds / count) if count else 0
+        with self._lock:
+            stats = self._get(stage, topic)
+            stats.count += count
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            stats.buckets[bucket] += count
+
+    def record_batch(self, stage, topics, sizes, seconds):
+        """ Records a batch of messages of mixed topics (one topic and size per
+        message) that took 'seconds' in total, spread evenly over the messages.
+        """
+        if not topics:
+            return
+        per_message = seconds / len(topics)
+        counts = {}
+        for topic, size in zip(topics, sizes):
+            entry = counts.get(topic)
+            if entry is None:
+                counts[topic] = [1, size]
+            else:
+                entry[0] += 1
+                entry[1] += size
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, per_message)
+        with self._lock:
+            for topic, (count, size) in counts.items():
+                stats = self._get(stage, topic)
+                stats.count += count
+                stats.bytes += size
+                stats.seconds += per_message * count
+                stats.buckets[bucket] += count
+
+    def error(self, stage, topic, count=1):
+        with self._lock:
+            self._get(stage, topic).errors += count
+
+    def wrap_deserializer(self, topic, deserialize):
+        """ Returns deserialize, recording every call under ('deserialize', topic). """
+        perf_counter = time.perf_counter
+
+        def timed(data):
+            start = perf_counter()
+            try:
+                message = deserialize(data)
+            except Exception:
+                self.error('deserialize', topic)
+                raise
+            self.record('deserialize', topic, perf_counter() - start, len(data))
+            return message
+        return timed
+
+    def snapshot(self):
+        """ Returns the JSON summary: {'stages': {stage: {topic: counters}}}. """
+        with self._lock:
+            items = sorted(self._stats.items())
+            stages = {}
+            for (stage, topic), stats in items:
+                stages.setdefault(stage, {})[topic] = stats.summary()
+        totals = {stage: {key: sum(entry[key] for entry in topics.values())
+                          for key in ('count', 'bytes', 'errors', 'seconds')}
+                  for stage, topics in stages.items()}
+        return {'time': time.time(), 'uptime_s': time.time() - self.started, 'pid': os.getpid(),
+                'totals': totals, 'stages': stages}
+
+    def to_prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format. """
+        with self._lock:
+            items = sorted((key, (stats.count, stats.bytes, stats.errors, stats.seconds, list(stats.buckets)))
+                           for key, stats in self._stats.items())
+        lines = []
+        for name, kind, help_text, index in (
+                ('rosbag_messages_total', 'counter', 'Messages processed per stage and topic.', 0),
+                ('rosbag_bytes_total', 'counter', 'Bytes processed per stage and topic.', 1),
+                ('rosbag_errors_total', 'counter', 'Failed messages per stage and topic.', 2)):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (stage, topic), values in items:
+                lines.append('{}{{{}}} {}'.format(name, _labels(stage, topic), values[index]))
+        lines.append('# HELP rosbag_latency_seconds Per-message latency per stage and topic.')
+        lines.append('# TYPE rosbag_latency_seconds histogram')
+        for (stage, topic), (count, _, _, seconds, buckets) in items:
+            labels = _labels(stage, topic)
+            cumulative = 0
+            for bound, observed in zip(LATENCY_BUCKETS, buckets):
+                cumulative += observed
+                lines.append('rosbag_latency_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('rosbag_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, cumulative + buckets[-1]))
+            lines.append('rosbag_latency_seconds_sum{{{}}} {}'.format(labels, seconds))
+            lines.append('rosbag_latency_seconds_count{{{}}} {}'.format(labels, cumulative + buckets[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        """ Writes the JSON summary to path ('-' for stderr), atomically. """
+        text = json.dumps(self.snapshot(), indent=2)
+        if path == '-':
+            print(text, file=sys.stderr)
+            return
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(text)
+        os.replace(temporary, path)
+
+    def start_reporter(self, path, interval=10.0):
+        """ Writes the JSON summary to path every 'interval' seconds and at exit. """
+        def report():
+            while not self._stop.wait(interval):
+                self.write_json(path)
+        self._reporter = threading.Thread(target=report, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+        atexit.register(self.write_json, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serves /metrics (Prometheus) and /metrics.json on host:port from a daemon thread. """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                elif self.path.split('?')[0] in ('/', '/metrics'):
+                    body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        return self._server.server_address
+
+    def close(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _labels(stage, topic):
+    topic = str(topic).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'stage="{}",topic="{}"'.format(stage, topic)
+
+
+def set_metrics(metrics):
+    """ Makes 'metrics' (a Metrics, or None to disable) the active metrics. """
+    global _metrics, _environment_checked
+    _metrics = metrics
+    _environment_checked = True
+
+
+def get_metrics():
+    """ Returns the active Metrics, or None when metrics are disabled. On
+    first use, metrics are enabled from ROSBAG_METRICS_PORT /
+    ROSBAG_METRICS_JSON if set.
+    """
+    global _environment_checked
+    if not _environment_checked:
+        _environment_checked = True
+        from_environment()
+    return _metrics
+
+
+def enable(port=None, json_path=None, interval=10.0, host='127.0.0.1'):
+    """ Activates a new Metrics with an HTTP endpoint and/or a periodic JSON summary. """
+    metrics = Metrics()
+    if port is not None:
+        try:
+            address = metrics.serve(port, host)
+            print(f"Metrics on http://{address[0]}:{address[1]}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on {host}:{port}: {e}")
+    if json_path:
+        metrics.start_reporter(json_path, interval)
+    set_metrics(metrics)
+    return metrics
+
+
+def from_environment():
+    """ Enables metrics as configured by ROSBAG_METRICS_PORT,
+    ROSBAG_METRICS_JSON and ROSBAG_METRICS_INTERVAL. Worker processes of a
+    multiprocessing pool keep them off: they would all bind the same port
+    and write the same file.
+    """
+    port = os.environ.get('ROSBAG_METRICS_PORT')
+    json_path = os.environ.get('ROSBAG_METRICS_JSON')
+    if not (port or json_path):
+        return None
+    import multiprocessing
+    if multiprocessing.parent_process() is not None:
+        return None
+    return enable(int(port) if port else None, json_path, float(os.environ.get('ROSBAG_METRICS_INTERVAL', 10)))
+
+
+def add_metrics_args(parser):
+    """
+    Adds the --metrics_port, --metrics_json and --metrics_interval options to a script's argument parser.
+    """
+    parser.add_argument("--metrics_port", type=int, default=None,
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--metrics_json", type=str, default="",
+                        help="Write a JSON metrics summary to this file periodically and at exit ('-' for stderr).")
+    parser.add_argument("--metrics_interval", type=float, default=10.0,
+                        help="Seconds between two JSON metrics summaries.")
+
+
+def metrics_from_args(args):
+    """ Enables metrics if the options of add_metrics_args ask for them, else
+    falls back to the environment. Returns the active Metrics or None.
+    """
+    if args.metrics_port is not None or args.metrics_json:
+        return enable(args.metrics_port, args.metrics_json, args.metrics_interval)
+    return get_metrics()
@@ -1,20 +1,182 @@
 import sqlite3
-from rosidl_runtime_py.utilities import get_message
-from rclpy.serialization import deserialize_message
 import csv
-import yaml
+import time
+from collections import namedtuple
+import BagConnection
+import CDRDecoder
+import DecodeCache
+import PipelineMetrics
 
+# rclpy / rosidl_runtime_py functions, imported by ros_available() the first
+# time a message is deserialized: importing them takes seconds, which tools
+# that only list topics or counts should not pay
+get_message = None
+deserialize_message = None
+_ros_checked = False
 
-def connect(sqlite_file):
-    conn = sqlite3.connect(sqlite_file)
+# One row of the 'messages' table, with the topic id resolved to its name
+BagMessage = namedtuple('BagMessage', ['id', 'topic', 'timestamp', 'data'])
+
+# One row of the 'topics' table plus its message count (None until known)
+TopicInfo = namedtuple('TopicInfo', ['id', 'name', 'type', 'serialization_format', 'offered_qos_profiles', 'count'])
+
+# Catalogs built by get_catalog(), one per open connection
+_catalogs = {}
+
+# DecodeCache set with set_decode_cache(); None falls back to the environment
+_decode_cache = None
+
+
+def ros_available():
+    """ Imports the ROS deserialization functions on first call. Returns True
+    when ROS is installed.
+    """
+    global get_message, deserialize_message, _ros_checked
+    if not _ros_checked:
+        _ros_checked = True
+        try:
+            from rosidl_runtime_py.utilities import get_message
+            from rclpy.serialization import deserialize_message
+        except ImportError:
+            # No ROS installation: only the pure-Python CDR decoder is available
+            pass
+    return deserialize_message is not None
+
+
+def connect(sqlite_file, read_only=False, **options):
+    """ Opens a bag and returns (connection, cursor). With read_only=True the
+    bag is opened read-only and memory-mapped, see BagConnection.open_readonly
+    (which takes the options).
+    """
+    if read_only:
+        conn = BagConnection.open_readonly(sqlite_file, **options)
+    else:
+        conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
     return conn, c
 
 
 def close(conn):
+    _catalogs.pop(conn, None)
     conn.close()
 
 
+class TopicCatalog:
+    """ In-memory index of a bag's topics.
+    Holds name -> TopicInfo and id -> TopicInfo dicts so lookups do not query
+    the database, and memoizes resolved message classes and deserializers.
+    Use get_catalog() to get the (shared) catalog of a connection.
+    """
+
+    def __init__(self, topics, conn=None):
+        self.topics = {}
+        self.by_id = {}
+        for info in topics:
+            self._set(info)  # the last topic with a name wins, as in isTopic
+        self._conn = conn
+        self._message_classes = {}
+        self._deserializers = {}
+
+    @classmethod
+    def from_connection(cls, conn, metadata_path=None):
+        """ Builds the catalog from the 'topics' table. Message counts are
+        taken from metadata.yaml when given, otherwise counted on first use.
+        """
+        conn = getattr(conn, 'connection', conn)
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name, type, serialization_format, offered_qos_profiles FROM topics ORDER BY id')
+        catalog = cls((TopicInfo(*row, None) for row in cursor.fetchall()), conn)
+        cursor.close()
+        if metadata_path is not None:
+            catalog.merge_metadata(metadata_path)
+        return catalog
+
+    def merge_metadata(self, metadata_path):
+        """ Fills in message counts from metadata.yaml. """
+        for name, info in parse_metadata_topics_info(metadata_path).items():
+            if name in self.topics and info['message_count'] is not None:
+                self._set(self.topics[name]._replace(count=info['message_count']))
+
+    def _set(self, info):
+        self.topics[info.name] = info
+        self.by_id[info.id] = info
+
+    def __contains__(self, topic_name):
+        return topic_name in self.topics
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, topic_name):
+        """ Returns the TopicInfo of a topic, or None. """
+        return self.topics.get(topic_name)
+
+    def names(self):
+        return [info.name for info in self.by_id.values()]
+
+    def types(self):
+        return [info.type for info in self.by_id.values()]
+
+    def count(self, topic_name):
+        """ Returns the number of messages of a topic. Counts missing from
+        metadata.yaml are computed for all topics in a single query.
+        """
+        if self.topics[topic_name].count is None:
+            cursor = self._conn.cursor()
+            cursor.execute('SELECT topic_id, COUNT(*) FROM messages GROUP BY topic_id')
+            counts = dict(cursor.fetchall())
+            cursor.close()
+            for info in list(self.by_id.values()):
+                if info.count is None:
+                    self._set(info._replace(count=counts.get(info.id, 0)))
+        return self.topics[topic_name].count
+
+    def get_message_class(self, msg_type):
+        """ Returns the rclpy message class of a type (memoized). """
+        if msg_type not in self._message_classes:
+            if not ros_available():
+                raise ImportError('rosidl_runtime_py is not installed')
+            self._message_classes[msg_type] = get_message(msg_type)
+        return self._message_classes[msg_type]
+
+    def get_deserializer(self, msg_type, backend='auto'):
+        """ Returns the memoized deserializer of a type, see get_deserializer(). """
+        cache = get_decode_cache()
+        key = (msg_type, backend, cache)
+        if key not in self._deserializers:
+            if backend == 'rclpy' or (backend == 'auto' and ros_available()):
+                msg_class = self.get_message_class(msg_type)
+                deserialize = lambda data: deserialize_message(data, msg_class)
+                self._deserializers[key] = cache.wrap(deserialize, msg_type, 'rclpy') if cache else deserialize
+            else:
+                self._deserializers[key] = get_deserializer(msg_type, backend)
+        return self._deserializers[key]
+
+    def topic_deserializer(self, topic_name, backend='auto'):
+        """ Returns the deserializer for the messages of a topic, recording
+        its calls when PipelineMetrics are enabled.
+        """
+        deserialize = self.get_deserializer(self.topics[topic_name].type, backend)
+        metrics = PipelineMetrics.get_metrics()
+        return metrics.wrap_deserializer(topic_name, deserialize) if metrics is not None else deserialize
+
+
+def get_catalog(conn, metadata_path=None):
+    """ Returns the TopicCatalog of a connection (or cursor), building it on
+    first use. The catalog is dropped by close().
+    """
+    conn = getattr(conn, 'connection', conn)
+    catalog = _catalogs.get(conn)
+    if catalog is None:
+        catalog = _catalogs[conn] = TopicCatalog.from_connection(conn, metadata_path)
+    elif metadata_path is not None:
+        catalog.merge_metadata(metadata_path)
+    return catalog
+
+
 def countRows(cursor, table_name, print_out=False):
     """ Returns the total number of rows in the database. """
     cursor.execute('SELECT COUNT(*) FROM {}'.format(table_name))
@@ -55,21 +217,10 @@ def isTopic(cursor, topic_name, print_out=False):
     """ Returns topic_name header if it exists. If it doesn't, returns empty.
         It returns the last topic found with this name.
     """
-    boolIsTopic = False
-    topicFound = []
-
-    # Get all records for 'topics'
-    records = getAllElements(cursor, 'topics', print_out=False)
-
-    # Look for specific 'topic_name' in 'records'
-    for row in records:
-        if (row[1] == topic_name):  # 1 is 'name' TODO
-            boolIsTopic = True
-            topicFound = row
+    topicFound = get_catalog(cursor).get(topic_name) or []
     if print_out:
-        if boolIsTopic:
-            # 1 is 'name', 0 is 'id' TODO
-            print('\nTopic named', topicFound[1], ' exists at id ', topicFound[0], '\n')
+        if topicFound:
+            print('\nTopic named', topicFound.name, ' exists at id ', topicFound.id, '\n')
         else:
             print('\nTopic', topic_name, 'could not be found. \n')
 
@@ -80,7 +231,6 @@ def getAllMessagesInTopic(cursor, topic_name, print_out=False):
     """ Returns all timestamps and messages at that topic.
     There is no deserialization for the BLOB data.
     """
-    count = 0
     timestamps = []
     messages = []
 
@@ -91,32 +241,73 @@ def getAllMessagesInTopic(cursor, topic_name, print_out=False):
     if not topicFound:
         print('Topic', topic_name, 'could not be found. \n')
     else:
-        records = getAllElements(cursor, 'messages', print_out=False)
-
-        # Look for message with the same id from the topic
-        for row in records:
-            if row[1] == topicFound[0]:  # 1 and 0 is 'topic_id' TODO
-                count = count + 1  # count messages for this topic
-                timestamps.append(row[2])  # 2 is for timestamp TODO
-                messages.append(row[3])  # 3 is for all messages
+        # Only this topic's rows are read from the database
+        for message in iter_messages(cursor, topics=[topic_name]):
+            timestamps.append(message.timestamp)
+            messages.append(message.data)
 
         # Print
         if print_out:
-            print('\nThere are ', count, 'messages in ', topicFound[1])
+            print('\nThere are ', len(messages), 'messages in ', topicFound.name)
 
     return timestamps, messages
 
 
+def iter_messages(conn, topics=None, start_ns=None, end_ns=None, batch_size=1000):
+    """ Yields BagMessage(id, topic, timestamp, data) in timestamp order.
+    conn can be a connection or a cursor. topics is an iterable of topic
+    names (None for all topics); start_ns/end_ns bound the timestamps
+    (inclusive). The filters are evaluated by SQLite, which walks timestamp_idx,
+    and rows are fetched batch_size at a time, so memory use stays bounded
+    whatever the size of the bag.
+    """
+    catalog = get_catalog(conn)
+    topic_names = {topic_id: info.name for topic_id, info in catalog.by_id.items()}
+
+    conditions = []
+    params = []
+    if topics is not None:
+        topic_ids = [catalog.topics[name].id for name in set(topics) if name in catalog]
+        if not topic_ids:
+            return
+        conditions.append('topic_id IN ({})'.format(', '.join('?' * len(topic_ids))))
+        params.extend(topic_ids)
+    if start_ns is not None:
+        conditions.append('timestamp >= ?')
+        params.append(start_ns)
+    if end_ns is not None:
+        conditions.append('timestamp <= ?')
+        params.append(end_ns)
+
+    query = 'SELECT id, topic_id, timestamp, data FROM messages'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY timestamp, id'
+
+    conn = getattr(conn, 'connection', conn)  # a cursor knows its connection
+    cursor = conn.cursor()  # own cursor, so callers can keep using theirs
+    metrics = PipelineMetrics.get_metrics()
+    try:
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if metrics is not None:
+                metrics.record_batch('read', [topic_names[row[1]] for row in rows], [len(row[3]) for row in rows],
+                                     time.perf_counter() - start)
+            for row_id, topic_id, timestamp, data in rows:
+                yield BagMessage(row_id, topic_names[topic_id], timestamp, data)
+            start = time.perf_counter()
+    finally:
+        cursor.close()
+
+
 def getAllTopicsNames(cursor, print_out=False):
     """ Returns all topics names.
     """
-    topicNames = []
-    # Get all records for 'topics'
-    records = getAllElements(cursor, 'topics', print_out=False)
-
-    # Save all topics names
-    for row in records:
-        topicNames.append(row[1])  # 1 is for topic name TODO
+    topicNames = get_catalog(cursor).names()
     if print_out:
         print('\nTopics names are:')
         print(topicNames)
@@ -127,13 +318,7 @@ def getAllTopicsNames(cursor, print_out=False):
 def getAllMsgsTypes(cursor, print_out=False):
     """ Returns all messages types.
     """
-    msgsTypes = []
-    # Get all records for 'topics'
-    records = getAllElements(cursor, 'topics', print_out=False)
-
-    # Save all message types
-    for row in records:
-        msgsTypes.append(row[2])  # 2 is for message type TODO
+    msgsTypes = get_catalog(cursor).types()
     if print_out:
         print('\nMessages types are:')
         print(msgsTypes)
@@ -144,23 +329,58 @@ def getAllMsgsTypes(cursor, print_out=False):
 def getMsgType(cursor, topic_name, print_out=False):
     """ Returns the message type of that specific topic.
     """
-    msg_type = []
-    # Get all topics names and all message types
-    topic_names = getAllTopicsNames(cursor, print_out=False)
-    msgs_types = getAllMsgsTypes(cursor, print_out=False)
-
-    # look for topic at the topic_names list, and find its index
-    for index, element in enumerate(topic_names):
-        if element == topic_name:
-            msg_type = msgs_types[index]
+    topic = get_catalog(cursor).get(topic_name)
+    msg_type = topic.type if topic else []
     if print_out:
         print('\nMessage type in', topic_name, 'is', msg_type)
 
     return msg_type
 
 
+def set_decode_cache(cache):
+    """ Makes the deserializers created from now on consult a
+    DecodeCache.DecodeCache (None disables caching).
+    """
+    global _decode_cache
+    _decode_cache = cache
+
+
+def get_decode_cache():
+    """ Returns the active DecodeCache: the one set with set_decode_cache(),
+    else the one configured by the ROSBAG_DECODE_CACHE environment variable.
+    """
+    return _decode_cache or DecodeCache.from_environment()
+
+
+def get_deserializer(msg_type, backend='auto'):
+    """ Returns a function that deserializes one message blob of type msg_type.
+    backend is 'rclpy', 'cdr' (the pure-Python CDRDecoder), 'view' (lazy
+    CDRView.MessageView objects that decode only the fields read) or 'auto',
+    which uses rclpy when ROS is installed and CDRDecoder otherwise.
+    When a decode cache is active, the function consults it first (views are
+    not cached: they cost less to create than a cache lookup).
+    """
+    if backend == 'view':
+        import CDRView
+        return CDRView.get_view_factory(msg_type)
+    if backend == 'auto':
+        backend = 'rclpy' if ros_available() else 'cdr'
+    if backend == 'cdr':
+        deserialize = CDRDecoder.get_decoder(msg_type)
+    elif backend == 'rclpy':
+        if not ros_available():
+            raise ImportError('rclpy is not installed, use the "cdr" backend')
+        msg_class = get_message(msg_type)
+        deserialize = lambda data: deserialize_message(data, msg_class)
+    else:
+        raise ValueError('Unknown deserializer backend: {}'.format(backend))
+    cache = get_decode_cache()
+    return cache.wrap(deserialize, msg_type, backend) if cache else deserialize
+
+
 def parse_metadata_topics(metadata_path):
     """Parse metadata.yaml and return a dict of topic_name: msg_type"""
+    import yaml
     with open(metadata_path, 'r') as file:
         metadata = yaml.safe_load(file)
     topics = metadata['rosbag2_bagfile_information']['topics_with_message_count']
@@ -170,22 +390,39 @@ def parse_metadata_topics(metadata_path):
     }
 
 
+def parse_metadata_topics_info(metadata_path):
+    """Parse metadata.yaml and return a dict of topic_name: topic metadata
+    (type, serialization_format, offered_qos_profiles and message_count)"""
+    import yaml
+    with open(metadata_path, 'r') as file:
+        metadata = yaml.safe_load(file)
+    topics = metadata['rosbag2_bagfile_information']['topics_with_message_count']
+    return {
+        t['topic_metadata']['name']: dict(t['topic_metadata'], message_count=t.get('message_count'))
+        for t in topics
+    }
+
+
 if __name__ == "__main__":
+    import BagReader
 
     # Specify the path for the CSV file
     csv_file_path = '../Scripts/details.csv'
 
-    # path to the bagfile
-    bag_file = 'sample-rosbag_0.db3'
-
-    # path to metadata.yaml
+    # path to metadata.yaml; the bag files are its relative_file_paths
+    # (.db3 or .mcap, see storage_identifier)
     metadata_path = 'metadata.yaml'
 
     # Parse topics/types from metadata.yaml
     type_map = parse_metadata_topics(metadata_path)
 
-    # Connect to the database
-    conn, c = connect(bag_file)
+    # Counters instead of a print per message (see PipelineMetrics for
+    # ROSBAG_METRICS_PORT / ROSBAG_METRICS_JSON)
+    metrics = PipelineMetrics.get_metrics() or PipelineMetrics.enable()
+
+    # Open every split of the bag, read concurrently as one time-ordered stream
+    bag = BagReader.BagReader(metadata_path)
+    catalog = bag.catalog
 
     # Open the CSV file for writing
     with open(csv_file_path, 'w', newline='') as csvfile:
@@ -194,17 +431,22 @@ if __name__ == "__main__":
 
         # Iterate over all topics in the metadata.yaml
         for topic_name, msg_type in type_map.items():
-            # Query all messages for this topic
-            c.execute("SELECT timestamp, data FROM messages WHERE topic_id = (SELECT id FROM topics WHERE name = ?)", (topic_name,))
-            rows = c.fetchall()
-            for timestamp, message in rows:
+            deserialize = metrics.wrap_deserializer(topic_name, catalog.get_deserializer(msg_type))
+            # Stream the messages of this topic in batches
+            for _, _, timestamp, message in bag.iter_messages(topics=[topic_name]):
                 try:
-                    deserialized_msg = deserialize_message(message, get_message(msg_type))
-                    print(f"Topic: {topic_name}, Timestamp: {timestamp}")
-                    print(f"Deserialized Message: {deserialized_msg}")
-                    csv_writer.writerow([topic_name, timestamp, deserialized_msg])
+                    deserialized_msg = deserialize(message)
                 except Exception as e:
                     print(f"Failed to deserialize message on topic {topic_name}: {e}")
-
-    # Close connection to the database
-    close(conn)
\ No newline at end of file
+                    continue
+                start = time.perf_counter()
+                text = str(deserialized_msg)
+                csv_writer.writerow([topic_name, timestamp, text])
+                metrics.record('export', topic_name, time.perf_counter() - start, len(text))
+
+    # Close the bag
+    bag.close()
+    for stage, topics in metrics.snapshot()['stages'].items():
+        for topic_name, stats in topics.items():
+            print(f"{stage:<12} {topic_name}: {stats['count']} messages, {stats['bytes']} bytes, "
+                  f"{stats['errors']} errors")
\ No newline at end of file
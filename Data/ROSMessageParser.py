@@ -1,4 +1,60 @@
 import re
+from operator import attrgetter
+
+import numpy as np
+
+import CDRDecoder
+import CDRView
+
+# Fields returned by the typed extractors: output name -> attribute path in the message
+VELOCITY_FIELDS = {
+    'linear_x': 'twist.twist.linear.x',
+    'linear_y': 'twist.twist.linear.y',
+    'angular_z': 'twist.twist.angular.z',
+}
+NAV_SAT_FIX_FIELDS = {
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'altitude': 'altitude',
+    'status': 'status.status',
+}
+IMU_FIELDS = {
+    'orientation_x': 'orientation.x',
+    'orientation_y': 'orientation.y',
+    'orientation_z': 'orientation.z',
+    'orientation_w': 'orientation.w',
+    'angular_velocity_x': 'angular_velocity.x',
+    'angular_velocity_y': 'angular_velocity.y',
+    'angular_velocity_z': 'angular_velocity.z',
+    'linear_acceleration_x': 'linear_acceleration.x',
+    'linear_acceleration_y': 'linear_acceleration.y',
+    'linear_acceleration_z': 'linear_acceleration.z',
+}
+CONTROL_MODE_FIELDS = {'mode': 'mode'}
+GEAR_FIELDS = {'report': 'report'}
+STEERING_FIELDS = {'steering_tire_angle': 'steering_tire_angle'}
+VELOCITY_REPORT_FIELDS = {
+    'longitudinal_velocity': 'longitudinal_velocity',
+    'lateral_velocity': 'lateral_velocity',
+    'heading_rate': 'heading_rate',
+}
+
+# Default fields per message type, used by extract_batch
+FIELDS_BY_TYPE = {
+    'geometry_msgs/msg/TwistWithCovarianceStamped': VELOCITY_FIELDS,
+    'sensor_msgs/msg/NavSatFix': NAV_SAT_FIX_FIELDS,
+    'sensor_msgs/msg/Imu': IMU_FIELDS,
+    'autoware_vehicle_msgs/msg/ControlModeReport': CONTROL_MODE_FIELDS,
+    'autoware_vehicle_msgs/msg/GearReport': GEAR_FIELDS,
+    'autoware_vehicle_msgs/msg/SteeringReport': STEERING_FIELDS,
+    'autoware_vehicle_msgs/msg/VelocityReport': VELOCITY_REPORT_FIELDS,
+}
+
+# Legacy format: repr of a TwistWithCovarianceStamped as written to details.csv
+_VELOCITY_RE = re.compile(
+    r'linear=geometry_msgs\.msg\.Vector3\(x=([-\d.e+]+), y=([-\d.e+]+), z=[-\d.e+]+\), '
+    r'angular=geometry_msgs\.msg\.Vector3\(x=[-\d.e+]+, y=[-\d.e+]+, z=([-\d.e+]+)\)')
+
 
 def read_message_details(file_path):
     """
@@ -12,8 +68,8 @@ def read_message_details(file_path):
     try:
         with open(file_path, 'r') as file:
             for line in file:
-                if line.strip():  # Ignore empty lines
-                    key, value = line.split(':', 1)
+                key, separator, value = line.partition(':')
+                if separator:  # Ignore empty lines and lines without a key
                     message_details[key.strip()] = value.strip()
     except FileNotFoundError:
         print(f"File not found: {file_path}")
@@ -23,24 +79,122 @@ def read_message_details(file_path):
     return message_details
 
 
+def _as_message(message, msg_type):
+    """
+    Returns a decoded message object; raw CDR bytes are decoded with CDRDecoder.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        if msg_type is None:
+            raise ValueError("msg_type is required to decode raw CDR bytes")
+        return CDRDecoder.get_decoder(msg_type)(bytes(message))
+    return message
+
+
+def extract_fields(message, fields, msg_type=None):
+    """
+    Extracts fields from a decoded message (rclpy or CDRDecoder) or from raw CDR bytes.
+
+    :param message: Message object, or the serialized CDR bytes of the message.
+    :param fields: Dictionary of output name -> attribute path (e.g. 'twist.twist.linear.x').
+    :param msg_type: Message type name, needed when message is raw bytes.
+    :return: Dictionary with the extracted values.
+    """
+    values = attrgetter(*fields.values())(_as_message(message, msg_type))
+    if len(fields) == 1:
+        values = (values,)
+    return dict(zip(fields, values))
+
+
+def extract_velocity(message):
+    """
+    Extracts linear_x, linear_y and angular_z from a geometry_msgs/msg/TwistWithCovarianceStamped.
+    """
+    return extract_fields(message, VELOCITY_FIELDS, 'geometry_msgs/msg/TwistWithCovarianceStamped')
+
+
+def extract_nav_sat_fix(message):
+    """
+    Extracts latitude, longitude, altitude and fix status from a sensor_msgs/msg/NavSatFix.
+    """
+    return extract_fields(message, NAV_SAT_FIX_FIELDS, 'sensor_msgs/msg/NavSatFix')
+
+
+def extract_imu(message):
+    """
+    Extracts orientation, angular velocity and linear acceleration from a sensor_msgs/msg/Imu.
+    """
+    return extract_fields(message, IMU_FIELDS, 'sensor_msgs/msg/Imu')
+
+
+def extract_control_mode(message):
+    """
+    Extracts the mode of an autoware_vehicle_msgs/msg/ControlModeReport.
+    """
+    return extract_fields(message, CONTROL_MODE_FIELDS, 'autoware_vehicle_msgs/msg/ControlModeReport')
+
+
+def extract_gear(message):
+    """
+    Extracts the gear of an autoware_vehicle_msgs/msg/GearReport.
+    """
+    return extract_fields(message, GEAR_FIELDS, 'autoware_vehicle_msgs/msg/GearReport')
+
+
+def extract_steering(message):
+    """
+    Extracts the steering tire angle of an autoware_vehicle_msgs/msg/SteeringReport.
+    """
+    return extract_fields(message, STEERING_FIELDS, 'autoware_vehicle_msgs/msg/SteeringReport')
+
+
+def extract_velocity_report(message):
+    """
+    Extracts the velocities of an autoware_vehicle_msgs/msg/VelocityReport.
+    """
+    return extract_fields(message, VELOCITY_REPORT_FIELDS, 'autoware_vehicle_msgs/msg/VelocityReport')
+
+
+def extract_batch(messages, fields=None, msg_type=None, dtype=np.float64):
+    """
+    Extracts the same fields from many messages in one pass.
+
+    :param messages: List of message objects or of raw CDR bytes (all of the same type).
+    :param fields: Dictionary of output name -> attribute path. Defaults to the
+                   fields of msg_type in FIELDS_BY_TYPE.
+    :param msg_type: Message type name; required for raw bytes or when fields is omitted.
+    :param dtype: NumPy dtype of the returned arrays.
+    :return: Dictionary of output name -> NumPy array with one value per message.
+    """
+    if fields is None:
+        fields = FIELDS_BY_TYPE[CDRDecoder.normalize_type_name(msg_type)]
+    if messages and isinstance(messages[0], (bytes, bytearray, memoryview, CDRView.MessageView)):
+        # Raw bytes are never decoded: the fields are read in bulk at their offsets
+        values = CDRView.columns(messages, list(fields.values()), msg_type or messages[0]._type)
+        return {name: values[path].astype(dtype) for name, path in fields.items()}
+    getter = attrgetter(*fields.values())
+    rows = [getter(message) for message in messages]
+    table = np.array(rows, dtype=dtype).reshape(len(rows), len(fields))
+    return {name: table[:, i] for i, name in enumerate(fields)}
+
 
 def parse_velocity_message(message):
     """
     Parses a velocity message in the format of geometry_msgs.msg.TwistWithCovarianceStamped
     and returns its linear_x, linear_y, and angular_z components.
 
-    :param message: The velocity message string to parse.
+    :param message: The velocity message: a decoded message object, its raw CDR bytes,
+                    or its repr string as written to details.csv.
     :return: A dictionary with parsed velocity components.
     """
     try:
-        linear_x = float(re.search(r'linear=geometry_msgs\.msg\.Vector3\(x=([-\d\.e]+),', message).group(1))
-        linear_y = float(re.search(r'linear=geometry_msgs\.msg\.Vector3\(x=[-\d\.e]+, y=([-\d\.e]+),', message).group(1))
-        angular_z = float(re.search(r'angular=geometry_msgs\.msg\.Vector3\(x=[-\d\.e]+, y=[-\d\.e]+, z=([-\d\.e]+)\)', message).group(1))
+        if not isinstance(message, str):
+            return extract_velocity(message)
+        match = _VELOCITY_RE.search(message)
         return {
-            'linear_x': linear_x,
-            'linear_y': linear_y,
-            'angular_z': angular_z
+            'linear_x': float(match.group(1)),
+            'linear_y': float(match.group(2)),
+            'angular_z': float(match.group(3))
         }
     except Exception as e:
         print(f"Error parsing velocity message: {e}")
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,296 @@
+"""Synthetic rosbag2 bags and sensor workbooks for benchmarks.
+
+The sample bag is 30 s long and the sensor workbook has 1000 rows per sheet,
+far too small to show how the readers, decoders and exporters scale.
+generate_bag() writes a rosbag2 SQLite bag of any size: random but valid CDR
+messages of the types in metadata.yaml (or any type CDRDecoder knows), on
+the given topics and rates, split over several .db3 files with a matching
+metadata.yaml. generate_workbook() writes an Excel file shaped like
+sensor_data_buildings.xlsx with any number of sheets and rows.
+
+A topic is given as NAME:TYPE:HZ[:BYTES]; BYTES pads the first string field
+of the message (e.g. header.frame_id) so that every message has about that
+size. Messages are drawn from a pool of random messages per topic, so
+generating gigabytes costs little more than writing them.
+
+    python SyntheticData.py --out_dir /tmp/synthetic_bag --size_gb 2 --splits 4
+    python SyntheticData.py --out_dir /tmp/synthetic_bag --duration_s 600 \\
+        --topic /sensing/imu/tamagawa/imu_raw:sensor_msgs/msg/Imu:400 \\
+        --topic /sensing/lidar/points:sensor_msgs/msg/NavSatFix:10:65536
+    python SyntheticData.py --excel /tmp/sensors.xlsx --sheets 6 --rows 100000
+"""
+import argparse
+import os
+import struct
+import uuid
+from collections import namedtuple
+
+import numpy as np
+
+import BagWriter
+import CDRDecoder
+
+# One generated topic; size is the padded message size in bytes (None: natural size)
+TopicSpec = namedtuple('TopicSpec', ['name', 'type', 'rate_hz', 'size'])
+
+# The topics of metadata.yaml at typical rates
+DEFAULT_TOPICS = [
+    TopicSpec('/sensing/gnss/ublox/fix_velocity', 'geometry_msgs/msg/TwistWithCovarianceStamped', 10.0, None),
+    TopicSpec('/sensing/gnss/ublox/nav_sat_fix', 'sensor_msgs/msg/NavSatFix', 10.0, None),
+    TopicSpec('/sensing/imu/tamagawa/imu_raw', 'sensor_msgs/msg/Imu', 100.0, None),
+    TopicSpec('/vehicle/status/control_mode', 'autoware_vehicle_msgs/msg/ControlModeReport', 30.0, None),
+    TopicSpec('/vehicle/status/gear_status', 'autoware_vehicle_msgs/msg/GearReport', 30.0, None),
+    TopicSpec('/vehicle/status/steering_status', 'autoware_vehicle_msgs/msg/SteeringReport', 30.0, None),
+    TopicSpec('/vehicle/status/velocity_status', 'autoware_vehicle_msgs/msg/VelocityReport', 30.0, None),
+]
+
+SENSOR_TYPES = ('temperature', 'humidity', 'occupancy')
+
+CDR_HEADER = b'\x00\x01\x00\x00'  # little-endian CDR encapsulation
+
+
+def parse_topic_spec(text):
+    """ 'NAME:TYPE:HZ[:BYTES]' -> TopicSpec. """
+    parts = text.split(':')
+    if len(parts) not in (3, 4):
+        raise ValueError('Invalid topic {!r}, expected NAME:TYPE:HZ[:BYTES]'.format(text))
+    size = int(parts[3]) if len(parts) == 4 else None
+    return TopicSpec(parts[0], CDRDecoder.normalize_type_name(parts[1]), float(parts[2]), size)
+
+
+class _CDRWriter:
+    """ Little-endian CDR serialization of plain values (the inverse of CDRDecoder). """
+
+    def __init__(self):
+        self.buffer = bytearray(CDR_HEADER)
+
+    def align(self, size):
+        # Alignment is relative to the end of the encapsulation header
+        self.buffer += b'\x00' * (-(len(self.buffer) - len(CDR_HEADER)) % size)
+
+    def primitive(self, ros_type, value):
+        code, size = CDRDecoder.PRIMITIVES[ros_type]
+        self.align(size)
+        self.buffer += struct.pack('<' + code, value)
+
+    def string(self, value):
+        data = value.encode('utf-8') + b'\x00'
+        self.primitive('uint32', len(data))
+        self.buffer += data
+
+
+def encode_message(msg_type, values, registry=None):
+    """ Serializes values ({field: value}, nested dicts for messages) to a CDR blob. """
+    writer = _CDRWriter()
+    _encode(writer, registry or CDRDecoder.default_registry, msg_type, values)
+    return bytes(writer.buffer)
+
+
+def _encode(writer, registry, msg_type, values):
+    for field in registry.get_fields(msg_type):
+        value = values[field.name]
+        items = [value] if field.array is None else value
+        if field.array == -1:
+            writer.primitive('uint32', len(items))
+        for item in items:
+            if field.kind == 'primitive':
+                writer.primitive(field.type, item)
+            elif field.kind == 'string':
+                writer.string(item)
+            else:
+                _encode(writer, registry, field.type, item)
+
+
+def _random_primitive(ros_type, rng):
+    if ros_type in ('float32', 'float64'):
+        value = float(rng.normal(0.0, 100.0))
+        return float(np.float32(value)) if ros_type == 'float32' else value
+    if ros_type == 'bool':
+        return bool(rng.integers(2))
+    code, size = CDRDecoder.PRIMITIVES[ros_type]
+    bits = min(8 * size, 63)  # 64-bit values stay within what rng.integers can draw
+    if code.islower():
+        return int(rng.integers(-2 ** (bits - 1), 2 ** (bits - 1)))
+    return int(rng.integers(0, 2 ** bits))
+
+
+def random_message(msg_type, rng, registry=None, padding=0):
+    """ Returns random values of a message type; the first string field
+    gets 'padding' characters.
+    """
+    state = {'padding': padding}
+    return _random_values(registry or CDRDecoder.default_registry, msg_type, rng, state)
+
+
+def _random_values(registry, msg_type, rng, state):
+    values = {}
+    for field in registry.get_fields(msg_type):
+        if field.array is None:
+            count = None
+        else:
+            count = field.array if field.array >= 0 else int(rng.integers(0, 6))
+        items = []
+        for _ in range(1 if count is None else count):
+            if field.kind == 'primitive':
+                items.append(_random_primitive(field.type, rng))
+            elif field.kind == 'string':
+                padding, state['padding'] = state['padding'], 0
+                items.append('frame_{}'.format(int(rng.integers(1000))) + 'x' * padding)
+            else:
+                items.append(_random_values(registry, field.type, rng, state))
+        values[field.name] = items[0] if count is None else items
+    return values
+
+
+def message_pool(spec, rng, count=256, registry=None):
+    """ Returns 'count' random CDR blobs of a topic, padded to spec.size when given.
+    Types without a string field cannot be padded and keep their natural size.
+    """
+    pool = []
+    for _ in range(count):
+        blob = encode_message(spec.type, random_message(spec.type, rng, registry), registry)
+        if spec.size and spec.size > len(blob):
+            padded = encode_message(spec.type, random_message(spec.type, rng, registry, spec.size - len(blob)),
+                                    registry)
+            if len(padded) > len(blob):
+                blob = padded
+        pool.append(blob)
+    return pool
+
+
+def _topic_timestamps(spec, start_ns, end_ns, rng, jitter):
+    """ Timestamps of one topic in [start_ns, end_ns) at spec.rate_hz, with
+    up to +-jitter/2 periods of noise.
+    """
+    period = 1e9 / spec.rate_hz
+    # Phase of the first sample so that consecutive windows continue the same grid
+    first = int(np.ceil(start_ns / period))
+    last = int(np.ceil(end_ns / period))
+    timestamps = np.arange(first, last, dtype=np.float64) * period
+    if jitter:
+        timestamps += rng.uniform(-jitter / 2, jitter / 2, len(timestamps)) * period
+    return np.clip(timestamps.astype(np.int64), start_ns, end_ns - 1)
+
+
+def generate_bag(out_dir, topics=None, duration_s=None, size_gb=None, splits=1, start_ns=None, seed=0,
+                 pool_size=256, chunk_s=10.0, jitter=0.1, name=None, log=print):
+    """ Writes a synthetic rosbag2 SQLite bag into out_dir and returns the
+    path of its metadata.yaml. The length of the recording is duration_s, or
+    is derived from size_gb (payload bytes) and the topic rates.
+    """
+    topics = list(topics or DEFAULT_TOPICS)
+    rng = np.random.default_rng(seed)
+    pools = [message_pool(spec, rng, pool_size) for spec in topics]
+    if duration_s is None:
+        if size_gb is None:
+            raise ValueError('Either duration_s or size_gb is required')
+        bytes_per_s = sum(spec.rate_hz * np.mean([len(blob) for blob in pool]) for spec, pool in zip(topics, pools))
+        duration_s = size_gb * 1e9 / bytes_per_s
+    if start_ns is None:
+        start_ns = 1614315746338218272  # start of the sample bag
+    end_ns = start_ns + int(duration_s * 1e9)
+    os.makedirs(out_dir, exist_ok=True)
+    name = name or os.path.basename(os.path.normpath(out_dir))
+
+    writers = []
+    bounds = np.linspace(start_ns, end_ns, splits + 1).astype(np.int64)
+    chunk_ns = int(chunk_s * 1e9)
+    offsets = [0] * len(topics)  # next blob of each pool
+    for index in range(splits):
+        writer = BagWriter.SqliteBagWriter(os.path.join(out_dir, '{}_{}.db3'.format(name, index)), overwrite=True)
+        topic_ids = np.array([writer.add_topic(spec.name, spec.type) for spec in topics], dtype=np.int64)
+        for window_start in range(int(bounds[index]), int(bounds[index + 1]), chunk_ns):
+            window_end = min(window_start + chunk_ns, int(bounds[index + 1]))
+            writer.write(_window_rows(topics, pools, offsets, topic_ids, window_start, window_end, rng, jitter))
+        writer.close()
+        writers.append(writer)
+        log(f"{writer.path}: {writer.message_count} messages, {os.path.getsize(writer.path) / 1e6:.1f} MB")
+    return BagWriter.write_metadata(out_dir, writers)
+
+
+def _window_rows(topics, pools, offsets, topic_ids, start_ns, end_ns, rng, jitter):
+    """ Yields the (topic_id, timestamp, blob) rows of all topics in one time window, in timestamp order. """
+    timestamps, owners = [], []
+    for position, spec in enumerate(topics):
+        topic_timestamps = _topic_timestamps(spec, start_ns, end_ns, rng, jitter)
+        timestamps.append(topic_timestamps)
+        owners.append(np.full(len(topic_timestamps), position, dtype=np.int64))
+    timestamps = np.concatenate(timestamps)
+    owners = np.concatenate(owners)
+    order = np.argsort(timestamps, kind='stable')
+    for timestamp, position in zip(timestamps[order].tolist(), owners[order].tolist()):
+        pool = pools[position]
+        blob = pool[offsets[position] % len(pool)]
+        offsets[position] += 1
+        yield int(topic_ids[position]), timestamp, blob
+
+
+def generate_workbook(path, sheets_per_type=2, rows=1000, seed=0, start=None, interval_s=900.0):
+    """ Writes an Excel workbook shaped like sensor_data_buildings.xlsx:
+    sheets <type>_sensor_<n> for every sensor type with 'rows' readings each.
+    Returns the list of sheet names.
+    """
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start or '2025-03-08T21:30:00')
+    names = []
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        for sensor_type in SENSOR_TYPES:
+            for number in range(1, sheets_per_type + 1):
+                name = '{}_sensor_{}'.format(sensor_type, number)
+                event = start + pd.to_timedelta(np.cumsum(rng.uniform(0.5, 1.5, rows) * interval_s), unit='s')
+                event = event.floor('s')
+                arrival = event + pd.to_timedelta(rng.uniform(1, 20, rows), unit='s')
+                frame = {
+                    'event_date': event.normalize(),
+                    'event_time': event.strftime('%Y-%m-%dT%H:%M:%S.000'),
+                    'event_timestamp': event.asi8 // 10 ** 6,
+                    'space_id': [str(uuid.UUID(int=int(value))) for value in rng.integers(0, 2 ** 63, rows)],
+                }
+                if sensor_type == 'temperature':
+                    frame['temperature'] = np.round(rng.normal(21.0, 1.5, rows), 2)
+                elif sensor_type == 'humidity':
+                    frame['unit'] = 'percentage'
+                    frame['humidity'] = np.round(rng.uniform(20.0, 70.0, rows), 2)
+                else:
+                    frame['occupancy'] = np.where(rng.random(rows) < 0.3, 'occupied', 'unoccupied')
+                frame['arrival_date'] = arrival.normalize()
+                frame['arrival_time'] = arrival.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3]
+                pd.DataFrame(frame).to_excel(writer, sheet_name=name, index=False)
+                names.append(name)
+    return names
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic rosbag2 bag and/or sensor workbook.")
+    parser.add_argument("--out_dir", type=str, default="", help="Bag directory to write (metadata.yaml + .db3 splits).")
+    parser.add_argument("--topic", type=str, action="append", default=[],
+                        help="Topic as NAME:TYPE:HZ[:BYTES], repeatable. Default: the topics of metadata.yaml.")
+    parser.add_argument("--duration_s", type=float, default=None, help="Recording length in seconds.")
+    parser.add_argument("--size_gb", type=float, default=None,
+                        help="Total message payload in GB (sets the length from the topic rates).")
+    parser.add_argument("--splits", type=int, default=1, help="Number of .db3 files.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--excel", type=str, default="", help="Excel workbook to write.")
+    parser.add_argument("--sheets", type=int, default=2, help="Sheets per sensor type in the workbook.")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows per sheet in the workbook.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.out_dir and not args.excel:
+        print("Nothing to do: pass --out_dir and/or --excel.")
+        return
+    if args.out_dir:
+        topics = [parse_topic_spec(text) for text in args.topic] or None
+        duration_s = args.duration_s if args.duration_s is not None or args.size_gb is not None else 60.0
+        metadata = generate_bag(args.out_dir, topics, duration_s, args.size_gb, args.splits, seed=args.seed)
+        print(f"Wrote {metadata}")
+    if args.excel:
+        names = generate_workbook(args.excel, args.sheets, args.rows, args.seed)
+        print(f"Wrote {len(names)} sheets of {args.rows} rows to {args.excel}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""Streams a bag straight to MQTT on its recorded timeline.
+
+Instead of exporting details.csv with ROSDeserializer.py and replaying it with
+MQTTMessagePlayback.py, the bridge reads the bag (.db3, .mcap, or every split
+of a bag through its metadata.yaml), decodes the messages and publishes them
+at their recorded times, scaled by --speedup. Topics are mapped with
+MQTTMessagePlayback.transform_topic.
+
+Reading, decoding and publishing run as a pipeline of three stages connected
+by bounded queues of small batches, so publishing starts as soon as the first
+batch is decoded and memory stays flat whatever the size of the bag.
+
+    python BagToMQTT.py --bag ../Data/metadata.yaml --speedup 2
+    python BagToMQTT.py --bag ../Data/sample-rosbag_0.db3 --topics imu_raw,fix_velocity --loop
+    python BagToMQTT.py --bag ../Data/metadata.yaml --encoding cbor --batch_ms 100  # see PayloadEncoding.py
+"""
+import argparse
+import heapq
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+
+import numpy as np
+
+import BagReader
+import BagStorage
+import ColumnarExport
+import Downsampling
+import PipelineMetrics
+from MQTTMessagePlayback import connect_mqtt, transform_topic
+from MQTTPublisher import MQTTPublisher, add_publisher_args
+from PayloadEncoding import PayloadEncoder, add_encoding_args, encoder_from_args
+from PlaybackScheduler import PlaybackScheduler
+
+# End of stream marker passed between the pipeline stages
+_DONE = object()
+
+
+def open_bag(path):
+    """
+    Opens a bag: a bag directory or metadata.yaml (all splits), or a single .db3/.mcap file.
+    """
+    if os.path.isdir(path) or path.endswith(('.yaml', '.yml')):
+        return BagReader.BagReader(path)
+    return BagStorage.open_storage(path)
+
+
+def _put(output, item, stop):
+    """
+    Puts item in a bounded queue, giving up when the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_stage(path, topics, start_ns, end_ns, batch_size, output, stop):
+    # The bag is opened in this thread: SQLite connections belong to their thread
+    try:
+        with open_bag(path) as bag:
+            batch = []
+            for message in bag.iter_messages(topics, start_ns, end_ns, batch_size):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    if not _put(output, batch, stop):
+                        return
+                    batch = []
+            if batch and not _put(output, batch, stop):
+                return
+        _put(output, _DONE, stop)
+    except Exception as e:
+        _put(output, e, stop)
+
+
+class _TopicReduction:
+    """
+    Downsampling of the messages of one topic in the decode stage. Selecting
+    modes (every, rate, last) pick rows on the timestamps before decoding, so
+    dropped messages are never decoded; aggregating modes (mean, min, max)
+    flatten the decoded messages into columns and publish one dict per bucket.
+    """
+
+    def __init__(self, topic_name, reducer, deserialize):
+        self.topic_name = topic_name
+        self.reducer = reducer
+        self.deserialize = deserialize
+        self.aggregates = reducer.mode not in ('every', 'rate', 'last')
+        self.flattener = None
+
+    def process(self, timestamps, blobs):
+        """
+        Returns the kept (timestamp, message or None, data) of a batch of the topic.
+        """
+        if not self.aggregates:
+            columns = {'timestamp': np.asarray(timestamps, dtype=np.int64), 'data': blobs}
+            return self._rows(self.reducer.process(columns))
+        messages = []
+        kept_timestamps = []
+        for timestamp, data in zip(timestamps, blobs):
+            try:
+                messages.append(self.deserialize(data))
+                kept_timestamps.append(timestamp)
+            except Exception as e:
+                print(f"Failed to deserialize message on topic {self.topic_name}: {e}")
+        if not messages:
+            return []
+        if self.flattener is None:
+            self.flattener = ColumnarExport.Flattener(messages[0])
+        rows = [self.flattener.flatten(message) for message in messages]
+        return self._rows(self.reducer.process(self.flattener.to_columns(kept_timestamps, rows)))
+
+    def flush(self):
+        columns = self.reducer.flush()
+        return self._rows(columns) if columns is not None else []
+
+    def advance(self, now_ns):
+        """
+        Returns the rows of the bucket held back if now_ns has passed its end.
+        """
+        columns = self.reducer.advance(now_ns)
+        return self._rows(columns) if columns is not None else []
+
+    def _rows(self, columns):
+        timestamps = columns['timestamp'].tolist()
+        if not self.aggregates:
+            return [(timestamp, None, data) for timestamp, data in zip(timestamps, columns['data'])]
+        names = [name for name in columns if name != 'timestamp']
+        values = [columns[name].tolist() if isinstance(columns[name], np.ndarray) else columns[name]
+                  for name in names]
+        return [(timestamp, dict(zip(names, row)), None) for timestamp, row in zip(timestamps, zip(*values))]
+
+
+def _decode_stage(catalog, backend, encoder, source, output, stop, reduce_rules=None):
+    deserializers = {}
+    reductions = {}  # topic -> _TopicReduction, or None when no rule matches
+    held = []  # heap of reduced (timestamp, sequence, topic, message, data) not released yet
+    bucket_lengths = {rule.param for rule in reduce_rules or () if rule.mode in Downsampling.BUCKET_MODES}
+    sequence = itertools.count()
+
+    def get_deserializer(topic_name):
+        deserialize = deserializers.get(topic_name)
+        if deserialize is None:
+            deserialize = deserializers[topic_name] = catalog.topic_deserializer(topic_name, backend)
+        return deserialize
+
+    def encode(decoded, topic_name, timestamp, message, data):
+        try:
+            if message is None and encoder.needs_message:  # raw CDR passthrough skips decoding
+                message = get_deserializer(topic_name)(data)
+            decoded.extend(encoder.add(topic_name, timestamp, message, data))
+        except Exception as e:
+            print(f"Failed to encode message on topic {topic_name}: {e}")
+
+    def reduce(batch):
+        # Group the batch by topic, reduce every topic's columns, release the rows in time order
+        if not batch:
+            return []
+        by_topic = {}
+        for _, topic_name, timestamp, data in batch:
+            timestamps, blobs = by_topic.setdefault(topic_name, ([], []))
+            timestamps.append(timestamp)
+            blobs.append(data)
+        rows = []
+        for topic_name, (timestamps, blobs) in by_topic.items():
+            if topic_name not in reductions:
+                reducer = Downsampling.make_reducer(reduce_rules, topic_name)
+                reductions[topic_name] = (_TopicReduction(topic_name, reducer, get_deserializer(topic_name))
+                                          if reducer is not None else None)
+            reduction = reductions[topic_name]
+            if reduction is None:
+                rows = ((timestamp, None, data) for timestamp, data in zip(timestamps, blobs))
+            else:
+                rows = reduction.process(timestamps, blobs)
+            for timestamp, message, data in rows:
+                heapq.heappush(held, (timestamp, next(sequence), topic_name, message, data))
+        # Later batches start at the last timestamp read, so buckets ending before it are complete
+        # even if their topic has gone quiet. Any later aggregate (of a bucket still open, or of a
+        # topic not seen yet) is stamped at or after the start of the bucket holding that timestamp:
+        # anything older is final. Without this, a bucket completed by the next batch would be
+        # published after newer rows of other topics.
+        last_read = max(row[2] for row in batch)
+        for topic_name, reduction in reductions.items():
+            if reduction is None:
+                continue
+            for timestamp, message, data in reduction.advance(last_read):
+                heapq.heappush(held, (timestamp, next(sequence), topic_name, message, data))
+        return release(min([last_read] + [last_read // length * length for length in bucket_lengths]))
+
+    def release(watermark=None):
+        released = []
+        while held and (watermark is None or held[0][0] <= watermark):
+            timestamp, _, topic_name, message, data = heapq.heappop(held)
+            released.append((timestamp, topic_name, message, data))
+        return released
+
+    try:
+        while not stop.is_set():
+            try:
+                batch = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch is _DONE:
+                # Rows held back by the reducers and incomplete payload batches go out at the end of the stream
+                remaining = []
+                for topic_name, reduction in reductions.items():
+                    if reduction is not None:
+                        for timestamp, message, data in reduction.flush():
+                            heapq.heappush(held, (timestamp, next(sequence), topic_name, message, data))
+                for timestamp, topic_name, message, data in release():
+                    encode(remaining, topic_name, timestamp, message, data)
+                remaining.extend(encoder.flush())
+                if remaining and not _put(output, remaining, stop):
+                    return
+            if batch is _DONE or isinstance(batch, Exception):
+                _put(output, batch, stop)
+                return
+            decoded = []
+            if reduce_rules:
+                for timestamp, topic_name, message, data in reduce(batch):
+                    encode(decoded, topic_name, timestamp, message, data)
+            else:
+                for _, topic_name, timestamp, data in batch:
+                    encode(decoded, topic_name, timestamp, None, data)
+            if not _put(output, decoded, stop):
+                return
+    except Exception as e:
+        # Forwarded like the read stage's errors, so stream_bag raises instead of waiting forever
+        _put(output, e, stop)
+
+
+def stream_bag(path, catalog, topics=None, start_ns=None, end_ns=None, backend='auto', encoder=None,
+               batch_size=256, queue_size=8, reduce_rules=None):
+    """
+    Yields (timestamp, topic, payload) of a bag in timestamp order, read and
+    decoded by two background threads. At most 2 * queue_size batches of
+    batch_size messages are buffered between the stages.
+
+    :param path: Bag to read, see open_bag().
+    :param catalog: TopicCatalog of the bag, used to decode the messages.
+    :param encoder: PayloadEncoder making the payloads (default: text, unbatched).
+    :param reduce_rules: Downsampling rules applied per topic before encoding.
+                         Aggregated rows are stamped with the start of their
+                         bucket and are published once no earlier row can follow.
+    """
+    encoder = encoder or PayloadEncoder()
+    stop = threading.Event()
+    read_queue = queue.Queue(queue_size)
+    decoded_queue = queue.Queue(queue_size)
+    threads = [
+        threading.Thread(target=_read_stage, args=(path, topics, start_ns, end_ns, batch_size, read_queue, stop),
+                         daemon=True),
+        threading.Thread(target=_decode_stage, args=(catalog, backend, encoder, read_queue, decoded_queue, stop,
+                                                             reduce_rules),
+                         daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            try:
+                batch = decoded_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not threads[-1].is_alive() and decoded_queue.empty():
+                    raise RuntimeError('The decode stage stopped before the end of the stream')
+                continue
+            if batch is _DONE:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=1.0)
+
+
+def select_topics(catalog, selection):
+    """
+    Returns the bag topics matching a selection of full topic names or topic
+    suffixes (as accepted by MQTTMessagePlayback.py), or all topics.
+    """
+    if not selection:
+        return catalog.names()
+    return [name for name in catalog.names() if name in selection or name.split("/")[-1] in selection]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stream a bag to MQTT on its recorded timeline.")
+    parser.add_argument("--bag", type=str, default="../Data/metadata.yaml",
+                        help="Bag directory, metadata.yaml, or a single .db3/.mcap file.")
+    parser.add_argument("--topics", type=str, default="",
+                        help="Comma-separated topic names or suffixes (e.g. imu_raw,fix_velocity). Default: all.")
+    parser.add_argument("--speedup", type=float, default=1.0,
+                        help="Speed up factor of the recorded timeline; 0 publishes as fast as possible.")
+    parser.add_argument("--start_s", type=float, default=None, help="Start, in seconds from the start of the bag.")
+    parser.add_argument("--duration_s", type=float, default=None, help="Length of the replayed window in seconds.")
+    parser.add_argument("--loop", action="store_true", help="Loop the replay forever.")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "cdr", "rclpy", "view"],
+                        help="Deserializer backend; 'view' decodes only the fields read (best with --fields).")
+    parser.add_argument("--read_batch", type=int, default=256, help="Messages per batch between the stages.")
+    parser.add_argument("--queue_size", type=int, default=8, help="Batches buffered between two stages.")
+    parser.add_argument("--reduce", type=str, default="",
+                        help="Per-topic downsampling rules PATTERN=MODE:PARAM, comma-separated "
+                             "(e.g. 'imu_raw=every:10,/vehicle/status/*=mean:100ms'); see Data/Downsampling.py.")
+    add_publisher_args(parser)
+    add_encoding_args(parser)
+    PipelineMetrics.add_metrics_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    PipelineMetrics.metrics_from_args(args)
+    if not os.path.exists(args.bag):
+        print(f"ERROR: Bag not found: {args.bag}")
+        sys.exit(1)
+
+    with open_bag(args.bag) as bag:
+        catalog = bag.catalog
+        first_ns, _ = bag.time_bounds()
+    reduce_rules = Downsampling.parse_rules(args.reduce)
+    if args.encoding == "cdr" and any(rule.mode in ("mean", "min", "max") for rule in reduce_rules):
+        print("ERROR: Aggregated (mean/min/max) messages cannot be sent as raw CDR.")
+        sys.exit(1)
+    selection = set(t.strip() for t in args.topics.split(",") if t.strip())
+    topics = select_topics(catalog, selection)
+    if not topics:
+        print("No matching topics in the bag.")
+        sys.exit(1)
+    start_ns = end_ns = None
+    if args.start_s is not None and first_ns is not None:
+        start_ns = first_ns + int(args.start_s * 1e9)
+    if args.duration_s is not None and first_ns is not None:
+        end_ns = (start_ns if start_ns is not None else first_ns) + int(args.duration_s * 1e9)
+
+    client = connect_mqtt()
+    publisher = MQTTPublisher(client, qos=args.qos, max_inflight=args.max_inflight)
+    scheduler = PlaybackScheduler(speedup=args.speedup) if args.speedup > 0 else None
+    mqtt_topics = {name: transform_topic(name) for name in topics}
+
+    try:
+        loop = 0
+        while True:
+            start_time = time.time()
+            if scheduler is not None and loop:
+                scheduler.next_loop()
+            for timestamp, topic_name, payload in stream_bag(args.bag, catalog, topics, start_ns, end_ns, args.backend,
+                                                              encoder_from_args(args), args.read_batch, args.queue_size,
+                                                              reduce_rules):
+                if scheduler is not None:
+                    scheduler.wait(timestamp / 1e9)
+                publisher.publish(mqtt_topics[topic_name], payload)
+            print(f"Completed one cycle in {time.time() - start_time:.2f} seconds.")
+            if scheduler is not None:
+                print(scheduler.stats.report())
+            loop += 1
+            if not args.loop:
+                break
+        publisher.flush(timeout=10)
+    except KeyboardInterrupt:
+        print("Interrupted by user.")
+    print(publisher.report())
+
+    client.loop_stop()
+    client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
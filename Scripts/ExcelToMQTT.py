@@ -6,8 +6,23 @@ import socket
 import sys
 import os
 import argparse
+import hashlib
+import heapq
+import json
 import time
+from collections import namedtuple
 from datetime import datetime
+from operator import itemgetter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+
+import Downsampling
+import PipelineMetrics
+from MQTTPublisher import MQTTPublisher, add_publisher_args, wait_for_connection
+from PayloadEncoding import PayloadEncoder, add_encoding_args, encoder_from_args
+from PlaybackScheduler import PlaybackScheduler
 
 # MQTT Configuration
 BROKER = "mqtt.dtlab.eaisi.tue.nl"
@@ -30,6 +45,12 @@ SENSOR_VALUE_COLUMNS = {
     "humidity": "humidity"
 }
 
+# Parsed sheet: timestamps (int64 ns, sorted) and values as column arrays
+SensorSeries = namedtuple('SensorSeries', ['sensor_type', 'timestamps', 'values'])
+
+# Format of the columnar cache written next to the Excel file
+SIDECAR_VERSION = 1
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Publish sensor data from Excel to MQTT.")
     parser.add_argument(
@@ -55,10 +76,28 @@ def parse_args():
         action="store_true",
         help="Loop the messages after reaching the end of the data."
     )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always parse the Excel file instead of using (and writing) its .cache.npz sidecar."
+    )
+    add_publisher_args(parser)
+    add_encoding_args(parser, encodings=("text", "json", "cbor", "msgpack"))
+    PipelineMetrics.add_metrics_args(parser)
+    parser.add_argument(
+        "--reduce",
+        type=str,
+        default="",
+        help="Per-sensor downsampling rules PATTERN=MODE:PARAM, comma-separated "
+             "(e.g. 'temperature_*=mean:15min,occupancy_*=last:1h'); see Data/Downsampling.py."
+    )
     return parser.parse_args()
 
-def get_excel_sheets(excel_file):
+def get_excel_sheets(excel_file, use_cache=True):
     """Get all sheet names from the Excel file."""
+    cached = load_sidecar(excel_file) if use_cache else None
+    if cached is not None:
+        return cached[0]
     try:
         xls = pd.ExcelFile(excel_file)
         return xls.sheet_names
@@ -119,140 +158,250 @@ def connect_mqtt():
 
         client.connect(BROKER, PORT)
         client.loop_start()
+        if not wait_for_connection(client):
+            print(f"ERROR: The MQTT broker {BROKER}:{PORT} did not acknowledge the connection.")
+            client.loop_stop()
+            sys.exit(1)
         return client
     except Exception as e:
         print(f"ERROR: Could not connect to MQTT broker: {e}")
         sys.exit(1)
 
-def read_sensor_data(excel_file, sensor_names):
-    """Read sensor data from the Excel file and return as dictionary."""
-    sensor_data = {}
-
-    for sensor_name in sensor_names:
+def sidecar_path(excel_file):
+    """Path of the columnar cache written next to the Excel file."""
+    return excel_file + ".cache.npz"
+
+def file_digest(path):
+    """Content hash of a file, used to validate the sidecar when only the mtime changed."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_sidecar(excel_file):
+    """
+    Return (sheet names, {sensor name: SensorSeries or skip message}) from the
+    sidecar of excel_file, or None if there is none or it is out of date.
+    """
+    path = sidecar_path(excel_file)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            if meta.get("version") != SIDECAR_VERSION:
+                return None
+            stat = os.stat(excel_file)
+            if (meta["size"], meta["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+                # Touched or copied: still valid if the content is the same
+                if meta["size"] != stat.st_size or meta["digest"] != file_digest(excel_file):
+                    return None
+            sensors = {}
+            for index, sheet in enumerate(meta["sheets"]):
+                if "skipped" in sheet:
+                    sensors[sheet["name"]] = sheet["skipped"]
+                else:
+                    sensors[sheet["name"]] = SensorSeries(sheet["sensor_type"], npz[f"t{index}"], npz[f"v{index}"])
+            return meta["sheet_names"], sensors
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable cache {path}: {e}")
+        return None
+
+def save_sidecar(excel_file, sheet_names, sensors):
+    """Write the parsed sheets to the sidecar of excel_file (atomically)."""
+    stat = os.stat(excel_file)
+    meta = {"version": SIDECAR_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "digest": file_digest(excel_file), "sheet_names": sheet_names, "sheets": []}
+    arrays = {}
+    for index, (name, series) in enumerate(sensors.items()):
+        if isinstance(series, str):
+            meta["sheets"].append({"name": name, "skipped": series})
+            continue
+        meta["sheets"].append({"name": name, "sensor_type": series.sensor_type})
+        arrays[f"t{index}"] = series.timestamps
+        arrays[f"v{index}"] = series.values
+    path = sidecar_path(excel_file)
+    tmp_path = path + ".tmp.npz"
+    try:
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write cache {path}: {e}")
+
+def get_sensor_type(sensor_name):
+    """Sensor type from the sheet name (temperature by default)."""
+    for key in SENSOR_VALUE_COLUMNS.keys():
+        if key in sensor_name.lower():
+            return key
+    return "temperature"
+
+def _wanted_column(column):
+    # Only the timestamp and value columns are converted
+    column = str(column).lower()
+    return column in ("event_time", "value") or any(key in column for key in SENSOR_VALUE_COLUMNS)
+
+def parse_sheet(sensor_name, df):
+    """
+    Convert one sheet to a SensorSeries, column-wise. Returns a message
+    instead when the sheet has no usable data.
+    """
+    sensor_type = get_sensor_type(sensor_name)
+
+    # Check if the expected value column exists for this sensor type
+    value_column = SENSOR_VALUE_COLUMNS[sensor_type]
+    if value_column not in df.columns:
+        print(f"Warning: Column '{value_column}' not found for sensor {sensor_name}. Looking for alternative columns...")
+        # Try to guess the column, else fall back to a 'value' column
+        value_column = next((col for col in df.columns if SENSOR_VALUE_COLUMNS[sensor_type] in str(col).lower()),
+                            "value")
+
+    # Check that event_time column exists
+    if 'event_time' not in df.columns:
+        return f"Required 'event_time' column not found in sensor {sensor_name}. Skipping."
+    if value_column not in df.columns:
+        return f"No value column found in sensor {sensor_name}. Skipping."
+
+    # event_time is ISO 8601 (e.g. 2025-03-08T21:34:57.000) or already a datetime
+    timestamps = pd.to_datetime(df['event_time'], errors='coerce')
+    valid = timestamps.notna().to_numpy()
+    if not valid.all():
+        print(f"Warning: {len(valid) - valid.sum()} rows without a valid event_time in sensor {sensor_name}. Skipped.")
+    timestamps = timestamps.to_numpy(dtype='datetime64[ns]')[valid].view(np.int64)
+    values = df[value_column].to_numpy()[valid]
+    if values.dtype == object:
+        values = values.astype(str)
+
+    # Sort by timestamp (stable, like the original row order for equal times)
+    order = np.argsort(timestamps, kind='stable')
+    return SensorSeries(sensor_type, timestamps[order], values[order])
+
+def read_sensor_data(excel_file, sensor_names, use_cache=True):
+    """
+    Read sensor data from the Excel file and return a dictionary of sensor
+    name -> SensorSeries. All sheets missing from the sidecar cache are parsed
+    in a single pass over the workbook, and the cache is updated.
+    """
+    cached = load_sidecar(excel_file) if use_cache else None
+    sheet_names, sensors = cached if cached is not None else (None, {})
+    missing = [name for name in sensor_names if name not in sensors]
+
+    if missing:
+        metrics = PipelineMetrics.get_metrics()
+        start = time.perf_counter()
+        frames = {}
+        parse_seconds = {}
         try:
-            # Read the sheet with the sensor name
-            df = pd.read_excel(excel_file, sheet_name=sensor_name)
-
-            # Determine sensor type based on sensor name and available columns
-            sensor_type = "temperature"  # Default
-            for key in SENSOR_VALUE_COLUMNS.keys():
-                if key in sensor_name.lower():
-                    sensor_type = key
-                    break
-
-            # Check if the expected value column exists for this sensor type
-            value_column = SENSOR_VALUE_COLUMNS[sensor_type]
-            if value_column not in df.columns:
-                print(f"Warning: Column '{value_column}' not found for sensor {sensor_name}. Looking for alternative columns...")
-                # Try to guess the column
-                for col in df.columns:
-                    if value_column in col.lower():
-                        value_column = col
-                        break
-
-            # Check that event_time column exists
-            if 'event_time' not in df.columns:
-                print(f"Warning: Required 'event_time' column not found in sensor {sensor_name}. Skipping.")
-                continue
-
-            # Extract required data with timestamp from event_time column only
-            data = []
-            for _, row in df.iterrows():
-                try:
-                    # Get timestamp from event_time column (ISO 8601 format)
-                    if pd.isna(row['event_time']):
-                        print(f"Warning: Missing event_time for a row in sensor {sensor_name}. Skipping row.")
-                        continue
-
-                    # Parse the event_time which is already in ISO 8601 format (e.g. 2025-03-08T21:34:57.000)
-                    timestamp = pd.to_datetime(row['event_time'])
-
-                    # Get the correct value based on sensor type
-                    if value_column in row:
-                        value = row[value_column]
-                    else:
-                        # Fallback to 'value' column if specific column not found
-                        value = row.get('value', None)
-                        if value is None:
-                            print(f"Warning: No value found for row in sensor {sensor_name}. Skipping row.")
-                            continue
-
-                    data.append({
-                        'timestamp': timestamp,
-                        'value': value,
-                        'sensor_type': sensor_type
-                    })
-
-                except Exception as e:
-                    print(f"Error processing row for sensor {sensor_name}: {e}")
-                    continue
-
-            # Sort by timestamp
-            data.sort(key=lambda x: x['timestamp'])
-
-            sensor_data[sensor_name] = data
-            print(f"Loaded {len(data)} data points for sensor {sensor_name} (type: {sensor_type})")
-
+            with pd.ExcelFile(excel_file) as xls:
+                sheet_names = xls.sheet_names
+                for name in missing:
+                    if name in sheet_names:
+                        sheet_start = time.perf_counter()
+                        frames[name] = xls.parse(name, usecols=_wanted_column)
+                        parse_seconds[name] = time.perf_counter() - sheet_start
         except Exception as e:
-            print(f"Error reading data for sensor {sensor_name}: {e}")
+            print(f"Error reading Excel file: {e}")
+            frames = {}
+        for name, df in frames.items():
+            sheet_start = time.perf_counter()
+            try:
+                sensors[name] = parse_sheet(name, df)
+            except Exception as e:
+                print(f"Error reading data for sensor {name}: {e}")
+            if metrics is not None:
+                series = sensors.get(name)
+                if series is None or isinstance(series, str):
+                    metrics.error('excel', name)
+                else:
+                    metrics.record('excel', name, parse_seconds[name] + time.perf_counter() - sheet_start,
+                                   series.timestamps.nbytes + series.values.nbytes, len(series.timestamps))
+        print(f"Parsed {len(frames)} sheets of {excel_file} in {time.perf_counter() - start:.2f} seconds")
+        if use_cache and frames:
+            save_sidecar(excel_file, sheet_names, sensors)
 
+    sensor_data = {}
+    for name in sensor_names:
+        series = sensors.get(name)
+        if series is None:
+            continue
+        if isinstance(series, str):
+            print(f"Warning: {series}")
+            continue
+        sensor_data[name] = series
+        print(f"Loaded {len(series.timestamps)} data points for sensor {name} (type: {series.sensor_type})")
     return sensor_data
 
-def publish_sensor_data(client, sensor_data, speedup=1.0, should_loop=False):
-    """Publish sensor data to MQTT with appropriate timing."""
-    if not sensor_data:
+def reduce_sensor_data(sensor_data, rules):
+    """
+    Downsample or aggregate the sensors matching the Downsampling rules
+    (patterns are matched against the sensor names).
+    """
+    reduced = {}
+    for sensor_name, series in sensor_data.items():
+        reducer = Downsampling.make_reducer(rules, sensor_name)
+        if reducer is None:
+            reduced[sensor_name] = series
+            continue
+        columns = reducer.reduce({'timestamp': series.timestamps, 'value': series.values})
+        reduced[sensor_name] = SensorSeries(series.sensor_type, columns['timestamp'], columns['value'])
+        print(f"Reduced sensor {sensor_name} from {len(series.timestamps)} to {len(columns['timestamp'])} data points "
+              f"({reducer.mode})")
+    return reduced
+
+def _iter_sensor_points(sensor_name, series, chunk_size=1024):
+    """Yield (timestamp, topic, value) of one sensor, converting its arrays chunk by chunk."""
+    topic = f"{TOPIC_PREFIXES[series.sensor_type]}/{sensor_name}"
+    for start in range(0, len(series.timestamps), chunk_size):
+        timestamps = series.timestamps[start:start + chunk_size].tolist()
+        values = series.values[start:start + chunk_size].tolist()
+        for timestamp, value in zip(timestamps, values):
+            yield timestamp, topic, value
+
+def merge_sensor_timelines(sensor_data):
+    """
+    Yield (timestamp in ns, topic, value) of all sensors in timestamp order.
+    The sorted timelines are merged lazily with a heap of one pending point per
+    sensor (ties keep the sensor order), so nothing is copied or sorted up front.
+    """
+    return heapq.merge(*(_iter_sensor_points(name, series) for name, series in sensor_data.items()),
+                       key=itemgetter(0))
+
+def publish_sensor_data(client, sensor_data, speedup=1.0, should_loop=False, qos=0, max_inflight=100, encoder=None):
+    """Publish sensor data to MQTT with appropriate timing, encoded by a PayloadEncoder (default: str of the value)."""
+    if not any(len(series.timestamps) for series in sensor_data.values()):
         print("No sensor data to publish.")
         return
 
-    # First, we'll organize all the data points with their absolute timestamps
-    all_data = []
-    for sensor_name, data_points in sensor_data.items():
-        for point in data_points:
-            all_data.append({
-                'sensor_name': sensor_name,
-                'timestamp': point['timestamp'],
-                'value': point['value'],
-                'sensor_type': point['sensor_type']
-            })
-
-    # Sort all data points by timestamp
-    all_data.sort(key=lambda x: x['timestamp'])
-
+    # Each message is sent at its absolute deadline, so delays do not accumulate
+    scheduler = PlaybackScheduler(speedup=speedup)
+    publisher = MQTTPublisher(client, qos=qos, max_inflight=max_inflight)
+    encoder = encoder or PayloadEncoder()
     while True:
         start_time = time.time()
-        first_timestamp = all_data[0]['timestamp']
-
-        for i, data_point in enumerate(all_data):
-            # Calculate delay until this message should be sent
-            if i > 0:
-                time_diff = data_point['timestamp'] - all_data[i-1]['timestamp']
-                # Convert to seconds if necessary and apply speedup
-                if isinstance(time_diff, (int, float)):
-                    delay = time_diff / speedup
-                else:
-                    # Assume timestamp is datetime
-                    delay = time_diff.total_seconds() / speedup
-
-                if delay > 0:
-                    time.sleep(delay)
-
-            # Publish the message
-            sensor_type = data_point['sensor_type']
-            topic = f"{TOPIC_PREFIXES[sensor_type]}/{data_point['sensor_name']}"
-            message = str(data_point['value'])
-
-            client.publish(topic, payload=message)
-            print(f"Published to {topic}: {message} (timestamp: {data_point['timestamp']})")
-
+        for point_time, sensor_topic, value in merge_sensor_timelines(sensor_data):
+            # Timestamps are in nanoseconds
+            for timestamp, topic, payload in encoder.add(sensor_topic, point_time, value):
+                scheduler.wait(timestamp / 1e9)
+                publisher.publish(topic, payload)
+        # Incomplete batches of the loop
+        for timestamp, topic, payload in encoder.flush():
+            scheduler.wait(timestamp / 1e9)
+            publisher.publish(topic, payload)
         if not should_loop:
             break
-
-        # If looping, wait until all messages have been sent before restarting
         elapsed = time.time() - start_time
         print(f"Completed one cycle in {elapsed:.2f} seconds. Restarting...")
+        print(scheduler.stats.report())
+        print(publisher.progress())
+        scheduler.next_loop()
+
+    publisher.flush(timeout=10)
+    print(scheduler.stats.report())
+    print(publisher.report())
 
 def main():
     args = parse_args()
+    PipelineMetrics.metrics_from_args(args)
 
     # Verify the Excel file exists
     excel_path = os.path.abspath(args.excel_file)
@@ -261,7 +410,7 @@ def main():
         sys.exit(1)
 
     # Get available sheets/sensors
-    sheet_names = get_excel_sheets(excel_path)
+    sheet_names = get_excel_sheets(excel_path, not args.no_cache)
 
     # Either use command line args or prompt interactively
     if args.sensors or args.speedup != 1.0 or args.loop:
@@ -279,10 +428,13 @@ def main():
 
     try:
         # Read sensor data
-        sensor_data = read_sensor_data(excel_path, selected_sensors)
+        sensor_data = read_sensor_data(excel_path, selected_sensors, not args.no_cache)
+        if args.reduce:
+            sensor_data = reduce_sensor_data(sensor_data, Downsampling.parse_rules(args.reduce))
 
         # Publish data
-        publish_sensor_data(client, sensor_data, speedup, should_loop)
+        publish_sensor_data(client, sensor_data, speedup, should_loop, args.qos, args.max_inflight,
+                            encoder_from_args(args))
 
     except KeyboardInterrupt:
         print("Interrupted by user.")
@@ -5,7 +5,12 @@ import socket
 import sys
 import os
 import argparse
-import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data'))
+
+import PipelineMetrics
+from MQTTPublisher import MQTTPublisher, add_publisher_args, wait_for_connection
+from PlaybackScheduler import PlaybackScheduler
 
 BROKER = "mqtt.dtlab.eaisi.tue.nl"
 PORT = 8883
@@ -46,8 +51,38 @@ def parse_args():
         default=0.0,
         help="Interval in seconds between sending messages (default: 0, i.e., as fast as possible)."
     )
+    add_publisher_args(parser)
+    PipelineMetrics.add_metrics_args(parser)
     return parser.parse_args()
 
+def connect_mqtt():
+    """
+    Connects to the MQTT broker and starts the client's network loop.
+
+    :return: The connected paho client. Exits the program if the broker cannot be reached.
+    """
+    try:
+        client = mqtt.Client(protocol=mqtt.MQTTv311)
+        client.username_pw_set(USERNAME, PASSWORD)
+        client.tls_set(ca_certs=TLS_CA_CERTS, cert_reqs=ssl.CERT_NONE)
+        client.tls_insecure_set(True)
+        # Test DNS resolution before connecting
+        try:
+            socket.gethostbyname(BROKER)
+        except socket.gaierror:
+            print(f"ERROR: Could not resolve broker address '{BROKER}'. Please check the broker address.")
+            sys.exit(1)
+        client.connect(BROKER, PORT)
+        client.loop_start()
+        if not wait_for_connection(client):
+            print(f"ERROR: The MQTT broker {BROKER}:{PORT} did not acknowledge the connection.")
+            client.loop_stop()
+            sys.exit(1)
+        return client
+    except Exception as e:
+        print(f"ERROR: Could not connect to MQTT broker: {e}")
+        sys.exit(1)
+
 def get_available_topic_suffixes(csv_path):
     """
     Get available topic suffixes from a CSV file.
@@ -71,6 +106,47 @@ def get_available_topic_suffixes(csv_path):
                 suffixes.add(suffix)
     return sorted(suffixes)
 
+def load_playback_buffer(csv_path, selected_topics=None):
+    """
+    Loads the messages of a CSV file once, for repeated playback.
+
+    The CSV is parsed a single time: the topic and message columns are located
+    from the header, every original topic is transformed (see transform_topic)
+    once and interned, and every message is encoded to bytes up front. Rows of
+    topics that are not selected are dropped here, so a playback loop only
+    publishes.
+
+    :param csv_path: Path to the CSV file with the messages.
+    :type csv_path: str
+    :param selected_topics: Topic suffixes to keep, or None/empty to keep all.
+    :type selected_topics: set[str] | None
+    :return: Two lists of the same length: the MQTT topic and the payload of every message.
+    :rtype: tuple[list[str], list[bytes]]
+    """
+    topics = []
+    payloads = []
+    mqtt_topics = {}  # original topic -> interned MQTT topic, or None when not selected
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        topic_columns = [header.index(name) for name in ("topic", "Topic", "path", "Path") if name in header]
+        message_columns = [header.index(name) for name in ("message", "Message", "data", "Data") if name in header]
+        for row in reader:
+            original_topic = next((row[i] for i in topic_columns if i < len(row) and row[i]), None)
+            message = next((row[i] for i in message_columns if i < len(row) and row[i]), None)
+            if not original_topic or not message:
+                continue
+            if original_topic not in mqtt_topics:
+                topic_suffix = original_topic.strip().split("/")[-1]
+                selected = not selected_topics or topic_suffix in selected_topics
+                mqtt_topics[original_topic] = sys.intern(transform_topic(original_topic)) if selected else None
+            new_topic = mqtt_topics[original_topic]
+            if new_topic is None:
+                continue
+            topics.append(new_topic)
+            payloads.append(message.encode('utf-8'))
+    return topics, payloads
+
 def prompt_for_topics(suffixes):
     """
     Prompts the user to select topics from a list of suffixes, using their indices,
@@ -157,6 +233,7 @@ def main():
     :return: None
     """
     args = parse_args()
+    PipelineMetrics.metrics_from_args(args)
     csv_path = "details.csv"
     if not os.path.isfile(csv_path):
         print(f"ERROR: File '{csv_path}' not found in the current directory: {os.getcwd()}")
@@ -173,41 +250,32 @@ def main():
         interval = args.interval
         loop_count = 1
 
-    try:
-        client = mqtt.Client(protocol=mqtt.MQTTv311)
-        client.username_pw_set(USERNAME, PASSWORD)
-        client.tls_set(ca_certs=TLS_CA_CERTS, cert_reqs=ssl.CERT_NONE)
-        client.tls_insecure_set(True)
-        # Test DNS resolution before connecting
-        try:
-            socket.gethostbyname(BROKER)
-        except socket.gaierror:
-            print(f"ERROR: Could not resolve broker address '{BROKER}'. Please check the broker address.")
-            sys.exit(1)
-        client.connect(BROKER, PORT)
-        client.loop_start()
-    except Exception as e:
-        print(f"ERROR: Could not connect to MQTT broker: {e}")
-        sys.exit(1)
+    client = connect_mqtt()
+
+    # Message k of a loop is due k * interval after the start of the loop,
+    # so publish time does not add up over the replay
+    scheduler = PlaybackScheduler()
+    # Bounded number of unacknowledged messages, progress logged every few seconds
+    publisher = MQTTPublisher(client, qos=args.qos, max_inflight=args.max_inflight)
+
+    # Parse the CSV once; every loop then only publishes from memory
+    topics, payloads = load_playback_buffer(csv_path, selected_topics)
+    print(f"Loaded {len(payloads)} messages ({sum(map(len, payloads))} bytes) "
+          f"on {len(set(topics))} topics from {csv_path}")
+    publish = publisher.publish
 
     def send_messages():
-        with open(csv_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                original_topic = row.get("topic") or row.get("Topic") or row.get("path") or row.get("Path")
-                message = row.get("message") or row.get("Message") or row.get("data") or row.get("Data")
-                if not original_topic or not message:
-                    continue
-                topic_suffix = original_topic.strip().split("/")[-1]
-                if selected_topics and topic_suffix not in selected_topics:
-                    continue
-                new_topic = f"{TOPIC_PREFIX}/{topic_suffix}"
-                client.publish(new_topic, payload=message)
-                print(f"Published to {new_topic}: {message}")
-                if interval > 0:
-                    time.sleep(interval)
+        if interval > 0:
+            for index in range(len(payloads)):
+                scheduler.wait(index * interval)
+                publish(topics[index], payloads[index])
+        else:
+            for topic, payload in zip(topics, payloads):
+                publish(topic, payload)
+        scheduler.next_loop(gap=interval)
 
     try:
+        scheduler.start()
         if loop_count is None:
             print("Looping messages infinitely. Press Ctrl+C to stop.")
             while True:
@@ -216,8 +284,12 @@ def main():
             for i in range(loop_count):
                 print(f"Loop {i+1}/{loop_count}")
                 send_messages()
+        publisher.flush(timeout=10)
     except KeyboardInterrupt:
         print("Interrupted by user.")
+    if interval > 0:
+        print(scheduler.stats.report())
+    print(publisher.report())
 
     client.loop_stop()
     client.disconnect()
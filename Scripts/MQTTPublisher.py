@@ -0,0 +1,206 @@
+"""Publisher layer shared by ExcelToMQTT.py and MQTTMessagePlayback.py.
+
+MQTTPublisher wraps a connected paho client and publishes with a configurable
+QoS while keeping at most 'max_inflight' messages unacknowledged: publish()
+blocks until the broker (QoS 1/2) or the network thread (QoS 0) has taken
+an earlier message, so a fast replay can neither flood paho's queue nor
+outrun the broker. Failed publishes are counted instead of being ignored,
+and progress (messages/sec, in flight, failures) is logged every few
+seconds rather than for every message.
+
+    publisher = MQTTPublisher(client, qos=1, max_inflight=100)
+    for topic, payload in messages:
+        publisher.publish(topic, payload)
+    publisher.flush()
+    print(publisher.report())
+
+Benchmark against a local broker (e.g. mosquitto on localhost):
+
+    python MQTTPublisher.py --benchmark --host localhost --port 1883 --qos 0,1,2 --max_inflight 10,100,1000
+"""
+import argparse
+import itertools
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+try:
+    import PipelineMetrics  # from ../Data, put on sys.path by the scripts
+except ImportError:
+    PipelineMetrics = None
+
+
+class MQTTPublisher:
+    """
+    Publishes through a paho client with a bounded in-flight window.
+
+    :param client: Connected paho client, with its network loop running (loop_start()).
+    :param qos: MQTT QoS of the published messages (0, 1 or 2).
+    :param max_inflight: Maximum number of published messages not yet acknowledged.
+    :param log_interval: Seconds between two progress lines (0 disables them).
+    :param log: Function used to write progress lines.
+    :param metrics: PipelineMetrics.Metrics recording every publish (default: the active metrics, if any).
+    """
+
+    def __init__(self, client, qos=0, max_inflight=100, log_interval=5.0, log=print, metrics=None):
+        if qos not in (0, 1, 2):
+            raise ValueError("qos must be 0, 1 or 2")
+        self.client = client
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.log_interval = log_interval
+        self.log = log
+        self.published = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.bytes = 0
+        if metrics is None and PipelineMetrics is not None:
+            metrics = PipelineMetrics.get_metrics()
+        self.metrics = metrics
+        self._window = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._start = None
+        self._next_log = None
+        # Let paho send as many QoS 1/2 messages as our window allows
+        client.max_inflight_messages_set(max_inflight)
+        self._previous_on_publish = client.on_publish
+        client.on_publish = self._on_publish
+
+    def _on_publish(self, client, userdata, mid, *args):
+        with self._lock:
+            self.acknowledged += 1
+        self._window.release()
+        if self._previous_on_publish is not None:
+            self._previous_on_publish(client, userdata, mid, *args)
+
+    def publish(self, topic, payload):
+        """
+        Publishes one message, blocking while the in-flight window is full.
+
+        :return: True if paho accepted the message.
+        """
+        if self._start is None:
+            self._start = time.monotonic()
+            self._next_log = self._start + self.log_interval
+        if self.metrics is not None:
+            start = time.perf_counter()
+        self._window.acquire()
+        info = self.client.publish(topic, payload=payload, qos=self.qos)
+        self.published += 1
+        self.bytes += len(payload)
+        accepted = info.rc == mqtt.MQTT_ERR_SUCCESS
+        if not accepted and not (info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0):
+            # Dropped: no acknowledgement will ever release the slot
+            # (QoS 1/2 messages published while disconnected are queued and sent on reconnect)
+            self.failed += 1
+            self._window.release()
+            if self.metrics is not None:
+                self.metrics.error('publish', topic)
+        elif self.metrics is not None:
+            self.metrics.record('publish', topic, time.perf_counter() - start, len(payload))
+        if self.log_interval and time.monotonic() >= self._next_log:
+            self._next_log += self.log_interval
+            self.log(self.progress())
+        return accepted
+
+    @property
+    def inflight(self):
+        return self.published - self.acknowledged - self.failed
+
+    def flush(self, timeout=None):
+        """
+        Waits until every published message has been acknowledged.
+
+        :return: True if nothing is left in flight.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.inflight > 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def rate(self):
+        """
+        Returns the acknowledged messages per second since the first publish.
+        """
+        if self._start is None:
+            return 0.0
+        elapsed = time.monotonic() - self._start
+        return self.acknowledged / elapsed if elapsed > 0 else 0.0
+
+    def progress(self):
+        return (f"{self.published} published, {self.acknowledged} acknowledged, {self.inflight} in flight, "
+                f"{self.failed} failed, {self.rate():.0f} msgs/s")
+
+    def report(self):
+        elapsed = time.monotonic() - self._start if self._start is not None else 0.0
+        return (f"Published {self.published} messages ({self.bytes / 1e6:.2f} MB of payload) in {elapsed:.2f} s "
+                f"(QoS {self.qos}): {self.progress()}")
+
+
+def add_publisher_args(parser):
+    """
+    Adds the --qos and --max_inflight options to a script's argument parser.
+    """
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1, 2], help="MQTT QoS of the published messages.")
+    parser.add_argument("--max_inflight", type=int, default=100,
+                        help="Maximum number of messages published but not yet acknowledged.")
+
+
+def wait_for_connection(client, timeout=10.0):
+    """
+    Waits until a client started with connect() + loop_start() is connected.
+    """
+    deadline = time.monotonic() + timeout
+    while not client.is_connected():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark MQTT publish throughput against a broker.")
+    parser.add_argument("--benchmark", action="store_true", help="Run the benchmark.")
+    parser.add_argument("--host", type=str, default="localhost", help="Broker host.")
+    parser.add_argument("--port", type=int, default=1883, help="Broker port (plain TCP).")
+    parser.add_argument("--count", type=int, default=20000, help="Messages per run.")
+    parser.add_argument("--payload_size", type=int, default=200, help="Payload size in bytes.")
+    parser.add_argument("--qos", type=str, default="0,1", help="Comma-separated QoS levels to measure.")
+    parser.add_argument("--max_inflight", type=str, default="1,10,100,1000",
+                        help="Comma-separated in-flight windows to measure.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.benchmark:
+        print("Nothing to do: pass --benchmark to measure publish throughput.")
+        return
+    payload = b"x" * args.payload_size
+    qos_levels = [int(q) for q in args.qos.split(",") if q.strip()]
+    windows = [int(w) for w in args.max_inflight.split(",") if w.strip()]
+    print(f"{'qos':>4} {'window':>7} {'msgs':>8} {'seconds':>8} {'msgs/s':>9} {'failed':>7}")
+    for qos, window in itertools.product(qos_levels, windows):
+        client = mqtt.Client(protocol=mqtt.MQTTv311)
+        client.connect(args.host, args.port)
+        client.loop_start()
+        if not wait_for_connection(client):
+            print(f"ERROR: Could not connect to {args.host}:{args.port}")
+            return
+        publisher = MQTTPublisher(client, qos=qos, max_inflight=window, log_interval=0)
+        start = time.monotonic()
+        for i in range(args.count):
+            publisher.publish(f"benchmark/qos{qos}/{i % 8}", payload)
+        publisher.flush(timeout=60)
+        elapsed = time.monotonic() - start
+        print(f"{qos:4d} {window:7d} {publisher.acknowledged:8d} {elapsed:8.2f} "
+              f"{publisher.acknowledged / elapsed:9.0f} {publisher.failed:7d}")
+        client.loop_stop()
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Payload encodings and batching for the MQTT scripts.
+
+Payloads have so far been the str() of the value or of the decoded message:
+a multi-kilobyte Python repr for messages with covariance arrays. A
+PayloadEncoder turns messages into one of these encodings instead:
+
+    text      str(message), the original format
+    json      the message (or only the selected --fields) as a JSON object
+    cbor      same structure, CBOR encoded (needs cbor2)
+    msgpack   same structure, MessagePack encoded (needs msgpack)
+    cdr       the serialized CDR blob from the bag, passed through undecoded
+
+With --batch_size N and/or --batch_ms T, up to N samples or T milliseconds
+(of recorded time) of a topic are packed into one MQTT message. A text,
+json, cbor or msgpack batch is a map in that encoding (text batches use JSON):
+
+    {"v": 1, "t0": <first timestamp, ns>, "dt": [<offset of each sample, ns>], "samples": [...]}
+
+A cdr batch is binary: the header struct BATCH_HEADER (b'RB', version,
+sample count, first timestamp in ns), then for every sample the struct
+BATCH_SAMPLE (offset from the first timestamp in ns, blob length) followed
+by the blob. decode_batch() reads both forms back.
+
+    encoder = PayloadEncoder('cbor', fields=['twist.twist.linear.x'], batch_size=50)
+    for timestamp, topic, message in messages:
+        for _, topic, payload in encoder.add(topic, timestamp, message):
+            publisher.publish(topic, payload)
+    for _, topic, payload in encoder.flush():
+        publisher.publish(topic, payload)
+"""
+import json
+import struct
+from operator import attrgetter
+
+ENCODINGS = ('text', 'json', 'cbor', 'msgpack', 'cdr')
+
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct('<2sBIq')  # magic, version, sample count, first timestamp (ns)
+BATCH_SAMPLE = struct.Struct('<qI')  # timestamp offset (ns), blob length
+BATCH_MAGIC = b'RB'
+
+
+def to_plain(value, binary=False):
+    """
+    Converts a decoded message (rclpy or CDRDecoder) and its fields to dicts,
+    lists and scalars that JSON, CBOR and MessagePack can encode.
+
+    :param binary: Keep uint8/byte/char arrays and sequences (bytes) as bytes,
+                   for CBOR and MessagePack; otherwise they become lists of ints.
+    """
+    if isinstance(value, dict):
+        return {name: to_plain(item, binary) for name, item in value.items()}
+    if hasattr(value, 'get_fields_and_field_types'):
+        return {name: to_plain(getattr(value, name), binary) for name in value.get_fields_and_field_types()}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value) if binary else list(value)
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item, binary) for item in value]
+    if hasattr(value, 'tolist'):  # NumPy arrays and scalars
+        return value.tolist()
+    return value
+
+
+def get_serializer(encoding):
+    """
+    Returns the function encoding a plain object to bytes for json, cbor or msgpack.
+    """
+    if encoding in ('text', 'json'):
+        return lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    if encoding == 'cbor':
+        try:
+            import cbor2
+        except ImportError:
+            raise ImportError('cbor2 is required for the cbor encoding (pip install cbor2)')
+        return cbor2.dumps
+    if encoding == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('msgpack is required for the msgpack encoding (pip install msgpack)')
+        return msgpack.packb
+    raise ValueError('No serializer for encoding {!r}'.format(encoding))
+
+
+def get_deserializer(encoding):
+    """
+    Returns the function decoding bytes written by get_serializer(encoding).
+    """
+    if encoding in ('text', 'json'):
+        return json.loads
+    if encoding == 'cbor':
+        import cbor2
+        return cbor2.loads
+    if encoding == 'msgpack':
+        import msgpack
+        return msgpack.unpackb
+    raise ValueError('No deserializer for encoding {!r}'.format(encoding))
+
+
+class PayloadEncoder:
+    """
+    Encodes messages to MQTT payloads, optionally batched per topic.
+
+    :param encoding: One of ENCODINGS.
+    :param fields: Attribute paths (e.g. 'twist.twist.linear.x') to keep for
+                   json/cbor/msgpack, instead of the whole message. Messages
+                   of a type with none of these fields are sent whole.
+    :param batch_size: Maximum number of samples per MQTT message (0 for no limit).
+    :param batch_ms: Maximum span of a batch in milliseconds of recorded time
+                     (0 for no limit).
+    """
+
+    def __init__(self, encoding='text', fields=None, batch_size=0, batch_ms=0.0):
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown encoding {!r}, expected one of {}'.format(encoding, ', '.join(ENCODINGS)))
+        if batch_size < 0 or batch_ms < 0:
+            raise ValueError('batch_size and batch_ms must not be negative')
+        self.encoding = encoding
+        self.fields = list(fields) if fields else None
+        self.batch_size = batch_size
+        self.batch_span_ns = int(batch_ms * 1e6)
+        self.batching = batch_size > 1 or batch_ms > 0
+        self.needs_message = encoding != 'cdr'
+        self._serialize = None if encoding == 'cdr' else get_serializer(encoding)
+        self._binary = encoding in ('cbor', 'msgpack')  # encode bytes natively
+        self._getters = {}  # message class -> (fields, getter) of the selected fields it has
+        self._pending = {}  # topic -> ([timestamps], [samples])
+
+    def sample(self, message=None, data=None):
+        """
+        Returns what is encoded for one message: its text, its plain
+        structure (all or selected fields) or its CDR blob.
+        """
+        if self.encoding == 'cdr':
+            if data is None:
+                raise ValueError('The cdr encoding needs the serialized message')
+            return bytes(data)
+        if self.encoding == 'text':
+            return str(message)
+        if self.fields is None:
+            return to_plain(message, self._binary)
+        fields, getter = self._getters.get(type(message)) or self._field_getter(message)
+        if getter is None:
+            return to_plain(message, self._binary)
+        values = getter(message)
+        if len(fields) == 1:
+            values = (values,)
+        return {field: to_plain(value, self._binary) for field, value in zip(fields, values)}
+
+    def _field_getter(self, message):
+        # Selected fields are looked up per message type: a type without any
+        # of them (another topic) is sent whole
+        fields = []
+        for field in self.fields:
+            try:
+                attrgetter(field)(message)
+                fields.append(field)
+            except AttributeError:
+                pass
+        entry = self._getters[type(message)] = (fields, attrgetter(*fields) if fields else None)
+        return entry
+
+    def encode(self, message=None, data=None):
+        """
+        Returns the payload of a single, unbatched message.
+        """
+        sample = self.sample(message, data)
+        if self.encoding == 'cdr':
+            return sample
+        if self.encoding == 'text':
+            return sample.encode('utf-8')
+        return self._serialize(sample)
+
+    def encode_batch(self, timestamps, samples):
+        """
+        Returns the payload of a batch of samples (see the module docstring).
+        """
+        t0 = timestamps[0]
+        if self.encoding == 'cdr':
+            parts = [BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(samples), t0)]
+            for timestamp, blob in zip(timestamps, samples):
+                parts.append(BATCH_SAMPLE.pack(timestamp - t0, len(blob)))
+                parts.append(blob)
+            return b''.join(parts)
+        return self._serialize({'v': BATCH_VERSION, 't0': t0, 'dt': [timestamp - t0 for timestamp in timestamps],
+                                'samples': samples})
+
+    def add(self, topic, timestamp, message=None, data=None):
+        """
+        Adds a message of a topic (timestamp in ns) and returns the list of
+        (timestamp, topic, payload) ready to be published: the message itself
+        when not batching, otherwise the batches it completed. Batches are
+        returned with the timestamp of the message that completed them.
+        """
+        if not self.batching:
+            return [(timestamp, topic, self.encode(message, data))]
+        ready = []
+        pending = self._pending.get(topic)
+        if pending is not None and self.batch_span_ns and timestamp - pending[0][0] >= self.batch_span_ns:
+            ready.append(self._take(topic, timestamp))
+            pending = None
+        if pending is None:
+            pending = self._pending[topic] = ([], [])
+        pending[0].append(timestamp)
+        pending[1].append(self.sample(message, data))
+        if self.batch_size and len(pending[0]) >= self.batch_size:
+            ready.append(self._take(topic, timestamp))
+        return ready
+
+    def _take(self, topic, timestamp=None):
+        timestamps, samples = self._pending.pop(topic)
+        return timestamp if timestamp is not None else timestamps[-1], topic, self.encode_batch(timestamps, samples)
+
+    def flush(self):
+        """
+        Returns the (timestamp, topic, payload) of every incomplete batch.
+        """
+        ready = [self._take(topic) for topic in list(self._pending)]
+        ready.sort(key=lambda item: item[0])
+        return ready
+
+
+def decode_batch(payload, encoding):
+    """
+    Returns (timestamps in ns, samples) of a batch written by PayloadEncoder.
+    """
+    if encoding == 'cdr':
+        magic, version, count, t0 = BATCH_HEADER.unpack_from(payload)
+        if magic != BATCH_MAGIC or version != BATCH_VERSION:
+            raise ValueError('Not a version {} CDR batch'.format(BATCH_VERSION))
+        offset = BATCH_HEADER.size
+        timestamps, samples = [], []
+        for _ in range(count):
+            dt, length = BATCH_SAMPLE.unpack_from(payload, offset)
+            offset += BATCH_SAMPLE.size
+            timestamps.append(t0 + dt)
+            samples.append(bytes(payload[offset:offset + length]))
+            offset += length
+        return timestamps, samples
+    batch = get_deserializer(encoding)(payload)
+    return [batch['t0'] + dt for dt in batch['dt']], batch['samples']
+
+
+def add_encoding_args(parser, encodings=ENCODINGS):
+    """
+    Adds the --encoding, --fields, --batch_size and --batch_ms options to a script's argument parser.
+    """
+    parser.add_argument("--encoding", type=str, default="text", choices=encodings,
+                        help="Payload encoding (text is the str() of the message).")
+    parser.add_argument("--fields", type=str, default="",
+                        help="Comma-separated message fields to keep with json/cbor/msgpack "
+                             "(e.g. twist.twist.linear.x,twist.twist.angular.z). Default: all.")
+    parser.add_argument("--batch_size", type=int, default=0,
+                        help="Pack up to this many samples of a topic into one MQTT message.")
+    parser.add_argument("--batch_ms", type=float, default=0.0,
+                        help="Pack up to this many milliseconds of a topic into one MQTT message.")
+
+
+def encoder_from_args(args):
+    fields = [field.strip() for field in args.fields.split(",") if field.strip()]
+    return PayloadEncoder(args.encoding, fields, args.batch_size, args.batch_ms)
@@ -0,0 +1,159 @@
+"""Deadline-based playback timing shared by ExcelToMQTT.py and MQTTMessagePlayback.py.
+
+Sleeping for the gap between two consecutive messages lets publish latency
+and sleep overshoot pile up, so long replays drift away from the recorded
+timeline. PlaybackScheduler instead computes the absolute deadline of every
+message from the first timestamp, on the monotonic clock:
+
+    deadline = start + (timestamp - first_timestamp) / speedup
+
+A late message is released immediately and the following ones keep their
+original deadlines, so errors never accumulate. Messages due within
+'tolerance' of each other are released together without sleeping in
+between, which keeps high-rate topics (IMU) on time. The achieved-vs-target
+error of every message is recorded and reported as p50/p99 lag.
+
+    scheduler = PlaybackScheduler(speedup=2.0)
+    for loop, item in scheduler.play(events, loop_count=None):  # events: [(seconds, item)]
+        publish(item)
+    print(scheduler.stats.report())
+"""
+import time
+from collections import deque
+
+
+class LagStats:
+    """
+    Timing error of the released messages (release time - deadline, in seconds;
+    negative when released early, within the tolerance). Percentiles are
+    computed over the last 'window' messages, so memory stays bounded when
+    looping forever.
+    """
+
+    def __init__(self, window=100000):
+        self.lags = deque(maxlen=window)
+        self.count = 0
+        self.max_lag = 0.0
+
+    def add(self, lag):
+        self.lags.append(lag)
+        self.count += 1
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile (0-100) of the recent lags, in seconds.
+        """
+        if not self.lags:
+            return 0.0
+        values = sorted(self.lags)
+        return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+    def summary(self):
+        """
+        Returns the lag statistics in milliseconds.
+        """
+        return {
+            'messages': self.count,
+            'p50_ms': self.percentile(50) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max_lag * 1000,
+        }
+
+    def report(self):
+        summary = self.summary()
+        return (f"Timing error over {summary['messages']} messages: p50 {summary['p50_ms']:.2f} ms, "
+                f"p99 {summary['p99_ms']:.2f} ms, max {summary['max_ms']:.2f} ms")
+
+
+class PlaybackScheduler:
+    """
+    Releases messages at absolute deadlines derived from their timestamps.
+
+    :param speedup: Playback speed factor (2.0 = twice as fast as recorded).
+    :param tolerance: Messages due less than this many seconds from now are
+                      released without sleeping, so bursts go out together.
+    :param spin: The last part of each wait, in seconds, is spent polling the
+                 clock instead of sleeping, to avoid the scheduler's wake-up
+                 latency on the deadline.
+    """
+
+    def __init__(self, speedup=1.0, tolerance=0.002, spin=0.0002, clock=time.monotonic, sleep=time.sleep):
+        if speedup <= 0:
+            raise ValueError("speedup must be positive")
+        self.speedup = speedup
+        self.tolerance = tolerance
+        self.spin = spin
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = LagStats()
+        self._origin = None  # clock time of the first timestamp of the current loop
+        self._first = None  # first timestamp of the current loop
+        self._last_deadline = None
+
+    def start(self):
+        """
+        Anchors the timeline: the next message waited for is due now.
+        """
+        self._origin = self.clock()
+        self._first = None
+        self._last_deadline = self._origin
+
+    def deadline(self, timestamp):
+        """
+        Returns the clock time at which a message with this timestamp (in
+        seconds of recorded time) is due.
+        """
+        if self._origin is None:
+            self.start()
+        if self._first is None:
+            self._first = timestamp
+        return self._origin + (timestamp - self._first) / self.speedup
+
+    def wait(self, timestamp):
+        """
+        Blocks until the deadline of a message with this timestamp (seconds)
+        and returns the lag (release time - deadline) in seconds.
+        """
+        deadline = self.deadline(timestamp)
+        now = self.clock()
+        remaining = deadline - now
+        if remaining > self.tolerance:
+            if remaining > self.spin:
+                self.sleep(remaining - self.spin)
+            now = self.clock()
+            while now < deadline:
+                now = self.clock()
+        lag = now - deadline
+        self.stats.add(lag)
+        self._last_deadline = max(self._last_deadline, deadline)
+        return lag
+
+    def next_loop(self, gap=0.0):
+        """
+        Continues the timeline with a new loop: its first message is due 'gap'
+        seconds of recorded time after the last deadline of this loop.
+        """
+        if self._origin is None:
+            self.start()
+            return
+        self._origin = self._last_deadline + gap / self.speedup
+        self._first = None
+
+    def play(self, events, loop_count=1, loop_gap=0.0):
+        """
+        Yields (loop index, item) for every (timestamp in seconds, item) of
+        events at its deadline, loop_count times (None loops forever).
+        events must be a sequence sorted by timestamp.
+        """
+        if not events:
+            return
+        self.start()
+        loop = 0
+        while loop_count is None or loop < loop_count:
+            for timestamp, item in events:
+                self.wait(timestamp)
+                yield loop, item
+            loop += 1
+            self.next_loop(loop_gap)